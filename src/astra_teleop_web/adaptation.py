@@ -0,0 +1,137 @@
+import asyncio
+import logging
+
+from astra_teleop_web.encoding import aiortc_internals, get_sender_encoder
+
+logger = logging.getLogger(__name__)
+
+# (bitrate bps, downscale factor, max fps), from best to worst
+LEVELS = [
+    (1500000, 1.0, 30),
+    (1000000, 1.0, 30),
+    (600000, 0.75, 20),
+    (300000, 0.5, 15),
+    (150000, 0.5, 10),
+]
+
+LOSS_CONGESTED = 0.1 # fraction of packets lost reported by the receiver
+LOSS_CLEAR = 0.02
+RTT_CONGESTED = 0.1 # s, above the lowest rtt seen
+CLEAR_TICKS_TO_UPGRADE = 3
+
+def set_sender_bitrate(sender, bitrate):
+    # aiortc only exposes the encoder bitrate to REMB, so we set it on the encoder directly
+    # (it is created on the first frame)
+    if not aiortc_internals(sender=sender):
+        return
+    encoder = get_sender_encoder(sender)
+    if encoder is None:
+        return
+    if hasattr(encoder, "bitrate_cap"):
+        # TrackEncoder, encodes at min(REMB estimate, cap)
+        encoder.bitrate_cap = bitrate
+    elif hasattr(encoder, "target_bitrate") and encoder.target_bitrate > bitrate:
+        # aiortc's own encoders have the REMB estimate only, lowered to the cap
+        encoder.target_bitrate = bitrate
+
+# Reads receiver reports of every video sender and moves tracks along LEVELS.
+# Lower priority tracks (wrists) are degraded first and upgraded last.
+class AdaptationController:
+    def __init__(self, pc, tracks, priority=("head", "wrist_left", "wrist_right"), interval=1, log=None):
+        self.pc = pc
+        self.tracks = tracks
+        self.priority = list(priority)
+        self.interval = interval
+        self.log = log
+        self.level = { name: 0 for name in self.priority }
+        self.min_rtt = None
+        self.clear_ticks = 0
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def senders(self):
+        senders = {}
+        for sender in self.pc.getSenders():
+            for name, track in self.tracks.items():
+                if track is not None and sender.track is track:
+                    senders[name] = sender
+        return senders
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.warning(f"Adaptation failed: {e}")
+
+    async def tick(self):
+        senders = self.senders()
+
+        loss = 0
+        rtt = None
+        for sender in senders.values():
+            stats = await sender.getStats()
+            for report in stats.values():
+                if report.type == "remote-inbound-rtp":
+                    loss = max(loss, report.fractionLost / 256)
+                    if report.roundTripTime is not None:
+                        rtt = report.roundTripTime if rtt is None else max(rtt, report.roundTripTime)
+
+        if rtt is not None:
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        rtt_excess = 0 if rtt is None else rtt - self.min_rtt
+
+        if loss > LOSS_CONGESTED or rtt_excess > RTT_CONGESTED:
+            self.clear_ticks = 0
+            name = self.pick([name for name in senders if self.level[name] < len(LEVELS) - 1], min)
+            if name is not None:
+                self.set_level(name, self.level[name] + 1, f"loss {loss:.0%}, rtt +{rtt_excess * 1000:.0f}ms")
+        elif loss < LOSS_CLEAR:
+            self.clear_ticks += 1
+            if self.clear_ticks >= CLEAR_TICKS_TO_UPGRADE:
+                self.clear_ticks = 0
+                name = self.pick([name for name in senders if self.level[name] > 0], max, reverse=True)
+                if name is not None:
+                    self.set_level(name, self.level[name] - 1, "link clear")
+        else:
+            self.clear_ticks = 0
+
+        # applied every tick, the encoder of a sender is created on its first frame
+        for name, sender in senders.items():
+            set_sender_bitrate(sender, LEVELS[self.level[name]][0])
+
+    def pick(self, candidates, by, reverse=False):
+        # The most important track is degraded only when all the others are at the worst level,
+        # and recovered before them. Others take turns, starting from the least important one.
+        if not candidates:
+            return None
+        top = self.priority[0]
+        others = [name for name in candidates if name != top]
+        if not reverse and others:
+            candidates = others
+        elif reverse and top in candidates:
+            return top
+        order = list(reversed(self.priority))
+        level = by(self.level[name] for name in candidates)
+        return min((name for name in candidates if self.level[name] == level), key=order.index)
+
+    def set_level(self, name, level, reason):
+        self.level[name] = level
+        bitrate, scale, fps = LEVELS[level]
+        track = self.tracks[name]
+        track.scale = scale
+        track.max_fps = fps
+
+        message = f"Video {name}: {bitrate // 1000}kbps, scale {scale}, {fps}fps ({reason})"
+        logger.info(message)
+        if self.log is not None:
+            self.log(message)
@@ -0,0 +1,217 @@
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import subprocess
+import threading
+import time
+import logging
+import aiohttp.web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+COMPRESS_SUFFIXES = [".js", ".css", ".wasm", ".json", ".svg", ".map"] # pages are compressed when served, see read
+MIN_COMPRESS_SIZE = 1024 # bytes
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")] # in order of preference
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache" # cached, but checked with the ETag on every load
+TAILWIND_VERSION = "3.4.5"
+CHECK_INTERVAL = 1 # s, a served file is checked for changes at most this often
+
+# local scripts / stylesheets / images referenced by a page, e.g. src="index.js"
+ASSET_REF = re.compile(r'((?:src|href)=")([^":?#]+\.(?:js|css|wasm|png|svg|ico))(")')
+
+mimetypes.add_type("application/wasm", ".wasm")
+mimetypes.add_type("text/javascript", ".js")
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=11)
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+# One file of the static directory, with its compressed variants
+class Asset:
+    def __init__(self, name, stat, body, deps=None):
+        self.name = name
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        self.deps = deps or {} # name -> version of the assets a page references
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type in ["application/json", "image/svg+xml"]:
+            content_type += "; charset=utf-8"
+        self.content_type = content_type
+        self.bodies = { "identity": body }
+
+    def etag(self, encoding):
+        return f'"{self.version}-{encoding}"'
+
+# Serves the static directory:
+# - precompressed variants (name.br / name.gz, see build below) to clients accepting them,
+#   variants older than the file are ignored
+# - every response has an ETag, so unchanged files are revalidated with a 304
+# - pages reference local assets as name?v=<content hash>, those URLs are cached as immutable,
+#   everything else (the pages, assets loaded by scripts) is revalidated on every load
+# - no directory listing
+# Files are read once (all of them by preload, at startup) and kept in memory until they change.
+# Reading, hashing and compressing run in the default executor, not on the event loop.
+class StaticAssets:
+    def __init__(self, directory=STATIC_DIR):
+        self.directory = os.path.realpath(directory)
+        self.assets = {}
+        self.checked = {} # name -> monotonic time load last looked at the file
+        self.lock = threading.RLock() # load runs in executor threads, and recurses for pages
+
+    def path(self, name):
+        path = os.path.realpath(os.path.join(self.directory, name))
+        if os.path.commonpath([path, self.directory]) != self.directory or not os.path.isfile(path):
+            return None
+        return path
+
+    def load(self, name):
+        with self.lock:
+            path = self.path(name)
+            if path is None:
+                self.assets.pop(name, None)
+                return None
+            stat = os.stat(path)
+            asset = self.assets.get(name)
+            if (
+                asset is None
+                or asset.mtime_ns != stat.st_mtime_ns
+                or asset.size != stat.st_size
+                or any(self.version(dep) != version for dep, version in asset.deps.items())
+            ):
+                asset = self.assets[name] = self.read(name, path, stat)
+            self.checked[name] = time.monotonic()
+            return asset
+
+    def preload(self):
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if d != "__pycache__" and not d.startswith(".")]
+            for file in files:
+                if file.startswith(".") or any(file.endswith(suffix) for _, suffix in ENCODINGS):
+                    continue
+                self.load(os.path.relpath(os.path.join(root, file), self.directory))
+        logger.info(f"{len(self.assets)} static files loaded")
+
+    def version(self, name):
+        asset = self.load(name)
+        return asset.version if asset is not None else None
+
+    def read(self, name, path, stat):
+        with open(path, "rb") as f:
+            body = f.read()
+
+        if name.endswith(".html"):
+            deps = {}
+            def versioned(m):
+                ref = os.path.normpath(os.path.join(os.path.dirname(name), m.group(2)))
+                version = self.version(ref)
+                if version is None:
+                    return m.group(0) # e.g. not built, the page handles the 404
+                deps[ref] = version
+                return f"{m.group(1)}{m.group(2)}?v={version}{m.group(3)}"
+            body = ASSET_REF.sub(versioned, body.decode()).encode()
+            asset = Asset(name, stat, body, deps)
+            # differs from the file, compressed here
+            for encoding, _ in ENCODINGS:
+                if encoding != "br" or brotli is not None:
+                    asset.bodies[encoding] = compress(body, encoding)
+            return asset
+
+        asset = Asset(name, stat, body)
+        for encoding, suffix in ENCODINGS:
+            variant = path + suffix
+            if os.path.isfile(variant) and os.stat(variant).st_mtime_ns >= stat.st_mtime_ns:
+                with open(variant, "rb") as f:
+                    asset.bodies[encoding] = f.read()
+        return asset
+
+    def encoding(self, request, asset):
+        accepted = set()
+        for item in request.headers.get("Accept-Encoding", "").split(","):
+            token, _, params = item.strip().partition(";")
+            if params.replace(" ", "") not in ["q=0", "q=0.0", "q=0.00", "q=0.000"]:
+                accepted.add(token.strip().lower())
+        for encoding, _ in ENCODINGS:
+            if encoding in asset.bodies and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    async def handle(self, request):
+        name = request.match_info.get("name") or "index.html"
+        asset = self.assets.get(name)
+        if asset is None or time.monotonic() - self.checked.get(name, 0) > CHECK_INTERVAL:
+            asset = await asyncio.get_running_loop().run_in_executor(None, self.load, name)
+        if asset is None:
+            raise aiohttp.web.HTTPNotFound()
+
+        encoding = self.encoding(request, asset)
+        etag = asset.etag(encoding)
+        headers = {
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+            "Cache-Control": IMMUTABLE if request.query.get("v") == asset.version else REVALIDATE,
+        }
+        if etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+            return aiohttp.web.Response(status=304, headers=headers)
+
+        headers["Content-Type"] = asset.content_type
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return aiohttp.web.Response(body=asset.bodies[encoding], headers=headers)
+
+    def add_routes(self, app):
+        app.router.add_get("/", self.handle)
+        app.router.add_get("/{name:.+}", self.handle)
+
+def build_css(directory=STATIC_DIR):
+    # Compiles the classes used by the page into tailwind.css, in place of the runtime compiler
+    # (tailwind-play-cdn-*.js, still loaded by the page when tailwind.css is missing)
+    subprocess.run([
+        "npx", "--yes", f"tailwindcss@{TAILWIND_VERSION}",
+        "-c", "tailwind.config.js", "-i", "tailwind.input.css", "-o", "tailwind.css", "--minify",
+    ], cwd=directory, check=True)
+
+def build_compressed(directory=STATIC_DIR):
+    # Writes name.gz (and name.br with the brotli package) next to every compressible file
+    encodings = [(encoding, suffix) for encoding, suffix in ENCODINGS if encoding != "br" or brotli is not None]
+    if brotli is None:
+        logger.warning("brotli is not installed, only gzip variants are built")
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.splitext(name)[1] not in COMPRESS_SUFFIXES or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        if stat.st_size < MIN_COMPRESS_SIZE:
+            continue
+        with open(path, "rb") as f:
+            body = f.read()
+        for encoding, suffix in encodings:
+            if os.path.isfile(path + suffix) and os.stat(path + suffix).st_mtime_ns >= stat.st_mtime_ns:
+                continue
+            compressed = compress(body, encoding)
+            with open(path + suffix, "wb") as f:
+                f.write(compressed)
+            logger.info(f"{name}{suffix}: {len(body)} -> {len(compressed)} bytes")
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build tailwind.css and the precompressed variants of the static files")
+    parser.add_argument("--no-css", action="store_true", help="skip tailwind.css (needs node / npx)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.no_css:
+        build_css()
+    build_compressed()
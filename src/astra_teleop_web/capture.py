@@ -0,0 +1,198 @@
+import threading
+import time
+import logging
+import av
+import cv2
+
+from astra_teleop_web.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_INTERVAL = 1 # s, between attempts to open a missing / unplugged camera
+READ_FAILURE_TIMEOUT = 1 # s of failing reads, before the camera is reopened
+FPS_INTERVAL = 1 # s
+
+class CameraConfig:
+    def __init__(self, name, device=None, backend="opencv", input_format="mjpeg", width=640, height=360, fps=30, buffers=1):
+        self.name = name # track name
+        self.device = device if device is not None else f"/dev/video_{name}"
+        # opencv: frames decoded by OpenCV, fed as bgr24
+        # av: frames decoded by libav and fed as yuv420p / nv12 (no RGB round trip), or with
+        #     input_format="h264" encoded packets are fed as they are (for passthrough tracks)
+        self.backend = backend
+        self.input_format = input_format
+        self.width = width
+        self.height = height
+        self.fps = fps
+        # driver buffers (opencv), fewer buffers means older frames can not pile up in the driver.
+        # libav always queues 256, so there packets that are already late are skipped instead.
+        self.buffers = buffers
+
+# Captures one camera on its own thread and hands every frame to sink(image, timestamp_ns, pixel_format),
+# where timestamp_ns is the capture time of the driver when available (packets have pixel_format None).
+# The camera is reopened when reading fails or the device is unplugged.
+class Camera:
+    def __init__(self, config, sink):
+        self.config = config
+        self.sink = sink
+        self.running = True # run() can also be called directly, e.g. in a capture process
+        self.thread = None
+
+        self.connected = False
+        self.frames = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.fps = 0
+        self.fps_frames = 0
+        self.fps_time = time.monotonic()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"capture_{self.config.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            try:
+                if self.config.backend == "av":
+                    self.run_av()
+                else:
+                    self.run_opencv()
+            except Exception as e:
+                logger.warning(f"Camera {self.config.name} ({self.config.device}): {e}")
+            if self.connected:
+                self.connected = False
+                self.reconnects += 1
+                metrics.inc("capture_reconnects_total", camera=self.config.name)
+            time.sleep(RECONNECT_INTERVAL)
+
+    def run_opencv(self):
+        config = self.config
+        cam = cv2.VideoCapture(config.device, cv2.CAP_V4L2)
+        try:
+            if not cam.isOpened():
+                raise IOError("can not open")
+            cam.set(cv2.CAP_PROP_BUFFERSIZE, config.buffers)
+            if config.input_format == "mjpeg":
+                cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+            cam.set(cv2.CAP_PROP_FRAME_HEIGHT, config.height)
+            cam.set(cv2.CAP_PROP_FRAME_WIDTH, config.width)
+            cam.set(cv2.CAP_PROP_FPS, config.fps)
+            self.opened()
+
+            failing_since = None
+            while self.running:
+                ret, image = cam.read()
+                read_time_ns = time.time_ns()
+                if not ret:
+                    # a read can fail at once, without waiting for a frame
+                    now = time.monotonic()
+                    if failing_since is None:
+                        failing_since = now
+                    elif now - failing_since >= READ_FAILURE_TIMEOUT:
+                        raise IOError("read failed")
+                    time.sleep(1 / config.fps)
+                    continue
+                failing_since = None
+                # V4L2 buffer timestamp, on CLOCK_MONOTONIC
+                driver_age_ns = time.monotonic_ns() - int(cam.get(cv2.CAP_PROP_POS_MSEC) * 1000000)
+                self.deliver(image, self.capture_time_ns(read_time_ns, driver_age_ns), "bgr24")
+        finally:
+            cam.release()
+
+    def run_av(self):
+        config = self.config
+        container = av.open(config.device, format="v4l2", options={
+            "input_format": config.input_format,
+            "framerate": str(config.fps),
+            "video_size": f"{config.width}x{config.height}",
+            "timestamps": "mono2abs", # driver capture time, as wall clock
+        })
+        try:
+            stream = container.streams.video[0]
+            self.opened()
+            max_age_ns = 2 * 1000000000 // config.fps
+
+            for packet in container.demux(stream):
+                if not self.running:
+                    break
+                if packet.size == 0:
+                    continue
+                read_time_ns = time.time_ns()
+                capture_time_ns = read_time_ns
+                if packet.pts is not None:
+                    capture_time_ns = self.capture_time_ns(read_time_ns, read_time_ns - int(packet.pts * packet.time_base * 1000000000))
+
+                if config.input_format == "h264":
+                    # packets depend on each other, none can be skipped
+                    self.deliver(packet, capture_time_ns, None)
+                    continue
+
+                if read_time_ns - capture_time_ns > max_age_ns:
+                    # queued in the driver while we were busy, a newer frame is already waiting
+                    self.dropped += 1
+                    metrics.inc("capture_dropped_total", camera=config.name)
+                    continue
+
+                for frame in packet.decode():
+                    if frame.format.name not in ["yuv420p", "nv12"]:
+                        frame = frame.reformat(format="yuv420p") # MJPEG decodes to yuvj422p
+                    self.deliver(frame.to_ndarray(), capture_time_ns, frame.format.name)
+        finally:
+            container.close()
+
+    def capture_time_ns(self, read_time_ns, driver_age_ns):
+        # fall back to the read time when the driver timestamp is missing or on another clock
+        if 0 <= driver_age_ns < 1000000000:
+            return read_time_ns - driver_age_ns
+        return read_time_ns
+
+    def opened(self):
+        logger.info(f"Camera {self.config.name} opened ({self.config.device})")
+        self.connected = True
+
+    def deliver(self, image, timestamp_ns, pixel_format):
+        self.sink(image, timestamp_ns, pixel_format)
+        metrics.observe("capture_latency_seconds", (time.time_ns() - timestamp_ns) / 1000000000, camera=self.config.name)
+
+        self.frames += 1
+        self.fps_frames += 1
+        now = time.monotonic()
+        if now - self.fps_time >= FPS_INTERVAL:
+            self.fps = self.fps_frames / (now - self.fps_time)
+            self.fps_frames = 0
+            self.fps_time = now
+            metrics.set("capture_fps", round(self.fps, 1), camera=self.config.name)
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "fps": self.fps,
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "reconnects": self.reconnects,
+        }
+
+# Cameras feeding the tracks of a WebServer
+class CaptureManager:
+    def __init__(self, webserver, configs):
+        self.webserver = webserver
+        self.cameras = { config.name: Camera(config, self.sink(config.name)) for config in configs }
+
+    def sink(self, name):
+        def feed(image, timestamp_ns, pixel_format):
+            self.webserver.track_feed(name, (image, int(timestamp_ns / 1000000000), int(timestamp_ns % 1000000000)), pixel_format=pixel_format)
+        return feed
+
+    def start(self):
+        for camera in self.cameras.values():
+            camera.start()
+
+    def stop(self):
+        for camera in self.cameras.values():
+            camera.stop()
+
+    def stats(self):
+        return { name: camera.stats() for name, camera in self.cameras.items() }
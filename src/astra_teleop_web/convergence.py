@@ -0,0 +1,63 @@
+import asyncio
+import math
+import threading
+import numpy as np
+
+# Lets coroutines wait for a condition on state that is updated from other threads
+# (ROS pose callbacks, dispatch threads): every notify() re-checks the condition at once
+# instead of on the next tick of a polling loop.
+class StateNotifier:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = set() # (loop, asyncio.Event)
+
+    def notify(self):
+        with self.lock:
+            waiters = list(self.waiters)
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    async def wait_for(self, predicate, timeout=None, interval=None, on_interval=None):
+        # Returns the seconds it took for predicate() to become true, raises asyncio.TimeoutError.
+        # on_interval() is called first and then every `interval` seconds (e.g. to republish a goal),
+        # the predicate is re-checked then too, for state nobody notifies about.
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        with self.lock:
+            self.waiters.add(waiter)
+
+        t0 = loop.time()
+        next_interval_time = t0
+        try:
+            while True:
+                now = loop.time()
+                if interval is not None and now >= next_interval_time:
+                    if on_interval is not None:
+                        on_interval()
+                    next_interval_time = now + interval
+
+                event.clear() # before checking, so a notify in between is not lost
+                if predicate():
+                    return loop.time() - t0
+
+                wait = math.inf
+                if timeout is not None:
+                    wait = t0 + timeout - now
+                    if wait <= 0:
+                        raise asyncio.TimeoutError
+                if interval is not None:
+                    wait = min(wait, next_interval_time - now)
+                try:
+                    await asyncio.wait_for(event.wait(), None if wait == math.inf else wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
+
+def pose_distance(T0, T1):
+    # (position distance, rotation angle) between two transforms
+    pos_dist = np.linalg.norm(T0[:3, 3] - T1[:3, 3])
+    cos_angle = (np.trace(T0[:3, :3].T @ T1[:3, :3]) - 1) / 2
+    return pos_dist, math.acos(min(1.0, max(-1.0, cos_angle)))
@@ -0,0 +1,92 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import logging
+import time
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+# Per worker process detector, same settings as capture() in index.js
+detector = None
+
+def detect_markers(gray):
+    global detector
+    if detector is None:
+        aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
+        detector_parameters = cv2.aruco.DetectorParameters()
+        detector_parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
+        refine_parameters = cv2.aruco.RefineParameters(10, 3, True)
+        detector = cv2.aruco.ArucoDetector(aruco_dict, detector_parameters, refine_parameters)
+
+    corners, ids, rejected = detector.detectMarkers(gray) # 9ms@1280x720
+    if ids is None:
+        return np.zeros((0, 1, 4, 2), dtype=np.float32), np.zeros((0, 1), dtype=np.int32)
+    return np.array(corners, dtype=np.float32).reshape(-1, 1, 4, 2), ids.astype(np.int32).reshape(-1, 1)
+
+DISTORTION_COEFFICIENTS = [4, 5, 8, 12, 14] # counts cv2 accepts
+
+def parse_intrinsics(camera_matrix, distortion_coefficients):
+    # -> camera_matrix (3, 3), distortion_coefficients (1, n), ValueError if they are not usable
+    try:
+        camera_matrix = np.array(camera_matrix, dtype=np.float32).reshape(3, 3)
+        distortion_coefficients = np.array(distortion_coefficients, dtype=np.float32).reshape(1, -1)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid intrinsics: {e}")
+    if distortion_coefficients.shape[1] not in DISTORTION_COEFFICIENTS:
+        raise ValueError(f"Invalid intrinsics: {distortion_coefficients.shape[1]} distortion coefficients")
+    if not (np.isfinite(camera_matrix).all() and np.isfinite(distortion_coefficients).all()):
+        raise ValueError("Invalid intrinsics: not finite")
+    return camera_matrix, distortion_coefficients
+
+# Runs ArUco detection on the browser's capture camera, uploaded as a WebRTC track,
+# and reports results like the `hand` channel does.
+class ServerSideDetector:
+    def __init__(self, camera_matrix, distortion_coefficients, on_hand, workers=2):
+        self.camera_matrix, self.distortion_coefficients = parse_intrinsics(camera_matrix, distortion_coefficients)
+        self.on_hand = on_hand
+        self.workers = workers
+        # spawn, since forking a process with running event loop threads is not safe
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        self.in_flight = 0
+        self.seq = 0
+        self.last_delivered_seq = 0
+        self.detect_time = 0
+        self.task = None
+
+    def start(self, track):
+        self.task = asyncio.create_task(self.run(track))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    async def run(self, track):
+        while True:
+            frame = await track.recv()
+            if self.in_flight >= self.workers:
+                continue # all workers busy, only detect the newest frames
+            gray = frame.to_ndarray(format="gray") # luma plane, no colour conversion needed
+            self.seq += 1
+            self.in_flight += 1
+            asyncio.create_task(self.detect(self.seq, gray))
+
+    async def detect(self, seq, gray):
+        try:
+            t0 = time.perf_counter()
+            corners, ids = await asyncio.get_running_loop().run_in_executor(self.pool, detect_markers, gray)
+            self.detect_time = time.perf_counter() - t0
+        except Exception as e:
+            logger.warning(f"Server side detection failed: {e}")
+            return
+        finally:
+            self.in_flight -= 1
+
+        if seq < self.last_delivered_seq:
+            return # a newer frame finished first
+        self.last_delivered_seq = seq
+        if self.on_hand:
+            self.on_hand(self.camera_matrix, self.distortion_coefficients, corners, ids)
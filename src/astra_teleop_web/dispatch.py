@@ -0,0 +1,153 @@
+import asyncio
+import collections
+import threading
+import time
+import logging
+
+from astra_teleop_web.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Datachannel messages are handed to the callbacks through a Dispatcher, so a slow solve or
+# a blocking publish does not stall SCTP and the video tracks on the event loop.
+#
+# Policies:
+#   latest:   keep only the newest message, for hand (a newer detection supersedes older ones)
+#   coalesce: merge a message into the waiting one with `merge`, for pedal (the newest
+#             values by default, pedal readings are absolute)
+#   fifo:     every message in order, up to `maxsize` waiting (newer ones are dropped), for control
+POLICIES = ["latest", "coalesce", "fifo"]
+DEFAULT_POLICY = { "hand": "latest", "pedal": "coalesce", "control": "fifo" }
+
+# Plain callbacks run on a dedicated thread, coroutine functions on a task of the event loop
+# (one at a time, so control commands never overlap).
+class Dispatcher:
+    def __init__(self, channel, callback, policy="fifo", maxsize=64, merge=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown dispatch policy {policy}")
+        self.channel = channel
+        self.callback = callback
+        self.policy = policy
+        self.maxsize = maxsize
+        self.merge = merge if merge is not None else (lambda old, new: new)
+        self.is_async = asyncio.iscoroutinefunction(callback)
+
+        self.q = collections.deque() # (args, put time)
+        self.lock = threading.Lock()
+        self.wakeup = None
+        self.worker = None
+        self.current = None # task of the running coroutine callback
+        self.running = False
+
+        self.processed = 0
+        self.dropped = 0
+
+    def start(self):
+        self.running = True
+        if self.is_async:
+            self.wakeup = asyncio.Event()
+            self.worker = asyncio.create_task(self.run_async())
+        else:
+            self.wakeup = threading.Event()
+            self.worker = threading.Thread(target=self.run_thread, name=f"dispatch_{self.channel}", daemon=True)
+            self.worker.start()
+
+    def stop(self):
+        self.running = False
+        if self.wakeup is not None:
+            self.wakeup.set()
+        if self.is_async and self.worker is not None:
+            self.worker.cancel()
+
+    def put(self, *args):
+        # called from the event loop
+        with self.lock:
+            put_time = time.perf_counter()
+            dropped = 0
+            if self.q and self.policy == "latest":
+                self.q.clear()
+                dropped = 1
+            elif self.q and self.policy == "coalesce":
+                old_args, put_time = self.q.pop() # waited since the first merged message
+                args = self.merge(old_args, args)
+                dropped = 1
+            elif len(self.q) >= self.maxsize:
+                dropped = 1
+                args = None
+            if args is not None:
+                self.q.append((args, put_time))
+            self.dropped += dropped
+            depth = len(self.q)
+
+        if args is None:
+            logger.warning(f"Dispatch queue of {self.channel} is full, message dropped")
+        if dropped:
+            metrics.inc("dispatch_dropped_total", channel=self.channel)
+        metrics.set("dispatch_queue_depth", depth, channel=self.channel)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def get(self):
+        with self.lock:
+            if not self.q:
+                return None
+            item = self.q.popleft()
+            depth = len(self.q)
+        metrics.set("dispatch_queue_depth", depth, channel=self.channel)
+        metrics.observe("dispatch_wait_seconds", time.perf_counter() - item[1], channel=self.channel)
+        return item[0]
+
+    def run_thread(self):
+        while self.running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while self.running:
+                args = self.get()
+                if args is None:
+                    break
+                t0 = time.perf_counter()
+                try:
+                    self.callback(*args)
+                except Exception as e:
+                    logger.warning(f"{self.channel} callback failed: {e}")
+                self.done(t0)
+
+    async def run_async(self):
+        while self.running:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.running:
+                args = self.get()
+                if args is None:
+                    break
+                t0 = time.perf_counter()
+                self.current = asyncio.create_task(self.callback(*args))
+                try:
+                    await asyncio.wait([self.current])
+                    if self.current.cancelled():
+                        logger.info(f"{self.channel} callback cancelled")
+                    elif self.current.exception() is not None:
+                        logger.warning(f"{self.channel} callback failed: {self.current.exception()}")
+                finally:
+                    self.current = None
+                self.done(t0)
+
+    def cancel(self):
+        # drops waiting messages and cancels the running coroutine callback, if any
+        with self.lock:
+            self.q.clear()
+        if self.current is not None:
+            self.current.cancel()
+            return True
+        return False
+
+    def done(self, t0):
+        self.processed += 1
+        metrics.observe("callback_seconds", time.perf_counter() - t0, channel=self.channel)
+
+    def stats(self):
+        return {
+            "depth": len(self.q),
+            "processed": self.processed,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,277 @@
+import fractions
+import multiprocessing
+import time
+import logging
+import av
+import av.video
+from aiortc.codecs.base import Encoder
+from aiortc.codecs.h264 import H264Encoder
+from aiortc.codecs.vpx import Vp8Encoder, number_of_threads
+from aiortc.mediastreams import VIDEO_TIME_BASE, convert_timebase
+
+from astra_teleop_web.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CODECS = ["video/H264", "video/VP8"]
+WORKERS = ["thread", "process"]
+# Bitrate changes the running encoder can not follow (libvpx, or x264 above the VBV maxrate it
+# was opened with) recreate the codec, starting with a keyframe, only when the bitrate is off by
+# more than this factor, and at most every RECREATE_INTERVAL
+RECREATE_BITRATE_FACTOR = 1.5
+RECREATE_INTERVAL = 5 # s
+
+# aiortc has no API to pick the encoder of a sender or to read the negotiated codec, so these
+# private attributes are used (as in the aiortc versions pinned in pyproject.toml)
+SENDER_ENCODER = "_RTCRtpSender__encoder"
+TRANSCEIVER_CODECS = "_codecs"
+aiortc_internals_warned = False
+
+def aiortc_internals(transceiver=None, sender=None):
+    # -> True if the private attributes are there, warns once when they are not
+    global aiortc_internals_warned
+    ok = (
+        (transceiver is None or (hasattr(transceiver, TRANSCEIVER_CODECS) and hasattr(transceiver.sender, SENDER_ENCODER)))
+        and (sender is None or hasattr(sender, SENDER_ENCODER))
+    )
+    if not ok and not aiortc_internals_warned:
+        aiortc_internals_warned = True
+        logger.warning("This aiortc version is not supported, its own encoders are used without the encoder config and adaptation")
+    return ok
+
+def set_sender_encoder(sender, encoder):
+    setattr(sender, SENDER_ENCODER, encoder)
+
+def get_sender_encoder(sender):
+    return getattr(sender, SENDER_ENCODER, None)
+
+class EncoderConfig:
+    def __init__(self, codec=None, preset="ultrafast", keyframe_interval=120, bitrate=1000000, min_bitrate=100000, max_bitrate=3000000, threads=0, worker="thread", fps=30):
+        if codec is not None and codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec}, expected one of {CODECS}")
+        if worker not in WORKERS:
+            raise ValueError(f"Unknown encoder worker {worker}, expected one of {WORKERS}")
+        self.codec = codec # preferred codec of the operator tracks, None leaves the choice to the browser
+        self.preset = preset # x264 preset
+        self.keyframe_interval = keyframe_interval # frames, keyframes requested by the browser (PLI) are sent anyway
+        # bps, the start bitrate and the range REMB / AdaptationController can move it in
+        # (aiortc clamps to 500k-3M for H.264 and 250k-1.5M for VP8)
+        self.bitrate = bitrate
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        self.threads = threads # encoder threads per track, 0 for by frame size like aiortc
+        # thread: encode in the aiortc executor thread (one per track at a time)
+        # process: encode in a dedicated process per track, out of the GIL of the control stack
+        self.worker = worker
+        self.fps = fps
+
+def create_codec(config, mime_type, width, height, bitrate, time_base, options=None):
+    threads = config.threads or number_of_threads(width * height, multiprocessing.cpu_count())
+    if mime_type == "video/H264":
+        codec = av.CodecContext.create("libx264", "w")
+        codec.profile = "Baseline"
+        codec.options = {
+            "level": "31",
+            "preset": config.preset,
+            "tune": "zerolatency", # no B-frames and no lookahead, every frame comes out right away
+            "forced-idr": "1", # keyframes requested by the browser must be decodable on their own
+            # VBV caps the size of single frames, so a keyframe does not delay the frames after it
+            "maxrate": str(bitrate),
+            "bufsize": str(bitrate // 2),
+            **(options or {}),
+        }
+    else:
+        codec = av.CodecContext.create("libvpx", "w")
+        codec.qmin = 2
+        codec.qmax = 56
+        # realtime settings of aiortc's Vp8Encoder
+        codec.options = {
+            "bufsize": str(bitrate),
+            "cpu-used": "-6",
+            "deadline": "realtime",
+            "lag-in-frames": "0",
+            "minrate": str(bitrate),
+            "maxrate": str(bitrate),
+            "noise-sensitivity": "4",
+            "overshoot-pct": "15",
+            "partitions": "0",
+            "static-thresh": "1",
+            "undershoot-pct": "100",
+            **(options or {}),
+        }
+    codec.width = width
+    codec.height = height
+    codec.bit_rate = bitrate
+    codec.pix_fmt = "yuv420p"
+    codec.gop_size = config.keyframe_interval
+    codec.framerate = fractions.Fraction(config.fps, 1)
+    codec.time_base = time_base
+    codec.thread_count = threads
+    return codec
+
+# One codec context, recreated when the frame size changes. Lower bitrates are applied to the
+# running x264 encoder (libavcodec reconfigures it), so they do not cost a keyframe.
+class FrameEncoder:
+    def __init__(self, config, mime_type):
+        self.config = config
+        self.mime_type = mime_type
+        self.codec = None
+        self.codec_time = 0
+        self.codec_bitrate = None # opened with
+
+    def encode(self, frame, force_keyframe, bitrate):
+        if self.codec is not None and (frame.width != self.codec.width or frame.height != self.codec.height):
+            self.codec = None
+        if self.codec is not None and abs(bitrate - self.codec.bit_rate) / self.codec.bit_rate > 0.05:
+            self.set_bitrate(bitrate)
+        if self.codec is None:
+            self.codec = create_codec(self.config, self.mime_type, frame.width, frame.height, bitrate, frame.time_base)
+            self.codec_time = time.monotonic()
+            self.codec_bitrate = bitrate
+            force_keyframe = True
+
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        frame.pict_type = av.video.frame.PictureType.I if force_keyframe else av.video.frame.PictureType.NONE
+        return self.codec.encode(frame)
+
+    def set_bitrate(self, bitrate):
+        if self.mime_type == "video/H264":
+            # maxrate can not be changed on the running encoder, bit_rate up to it can
+            self.codec.bit_rate = min(bitrate, self.codec_bitrate)
+            if bitrate <= self.codec_bitrate:
+                return
+        factor = max(bitrate, self.codec_bitrate) / min(bitrate, self.codec_bitrate)
+        if factor > RECREATE_BITRATE_FACTOR and time.monotonic() - self.codec_time >= RECREATE_INTERVAL:
+            self.codec = None
+
+    def close(self):
+        self.codec = None
+
+def encoder_process(conn, config, mime_type):
+    encoder = FrameEncoder(config, mime_type)
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        image, pts, time_base, force_keyframe, bitrate = request
+        frame = av.video.VideoFrame.from_ndarray(image, format="yuv420p")
+        frame.pts = pts
+        frame.time_base = time_base
+        conn.send([(bytes(packet), packet.pts, packet.is_keyframe) for packet in encoder.encode(frame, force_keyframe, bitrate)])
+
+# FrameEncoder in a process of its own, frames are passed as yuv420p arrays through a pipe
+class ProcessFrameEncoder:
+    def __init__(self, config, mime_type, name=None):
+        self.config = config
+        self.mime_type = mime_type
+        self.name = name
+        self.process = None
+        self.conn = None
+        self.start()
+
+    def start(self):
+        # spawned, forking the threads of the webserver is not safe
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=encoder_process, args=(child_conn, self.config, self.mime_type), name=f"encoder_{self.name}", daemon=True)
+        self.process.start()
+
+    def encode(self, frame, force_keyframe, bitrate):
+        if not self.process.is_alive():
+            logger.warning(f"Encoder process of {self.name} exited ({self.process.exitcode}), restarting")
+            self.start()
+            force_keyframe = True
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        self.conn.send((frame.to_ndarray(), frame.pts, frame.time_base, force_keyframe, bitrate))
+        packets = []
+        for data, pts, is_keyframe in self.conn.recv():
+            packet = av.Packet(data)
+            packet.pts = pts
+            packet.is_keyframe = is_keyframe
+            packet.time_base = frame.time_base
+            packets.append(packet)
+        return packets
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+
+# Installed as the encoder of an aiortc sender (see WebServer.offer), replacing the default one
+# created on the first frame, for control over the codec settings and where encoding runs.
+# Packetization is left to aiortc's encoder of the negotiated codec.
+class TrackEncoder(Encoder):
+    def __init__(self, config, mime_type, name=None):
+        self.config = config
+        self.mime_type = "video/H264" if mime_type.lower() == "video/h264" else "video/VP8"
+        self.name = name
+        self.packetizer = H264Encoder() if self.mime_type == "video/H264" else Vp8Encoder()
+        if config.worker == "process":
+            self.frame_encoder = ProcessFrameEncoder(config, self.mime_type, name=name)
+        else:
+            self.frame_encoder = FrameEncoder(config, self.mime_type)
+        # the estimate of the browser (REMB, set by aiortc through target_bitrate) and the cap of
+        # the AdaptationController level are kept apart, so neither overwrites the other
+        self.remb_bitrate = config.bitrate
+        self.bitrate_cap = None
+        self.force_keyframe = False
+
+        self.frames = 0
+        self.keyframes = 0
+        self.encode_time = 0
+
+    @property
+    def target_bitrate(self):
+        bitrate = self.remb_bitrate if self.bitrate_cap is None else min(self.remb_bitrate, self.bitrate_cap)
+        return max(self.config.min_bitrate, min(bitrate, self.config.max_bitrate))
+
+    @target_bitrate.setter
+    def target_bitrate(self, bitrate):
+        # set by aiortc on REMB
+        self.remb_bitrate = bitrate
+
+    def restart(self):
+        # for the sender of a new connection, its receiver can only start decoding at a keyframe
+        self.force_keyframe = True
+
+    def encode(self, frame, force_keyframe=False):
+        force_keyframe = force_keyframe or self.force_keyframe
+        self.force_keyframe = False
+        t0 = time.perf_counter()
+        packets = self.frame_encoder.encode(frame, force_keyframe, self.target_bitrate)
+        encode_time = time.perf_counter() - t0
+
+        self.frames += 1
+        self.keyframes += any(packet.is_keyframe for packet in packets)
+        self.encode_time += encode_time
+        if self.name is not None:
+            metrics.observe("encode_seconds", encode_time, track=self.name)
+
+        payloads = []
+        for packet in packets:
+            payloads += self.packetizer.pack(packet)[0]
+        return payloads, convert_timebase(frame.pts, frame.time_base, VIDEO_TIME_BASE)
+
+    def pack(self, packet):
+        return self.packetizer.pack(packet)
+
+    def close(self):
+        self.frame_encoder.close()
+
+    def stats(self):
+        return {
+            "codec": self.mime_type,
+            "bitrate": self.target_bitrate,
+            "frames": self.frames,
+            "keyframes": self.keyframes,
+            "encode_ms": self.encode_time / self.frames * 1000 if self.frames else None,
+        }
@@ -0,0 +1,137 @@
+import bisect
+import threading
+
+# Latency histograms, exposed in Prometheus text format on /metrics.
+# Observed from the event loop, capture threads and ROS callbacks, so guarded by a lock.
+
+BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5] # s
+FINE_BUCKETS = [0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05] # s, for control loop timing
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the quantile
+        if self.count == 0:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, self.buckets[-1]) # values over the last bucket are reported as the last bucket
+        return self.buckets[-1]
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {} # (name, labels) -> Histogram
+        self.values = {} # (name, labels) -> [type, value], for gauges and counters
+        self.help = {}
+        self.buckets = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets.get(name, BUCKETS))
+            histogram.observe(max(value, 0))
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = ["gauge", value]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = ["counter", 0]
+            self.values[key][1] += value
+
+    def describe(self, name, help, buckets=None):
+        self.help[name] = help
+        if buckets is not None:
+            self.buckets[name] = buckets
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted({ name for name, _ in self.histograms }):
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', bound), ))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+            for name in sorted({ name for name, _ in self.values }):
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                entries = [(labels, value) for (value_name, labels), value in sorted(self.values.items()) if value_name == name]
+                lines.append(f"# TYPE {name} {entries[0][1][0]}")
+                for labels, (_, value) in entries:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # {"name{labels}": (count, mean, p50, p95)} in ms, compact enough for the control channel
+        result = {}
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if histogram.count == 0:
+                    continue
+                result[name + format_labels(labels)] = (
+                    histogram.count,
+                    round(histogram.sum / histogram.count * 1000, 1),
+                    histogram.quantile(0.5) * 1000,
+                    histogram.quantile(0.95) * 1000,
+                )
+        return result
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+metrics = Metrics()
+metrics.describe("frame_age_seconds", "Capture to track recv (before encoding), per track")
+metrics.describe("client_detect_seconds", "Marker detection time in the browser")
+metrics.describe("client_capture_to_detect_seconds", "Frame grab to detection start in the browser")
+metrics.describe("hand_network_seconds", "Client detection end to server receive (assumes synced clocks)")
+metrics.describe("callback_seconds", "on_hand / on_pedal / on_control processing time, per channel")
+metrics.describe("dispatch_wait_seconds", "Time a message waited in the dispatch queue, per channel")
+metrics.describe("dispatch_queue_depth", "Messages waiting in the dispatch queue, per channel")
+metrics.describe("stale_dropped_total", "Messages dropped for arriving after a newer one, per channel")
+metrics.describe("dispatch_dropped_total", "Messages dropped or coalesced by the dispatch policy, per channel")
+metrics.describe("hand_to_command_seconds", "Client capture to goal published (assumes synced clocks)")
+metrics.describe("solve_seconds", "Marker pose solve time")
+metrics.describe("publish_seconds", "Time spent in publish callbacks")
+metrics.describe("client_rtt_seconds", "Round trip time reported by the browser")
+metrics.describe("control_loop_jitter_seconds", "Delay of control loop ticks past their deadline", buckets=FINE_BUCKETS)
+metrics.describe("control_loop_seconds", "Control loop tick duration", buckets=FINE_BUCKETS)
+metrics.describe("control_loop_overruns_total", "Control loop deadlines missed because a tick ran over")
+metrics.describe("capture_latency_seconds", "Camera capture (driver timestamp) to frame fed, per camera")
+metrics.describe("capture_fps", "Frames fed per second, per camera")
+metrics.describe("capture_dropped_total", "Frames skipped for being late out of the driver queue, per camera")
+metrics.describe("capture_reconnects_total", "Camera reopened after a failure or unplug, per camera")
+metrics.describe("encode_seconds", "Encode time per frame (including the worker round trip), per track")
+metrics.describe("stale_frames_total", "Frames dropped for being older than max_frame_age when the track got them, per track")
+metrics.describe("session_recover_seconds", "Connection lost to connected again on resume, reported by the browser", buckets=[0.1, 0.2, 0.5, 1, 2, 5, 10, 20])
+metrics.describe("feed_errors_total", "Frames a track, the mosaic or the observer fanout could not take, per track")
+metrics.describe("record_dropped_total", "Frames not recorded because the session log writer fell behind, per track")
+metrics.describe("telemetry_coalesced_total", "Status texts merged into a waiting one of the same text instead of sent on their own")
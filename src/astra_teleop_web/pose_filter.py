@@ -0,0 +1,230 @@
+import math
+import numpy as np
+
+# Pose filters / predictors for Teleopoperator.hand_cb.
+#
+# All arms are processed in one vectorized pass: poses are (n, 4, 4) transforms,
+# positions (n, 3) and quaternions (n, 4) in (w, x, y, z) order like pytransform3d.
+# `valid` is a (n,) bool mask of arms detected in this message, the others keep their state.
+#
+# Filters keep a velocity estimate, predict(t) extrapolates the filtered pose from the capture
+# timestamp of the last message to t + horizon: t is the time the command is published (the
+# control loop tick), horizon the delay until the robot acts on it. Extrapolation is capped at
+# max_prediction past the last measurement, so a lost marker does not drift off.
+MAX_PREDICTION = 0.2 # s
+
+def quaternions_from_matrices(R):
+    m00, m01, m02 = R[:, 0, 0], R[:, 0, 1], R[:, 0, 2]
+    m10, m11, m12 = R[:, 1, 0], R[:, 1, 1], R[:, 1, 2]
+    m20, m21, m22 = R[:, 2, 0], R[:, 2, 1], R[:, 2, 2]
+
+    # Shepperd's method, pick the numerically best of 4 candidates per row
+    t = np.stack([m00 + m11 + m22, m00 - m11 - m22, m11 - m00 - m22, m22 - m00 - m11], axis=1)
+    s = np.sqrt(np.maximum(1 + t, 1e-12)) * 2
+    candidates = np.stack([
+        np.stack([0.25 * s[:, 0], (m21 - m12) / s[:, 0], (m02 - m20) / s[:, 0], (m10 - m01) / s[:, 0]], axis=1),
+        np.stack([(m21 - m12) / s[:, 1], 0.25 * s[:, 1], (m01 + m10) / s[:, 1], (m02 + m20) / s[:, 1]], axis=1),
+        np.stack([(m02 - m20) / s[:, 2], (m01 + m10) / s[:, 2], 0.25 * s[:, 2], (m12 + m21) / s[:, 2]], axis=1),
+        np.stack([(m10 - m01) / s[:, 3], (m02 + m20) / s[:, 3], (m12 + m21) / s[:, 3], 0.25 * s[:, 3]], axis=1),
+    ], axis=1)
+    q = candidates[np.arange(len(R)), np.argmax(t, axis=1)]
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    return np.where(q[:, :1] < 0, -q, q)
+
+def matrices_from_quaternions(q):
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], axis=1),
+        np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], axis=1),
+        np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=1),
+    ], axis=1)
+
+def pq_from_transforms(T):
+    return T[:, :3, 3].copy(), quaternions_from_matrices(T[:, :3, :3])
+
+def transforms_from_pq(p, q):
+    T = np.tile(np.eye(4), (len(p), 1, 1))
+    T[:, :3, :3] = matrices_from_quaternions(q)
+    T[:, :3, 3] = p
+    return T
+
+def quaternion_multiply(a, b):
+    aw, ax, ay, az = a[:, 0], a[:, 1], a[:, 2], a[:, 3]
+    bw, bx, by, bz = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+    return np.stack([
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    ], axis=1)
+
+def quaternion_conjugate(q):
+    return q * np.array([1, -1, -1, -1])
+
+def rotvec_from_quaternions(q):
+    q = np.where(q[:, :1] < 0, -q, q) # shortest path
+    sin_half = np.linalg.norm(q[:, 1:], axis=1)
+    angle = 2 * np.arctan2(sin_half, q[:, 0])
+    scale = np.where(sin_half > 1e-9, angle / np.maximum(sin_half, 1e-9), 2.0)
+    return q[:, 1:] * scale[:, None]
+
+def quaternions_from_rotvec(v):
+    angle = np.linalg.norm(v, axis=1)
+    scale = np.where(angle > 1e-9, np.sin(angle / 2) / np.maximum(angle, 1e-9), 0.5)
+    return np.concatenate([np.cos(angle / 2)[:, None], v * scale[:, None]], axis=1)
+
+def rotation_difference(q1, q0):
+    # rotvec of q1 relative to q0, in the base frame
+    return rotvec_from_quaternions(quaternion_multiply(q1, quaternion_conjugate(q0)))
+
+def rotate(q, v):
+    # apply rotvec v (in the base frame) to q
+    return quaternion_multiply(quaternions_from_rotvec(v), q)
+
+def slerp(q0, q1, t):
+    # t: scalar or (n,), always along the shortest path
+    t = np.broadcast_to(np.asarray(t, dtype=float), (len(q0),))
+    return rotate(q0, rotation_difference(q1, q0) * t[:, None])
+
+class PoseFilter:
+    def __init__(self, horizon=0.0, max_prediction=MAX_PREDICTION):
+        self.horizon = horizon # s
+        self.max_prediction = max_prediction # s
+        self.p = None
+        self.q = None
+        self.v = None
+        self.w = None
+        self.t = None
+        self.initialized = None
+
+    def reset(self):
+        self.p = None
+
+    def __call__(self, T, valid, timestamp):
+        n = len(T)
+        if self.p is None:
+            self.p = np.zeros((n, 3))
+            self.q = np.tile([1.0, 0, 0, 0], (n, 1))
+            self.v = np.zeros((n, 3))
+            self.w = np.zeros((n, 3))
+            self.t = np.zeros(n)
+            self.initialized = np.zeros(n, dtype=bool)
+            self.init_state(n)
+
+        p, q = pq_from_transforms(T)
+        init = valid & ~self.initialized
+        update = valid & self.initialized
+        dt = np.maximum(timestamp - self.t, 1e-3)
+
+        self.p[init] = p[init]
+        self.q[init] = q[init]
+        self.v[init] = 0
+        self.w[init] = 0
+        if update.any():
+            self.update(p, q, update, dt)
+        self.t[valid] = timestamp
+        self.initialized |= valid
+
+        # filtered, at the capture time
+        T = T.copy()
+        T[valid] = transforms_from_pq(self.p[valid], self.q[valid])
+        return T
+
+    def predict(self, t):
+        # -> (n, 4, 4) poses at t + horizon, None before the first message;
+        # only rows of initialized arms are meaningful
+        if self.p is None:
+            return None
+        p, q = self.output(self.initialized, t + self.horizon)
+        return transforms_from_pq(p, q)
+
+    def init_state(self, n):
+        pass
+
+    def update(self, p, q, mask, dt):
+        raise NotImplementedError
+
+    def output(self, valid, t):
+        # extrapolated with the velocity estimate, from the last measurement to t
+        dt = np.clip(t - self.t, 0, self.max_prediction)[:, None]
+        return self.p + self.v * dt, rotate(self.q, self.w * dt)
+
+    @staticmethod
+    def clamp(v, limit):
+        norm = np.linalg.norm(v, axis=1, keepdims=True)
+        return v * np.minimum(1, limit / np.maximum(norm, 1e-9))
+
+# Fixed coefficient exponential smoothing, the original percise mode behaviour. The velocity
+# of the smoothed pose, smoothed the same way, is used for prediction.
+class LowPassPoseFilter(PoseFilter):
+    def __init__(self, p_low_pass_coff=0.1, q_low_pass_coff=0.1, horizon=0.0, max_prediction=MAX_PREDICTION, max_speed=2.0, max_angular_speed=2 * math.pi):
+        super().__init__(horizon, max_prediction)
+        self.p_low_pass_coff = p_low_pass_coff
+        self.q_low_pass_coff = q_low_pass_coff
+        self.max_speed = max_speed
+        self.max_angular_speed = max_angular_speed
+
+    def update(self, p, q, mask, dt):
+        dt = dt[mask][:, None]
+        p_last, q_last = self.p[mask], self.q[mask]
+        # trust for sensor read (in this case, opencv on web client)
+        self.p[mask] = self.p[mask] * (1 - self.p_low_pass_coff) + p[mask] * self.p_low_pass_coff
+        self.q[mask] = slerp(self.q[mask], q[mask], self.q_low_pass_coff)
+
+        v = self.clamp((self.p[mask] - p_last) / dt, self.max_speed)
+        self.v[mask] = self.v[mask] * (1 - self.p_low_pass_coff) + v * self.p_low_pass_coff
+        w = self.clamp(rotation_difference(self.q[mask], q_last) / dt, self.max_angular_speed)
+        self.w[mask] = self.w[mask] * (1 - self.q_low_pass_coff) + w * self.q_low_pass_coff
+
+# One Euro filter: smooth when still, little lag when moving fast
+# See: https://gery.casiez.net/1euro/
+class OneEuroPoseFilter(PoseFilter):
+    def __init__(self, min_cutoff=1.0, beta=5.0, d_cutoff=1.0, rot_min_cutoff=1.0, rot_beta=1.0, horizon=0.0, max_prediction=MAX_PREDICTION):
+        super().__init__(horizon, max_prediction)
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.rot_min_cutoff = rot_min_cutoff
+        self.rot_beta = rot_beta
+
+    @staticmethod
+    def alpha(cutoff, dt):
+        tau = 1 / (2 * math.pi * cutoff)
+        return 1 / (1 + tau / dt)
+
+    def update(self, p, q, mask, dt):
+        dt = dt[mask]
+        a_d = self.alpha(self.d_cutoff, dt)[:, None]
+
+        v = (p[mask] - self.p[mask]) / dt[:, None]
+        self.v[mask] = self.v[mask] + a_d * (v - self.v[mask])
+        a = self.alpha(self.min_cutoff + self.beta * np.linalg.norm(self.v[mask], axis=1), dt)
+        self.p[mask] = self.p[mask] + a[:, None] * (p[mask] - self.p[mask])
+
+        w = rotation_difference(q[mask], self.q[mask]) / dt[:, None]
+        self.w[mask] = self.w[mask] + a_d * (w - self.w[mask])
+        a = self.alpha(self.rot_min_cutoff + self.rot_beta * np.linalg.norm(self.w[mask], axis=1), dt)
+        self.q[mask] = slerp(self.q[mask], q[mask], a)
+
+# Constant velocity model with steady-state Kalman gains (alpha-beta filter), on position
+# and on rotation (as rotation vectors).
+class ConstantVelocityPoseFilter(PoseFilter):
+    def __init__(self, alpha=0.5, beta=0.1, horizon=0.05, max_prediction=MAX_PREDICTION, max_speed=2.0, max_angular_speed=2 * math.pi):
+        super().__init__(horizon, max_prediction)
+        self.alpha = alpha
+        self.beta = beta
+        self.max_speed = max_speed # clamp velocity estimates, outliers should not throw the arm
+        self.max_angular_speed = max_angular_speed
+
+    def update(self, p, q, mask, dt):
+        dt = dt[mask][:, None]
+
+        p_pred = self.p[mask] + self.v[mask] * dt
+        r = p[mask] - p_pred
+        self.p[mask] = p_pred + self.alpha * r
+        self.v[mask] = self.clamp(self.v[mask] + self.beta / dt * r, self.max_speed)
+
+        q_pred = rotate(self.q[mask], self.w[mask] * dt)
+        r = rotation_difference(q[mask], q_pred)
+        self.q[mask] = rotate(q_pred, self.alpha * r)
+        self.w[mask] = self.clamp(self.w[mask] + self.beta / dt * r, self.max_angular_speed)
@@ -0,0 +1,336 @@
+import asyncio
+import atexit
+import collections
+import json
+import mmap
+import queue
+import struct
+import threading
+import time
+import logging
+import numpy as np
+import av
+
+from astra_teleop_web import wire
+from astra_teleop_web.metrics import metrics
+from astra_teleop_web.shm import PIXEL_FORMATS, image_shape
+
+logger = logging.getLogger(__name__)
+
+# Append-only session log of datachannel messages and fed frames, for replaying runs
+# offline (filter tuning, regression runs, throughput measurements) without the robot.
+#
+# Layout, all little endian:
+#   file header: MAGIC (8 bytes)
+#   record * n:
+#     header: kind (u8), flags (u8), name (u16, index of NAMES), length (u32), timestamp_ns (u64)
+#     payload: length bytes, zero padded to 8 bytes so frames can be viewed with np.frombuffer
+#   frame payload: height (u32), width (u32), pixel_format (u8, index of PIXEL_FORMATS), padding (7 bytes), image
+#
+# Messages are timestamped when received, frames with their capture timestamp.
+# A record cut off by a crash is ignored when reading.
+MAGIC = b"ATWREC\x01\x00"
+RECORD_HEADER = struct.Struct("<BBHIQ")
+FRAME_HEADER = struct.Struct("<IIB7x")
+
+KIND_HAND = 1
+KIND_PEDAL = 2
+KIND_CONTROL = 3
+KIND_FRAME = 4
+KIND_PACKET = 5 # encoded packets of passthrough cameras
+KIND_NAMES = { KIND_HAND: "hand", KIND_PEDAL: "pedal", KIND_CONTROL: "control", KIND_FRAME: "frame", KIND_PACKET: "packet" }
+
+FLAG_BINARY = 1 # message sent as binary instead of text
+FLAG_KEYFRAME = 2
+
+NAMES = ["", "head", "wrist_left", "wrist_right"]
+
+RECORD_FRAME_INTERVAL = 0.2 # s, raw frames of every fed frame are ~60 MB/s with three 640x360 cameras at 30 fps
+RECORD_QUEUE_SIZE = 64 # frames waiting for the writer thread, more are dropped (messages never are)
+
+class SessionRecorder:
+    FLUSH_INTERVAL = 1 # s
+
+    def __init__(self, path, frame_interval=RECORD_FRAME_INTERVAL, queue_size=RECORD_QUEUE_SIZE):
+        self.f = open(path, "ab")
+        if self.f.tell() == 0:
+            self.f.write(MAGIC)
+        # s, minimum interval between recorded frames of a track, 0 records every frame
+        self.frame_interval = frame_interval
+        self.last_frame_time = {}
+        # the event loop and the capture threads only queue records, the file is written by a thread
+        self.queue = queue.Queue()
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, kind, flags, name, timestamp_ns, *chunks):
+        # chunks are written later, they must not change after this
+        if self.thread is None:
+            return
+        length = sum(len(chunk) for chunk in chunks)
+        self.queue.put((RECORD_HEADER.pack(kind, flags, NAMES.index(name), length, timestamp_ns), chunks, length))
+
+    def run(self):
+        last_flush_time = time.monotonic()
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            header, chunks, length = record
+            self.f.write(header)
+            for chunk in chunks:
+                self.f.write(chunk)
+            self.f.write(b"\0" * (-length % 8))
+
+            now = time.monotonic()
+            if now - last_flush_time > self.FLUSH_INTERVAL:
+                self.f.flush()
+                last_flush_time = now
+        self.f.close()
+
+    def record_message(self, kind, msg):
+        if wire.is_binary(msg):
+            self.write(kind, FLAG_BINARY, "", time.time_ns(), bytes(msg))
+        else:
+            self.write(kind, 0, "", time.time_ns(), msg.encode())
+
+    def record_frame(self, name, image_with_timestamp):
+        image, timestamp_sec, timestamp_nsec = image_with_timestamp[:3]
+        timestamp_ns = timestamp_sec * 1000000000 + timestamp_nsec
+
+        if self.frame_interval:
+            if timestamp_ns - self.last_frame_time.get(name, 0) < self.frame_interval * 1000000000:
+                return
+            self.last_frame_time[name] = timestamp_ns
+
+        if self.queue.qsize() >= self.queue_size:
+            # the disk does not keep up, frames are the ones to give
+            metrics.inc("record_dropped_total", track=name)
+            return
+
+        if not isinstance(image, np.ndarray):
+            # av.Packet
+            self.write(KIND_PACKET, FLAG_KEYFRAME if image.is_keyframe else 0, name, timestamp_ns, bytes(image))
+            return
+
+        pixel_format = image_with_timestamp[3] if len(image_with_timestamp) > 3 else "rgb24"
+        height = image.shape[0] if pixel_format in ["rgb24", "bgr24"] else image.shape[0] * 2 // 3
+        self.write(
+            KIND_FRAME, 0, name, timestamp_ns,
+            FRAME_HEADER.pack(height, image.shape[1], PIXEL_FORMATS.index(pixel_format)),
+            np.ascontiguousarray(image, dtype=np.uint8).tobytes(), # copied, the caller reuses the buffer
+        )
+
+    def close(self):
+        # writes what is queued
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+class SessionLog:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a session log")
+
+    def __iter__(self):
+        # yields (kind, name, timestamp_ns, payload), payload is bytes / str for messages,
+        # (image, pixel_format) for frames with image viewing the log, bytes for packets
+        buf = memoryview(self.mm)
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= len(buf):
+            kind, flags, name, length, timestamp_ns = RECORD_HEADER.unpack_from(buf, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > len(buf):
+                logger.warning("Session log is truncated")
+                break
+
+            payload = buf[offset:offset + length]
+            if kind == KIND_FRAME:
+                height, width, pixel_format = FRAME_HEADER.unpack_from(payload, 0)
+                pixel_format = PIXEL_FORMATS[pixel_format]
+                image = np.frombuffer(payload, dtype=np.uint8, offset=FRAME_HEADER.size).reshape(image_shape(pixel_format, height, width))
+                payload = (image, pixel_format)
+            elif kind == KIND_PACKET or flags & FLAG_BINARY:
+                payload = bytes(payload)
+            else:
+                payload = str(payload, "utf-8")
+            yield kind, NAMES[name], timestamp_ns, payload
+
+            offset += length + (-length % 8)
+
+# Stands in for WebServer when replaying, nothing is served
+class ReplayWebServer:
+    def __init__(self):
+        self.loop = None
+        self.on_hand = None
+        self.on_pedal = None
+        self.on_control = None
+        self.log = []
+        self.state = {}
+        self.frames_fed = collections.Counter()
+
+    def control_datachannel_log(self, message):
+        self.log.append(message)
+
+    def publish_state(self, **values):
+        self.state.update(values)
+
+    def track_feed(self, name, image_with_timestamp, pixel_format=None):
+        self.frames_fed[name] += 1
+
+# Stub robot sinks for Teleopoperator, commands are collected instead of published.
+# The end effectors are assumed to reach every goal at once, so resets finish immediately.
+class StubRobot:
+    def __init__(self):
+        self.goals = []
+        self.grippers = []
+        self.heads = []
+        self.cmd_vels = []
+        self.pose = { "left": np.eye(4), "right": np.eye(4) }
+
+    def attach(self, teleoperator):
+        teleoperator.on_pub_goal = self.pub_goal
+        teleoperator.on_pub_gripper = self.pub_gripper
+        teleoperator.on_pub_head = self.pub_head
+        teleoperator.on_cmd_vel = self.cmd_vel
+        teleoperator.on_get_current_eef_pose = lambda side: self.pose[side]
+        teleoperator.on_get_initial_eef_pose = lambda side, joints: self.pose[side]
+        teleoperator.on_reset = lambda: None
+        teleoperator.on_done = lambda: None
+
+    def pub_goal(self, side, Tsgoal, **kwargs):
+        self.goals.append((side, Tsgoal))
+        self.pose[side] = Tsgoal
+
+    def pub_gripper(self, side, pos):
+        self.grippers.append((side, pos))
+
+    def pub_head(self, pan, tilt):
+        self.heads.append((pan, tilt))
+
+    def cmd_vel(self, linear_vel, angular_vel):
+        self.cmd_vels.append((linear_vel, angular_vel))
+
+async def run_control(teleoperator, control_type, previous):
+    if previous is not None:
+        await asyncio.wait([previous])
+    await teleoperator.control_cb(control_type)
+
+def cancel_controls(tasks):
+    # -> whether a command was cancelled
+    cancelled = False
+    for task in tasks:
+        if not task.done():
+            cancelled = task.cancel() or cancelled
+    return cancelled
+
+async def replay(path, teleoperator, speed=1.0, drain_timeout=1):
+    # Pushes a session log through the Teleopoperator callbacks, at `speed` times real time
+    # or as fast as possible with speed=None. The teleoperator clock is the recorded receive time
+    # and hand messages use the recorded capture time, as the webserver does, so filtered and
+    # predicted poses are the same on every run (with a Teleopoperator(control_rate=None),
+    # publishing on messages instead of a timer).
+    stats = collections.Counter()
+    seq_filter = { KIND_HAND: wire.SequenceFilter(), KIND_PEDAL: wire.SequenceFilter() }
+    calibrations = wire.CalibrationCache()
+    tasks = []
+    start_timestamp_ns = None
+    t0 = time.perf_counter()
+    busy = 0
+
+    now = None
+    teleoperator.clock = lambda: now
+
+    for kind, name, timestamp_ns, payload in SessionLog(path):
+        now = timestamp_ns / 1000000000
+        if speed is not None:
+            if start_timestamp_ns is None:
+                start_timestamp_ns = timestamp_ns
+            delay = (timestamp_ns - start_timestamp_ns) / 1000000000 / speed - (time.perf_counter() - t0)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0) # let running control commands make progress
+
+        t1 = time.perf_counter()
+        try:
+            if kind == KIND_HAND:
+                camera_matrix, distortion_coefficients, corners, ids, timestamps, seq = wire.parse_hand(payload, calibrations)
+                if not seq_filter[kind].accept(seq):
+                    stats["stale"] += 1
+                    continue
+                timestamp = now
+                if timestamps is not None and timestamps[0] > 0:
+                    # recorded on the wall clock, a client clock ahead of ours counts as captured on receive
+                    timestamp = min(timestamps[0] / 1000, now)
+                teleoperator.hand_cb(camera_matrix, distortion_coefficients, corners, ids, timestamp=timestamp)
+            elif kind == KIND_PEDAL:
+                pedal_real_values, seq = wire.parse_pedal(payload)
+                if not seq_filter[kind].accept(seq):
+                    stats["stale"] += 1
+                    continue
+                teleoperator.pedal_cb(pedal_real_values)
+            elif kind == KIND_CONTROL:
+                control_type = json.loads(payload)
+                if isinstance(control_type, dict) and control_type.get("type") == "stats":
+                    continue
+                if isinstance(control_type, dict) and control_type.get("type") == "calibration":
+                    calibrations.register(control_type["camera_matrix"], control_type["distortion_coefficients"])
+                    continue
+                if control_type == "cancel":
+                    # like the control dispatcher of the webserver: drops the queued commands, cancels the running one
+                    if cancel_controls(tasks):
+                        teleoperator.webserver.control_datachannel_log("Cancelled")
+                    stats["cancelled"] += 1
+                    continue
+                # one after another, like the control dispatcher of the webserver
+                tasks.append(asyncio.create_task(run_control(teleoperator, control_type, tasks[-1] if tasks else None)))
+            elif kind == KIND_FRAME:
+                image, pixel_format = payload
+                teleoperator.webserver.track_feed(name, (image, timestamp_ns // 1000000000, timestamp_ns % 1000000000), pixel_format=pixel_format)
+            elif kind == KIND_PACKET:
+                teleoperator.webserver.track_feed(name, (av.Packet(payload), timestamp_ns // 1000000000, timestamp_ns % 1000000000))
+        except Exception as e:
+            # same as the webserver, a failing callback does not stop the session
+            logger.warning(f"{KIND_NAMES.get(kind)} callback failed: {e}")
+            stats["errors"] += 1
+        busy += time.perf_counter() - t1
+        stats[KIND_NAMES.get(kind, "unknown")] += 1
+
+    if tasks:
+        done, pending = await asyncio.wait(tasks, timeout=drain_timeout)
+        for task in pending:
+            task.cancel()
+        stats["errors"] += sum(1 for task in done if not task.cancelled() and task.exception() is not None)
+
+    wall_time = time.perf_counter() - t0
+    return {
+        **stats,
+        "wall_time": wall_time,
+        "busy_time": busy, # spent in callbacks
+        "messages_per_second": (stats["hand"] + stats["pedal"] + stats["control"]) / max(busy, 1e-9),
+    }
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay a session log through Teleopoperator with stub robot sinks")
+    parser.add_argument("path")
+    parser.add_argument("--speed", type=float, default=1.0, help="times real time, 0 for as fast as possible")
+    args = parser.parse_args()
+
+    from astra_teleop_web.teleoprator import Teleopoperator
+
+    teleoperator = Teleopoperator(webserver=ReplayWebServer(), control_rate=None)
+    robot = StubRobot()
+    robot.attach(teleoperator)
+
+    print(asyncio.run(replay(args.path, teleoperator, speed=args.speed or None)))
+    print(f"goals: {len(robot.goals)}, grippers: {len(robot.grippers)}, cmd_vels: {len(robot.cmd_vels)}")
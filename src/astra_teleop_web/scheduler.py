@@ -0,0 +1,62 @@
+import threading
+import time
+import logging
+
+from astra_teleop_web.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Calls tick(dt) at a fixed rate on a dedicated thread, with dt the measured time since
+# the last tick. Deadlines are absolute, so jitter does not accumulate. A tick that runs
+# over skips the missed deadlines instead of bursting to catch up.
+class FixedRateScheduler:
+    def __init__(self, rate, tick, name="control"):
+        self.rate = rate
+        self.tick = tick
+        self.name = name
+        self.running = False
+        self.thread = None
+        self.ticks = 0
+        self.overruns = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=f"scheduler_{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        period = 1 / self.rate
+        next_time = time.monotonic()
+        last_time = None
+        while self.running:
+            now = time.monotonic()
+            if next_time > now:
+                time.sleep(next_time - now)
+                now = time.monotonic()
+            metrics.observe("control_loop_jitter_seconds", now - next_time, loop=self.name)
+
+            dt = period if last_time is None else now - last_time
+            last_time = now
+            try:
+                self.tick(dt)
+            except Exception as e:
+                logger.warning(f"{self.name} tick failed: {e}")
+            self.ticks += 1
+
+            end = time.monotonic()
+            metrics.observe("control_loop_seconds", end - now, loop=self.name)
+            next_time += period
+            if end > next_time:
+                missed = int((end - next_time) / period) + 1
+                next_time += missed * period
+                self.overruns += missed
+                metrics.inc("control_loop_overruns_total", missed, loop=self.name)
+
+    def stats(self):
+        return {
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+        }
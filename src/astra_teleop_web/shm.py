@@ -0,0 +1,143 @@
+import os
+import struct
+import time
+from multiprocessing import shared_memory, resource_tracker
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Pixel formats accepted by the tracks, libav converts them to yuv420p for encoding at most once
+PIXEL_FORMATS = ["rgb24", "bgr24", "yuv420p", "nv12"]
+
+def image_shape(pixel_format, height, width):
+    if pixel_format in ["rgb24", "bgr24"]:
+        return (height, width, 3)
+    elif pixel_format in ["yuv420p", "nv12"]:
+        return (height * 3 // 2, width) # planar, chroma planes stacked under luma
+    else:
+        raise ValueError(f"Unsupported pixel format {pixel_format}")
+
+# Ring buffer of frames in shared memory, written by one producer process (a capture
+# process, or an external ROS node) and read zero-copy by the webserver.
+#
+# Layout:
+#   header: latest_seq (u64), n_slots (u32), height (u32), width (u32), pixel_format (u32, index of PIXEL_FORMATS),
+#           generation (u64, random, new for every segment created under the name)
+#   slot * n_slots: seq (u64), timestamp_ns (u64), image (u8, see image_shape)
+#
+# Writer clears slot seq, writes image and timestamp, sets slot seq, then publishes
+# latest_seq. Reader checks slot seq again after copying out the image to detect
+# frames overwritten while being read (the ring is lapped).
+# A restarted producer unlinks the segment and creates a new one, a reader still mapping
+# the old one sees no new frames, and finds the new one by its generation (see replaced).
+HEADER = struct.Struct("<QIIIIQ")
+SLOT_HEADER = struct.Struct("<QQ")
+
+class SharedFrameRing:
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        _, self.n_slots, self.height, self.width, pixel_format, self.generation = HEADER.unpack_from(shm.buf, 0)
+        self.pixel_format = PIXEL_FORMATS[pixel_format]
+        self.shape = image_shape(self.pixel_format, self.height, self.width)
+        self.image_size = int(np.prod(self.shape))
+        self.slot_size = SLOT_HEADER.size + self.image_size
+        self.seq = 0
+
+    @classmethod
+    def create(cls, name, height, width, pixel_format="rgb24", n_slots=4):
+        size = HEADER.size + n_slots * (SLOT_HEADER.size + int(np.prod(image_shape(pixel_format, height, width))))
+        try:
+            # stale segment from a crashed producer
+            old = shared_memory.SharedMemory(name=name)
+            old.close()
+            old.unlink()
+        except FileNotFoundError:
+            pass
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        generation = int.from_bytes(os.urandom(8), "little")
+        HEADER.pack_into(shm.buf, 0, 0, n_slots, height, width, PIXEL_FORMATS.index(pixel_format), generation)
+        return cls(shm, owner=True)
+
+    @staticmethod
+    def open(name):
+        shm = shared_memory.SharedMemory(name=name)
+        # Python < 3.13 would unlink the segment when the reader exits
+        # See: https://github.com/python/cpython/issues/82300
+        try:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        return shm
+
+    @classmethod
+    def attach(cls, name):
+        return cls(cls.open(name), owner=False)
+
+    def replaced(self):
+        # True if the segment under the name is no longer this one (the producer restarted),
+        # FileNotFoundError while there is none
+        shm = self.open(self.shm.name)
+        try:
+            return HEADER.unpack_from(shm.buf, 0)[5] != self.generation
+        finally:
+            shm.close()
+
+    def slot_offset(self, seq):
+        return HEADER.size + (seq % self.n_slots) * self.slot_size
+
+    def write(self, image, timestamp_ns=None):
+        assert image.shape == self.shape and image.dtype == np.uint8
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+        self.seq += 1
+        offset = self.slot_offset(self.seq)
+        SLOT_HEADER.pack_into(self.shm.buf, offset, 0, 0)
+        self.image(offset)[...] = image
+        SLOT_HEADER.pack_into(self.shm.buf, offset, self.seq, timestamp_ns)
+        struct.pack_into("<Q", self.shm.buf, 0, self.seq)
+
+    def latest_seq(self):
+        return struct.unpack_from("<Q", self.shm.buf, 0)[0]
+
+    def image(self, offset):
+        return np.ndarray(
+            self.shape, dtype=np.uint8,
+            buffer=self.shm.buf, offset=offset + SLOT_HEADER.size,
+        )
+
+    def view(self, seq):
+        # Returns (image, timestamp_ns) without copying, or None if the slot is already reused
+        offset = self.slot_offset(seq)
+        slot_seq, timestamp_ns = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+        if slot_seq != seq:
+            return None
+        return self.image(offset), timestamp_ns
+
+    def valid(self, seq):
+        return SLOT_HEADER.unpack_from(self.shm.buf, self.slot_offset(seq))[0] == seq
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def feed_shared_memory(name, device, image_height=360, image_width=640, frames_per_second=30):
+    # Capture process entry, run with multiprocessing.Process so decode / convert work
+    # does not share the GIL with the webserver
+    from astra_teleop_web.capture import Camera, CameraConfig
+
+    ring = SharedFrameRing.create(name, image_height, image_width, pixel_format="bgr24")
+    config = CameraConfig(device, width=image_width, height=image_height, fps=frames_per_second)
+
+    def sink(image, timestamp_ns, pixel_format):
+        if image.shape != ring.shape:
+            logger.warning(f"Unexpected frame shape {image.shape} from {device}")
+            return
+        ring.write(image, timestamp_ns) # encoder converts bgr24 to yuv420p, no extra cvtColor
+
+    try:
+        Camera(config, sink).run()
+    finally:
+        ring.close()
@@ -0,0 +1,272 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import aiohttp
+import aiortc
+import numpy as np
+
+from astra_teleop_web.encoding import EncoderConfig
+from astra_teleop_web.webserver import MosaicLayout, WebServer
+
+# Headless streaming benchmark: WebServer is fed synthetic frames on all tracks and an
+# aiortc peer in this process connects through /offer like the browser does.
+#
+# The capture time (ms) is stamped into every frame as a row of black / white blocks,
+# which survive encoding, so the receiver can measure frame age after decoding
+# (RTP timestamps start at a random offset and can not be used for that).
+#
+#   python src/astra_teleop_web/static/bench_stream.py --width 1280 --height 720 --output bench.json
+
+TRACKS = ["head", "wrist_left", "wrist_right"] # mid: 0, 1, 2
+STAMP_BITS = 32
+
+def stamp(image, value):
+    block = image.shape[1] // STAMP_BITS
+    for i in range(STAMP_BITS):
+        image[:block, i * block:(i + 1) * block] = 255 if value >> (STAMP_BITS - 1 - i) & 1 else 0
+
+def read_stamp(luma):
+    block = luma.shape[1] // STAMP_BITS
+    bits = luma[block // 2, block // 2::block][:STAMP_BITS] > 128
+    value = 0
+    for bit in bits:
+        value = value << 1 | int(bit)
+    return value
+
+def synthetic_frames(height, width, n=30):
+    # moving gradient with some noise, so the encoder has something to do
+    y, x = np.mgrid[0:height, 0:width]
+    frames = []
+    for i in range(n):
+        image = np.empty((height, width, 3), dtype=np.uint8)
+        image[..., 0] = (x + i * 8) % 256
+        image[..., 1] = (y + i * 4) % 256
+        image[..., 2] = np.random.randint(0, 64, (height, width), dtype=np.uint8)
+        frames.append(image)
+    return frames
+
+def feed(webserver, name, frames, fps, stop):
+    period = 1 / fps
+    next_time = time.monotonic()
+    index = 0
+    while not stop.is_set():
+        image = frames[index % len(frames)].copy()
+        index += 1
+        t = time.time_ns()
+        stamp(image, t // 1000000 % (1 << STAMP_BITS))
+        webserver.track_feed(name, (image, int(t / 1000000000), int(t % 1000000000)), pixel_format="bgr24")
+
+        next_time += period
+        time.sleep(max(0, next_time - time.monotonic()))
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.array(values)
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(values.max()),
+    }
+
+async def measure_loop_lag(lags, interval=0.01):
+    # runs on the webserver event loop
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - t0 - interval) * 1000)
+
+def wrap_encoder(sender, cpu):
+    # thread CPU time spent encoding, per track
+    encoder = sender._RTCRtpSender__encoder
+    encode = encoder.encode
+    def timed_encode(*args, **kwargs):
+        t0 = time.thread_time()
+        try:
+            return encode(*args, **kwargs)
+        finally:
+            cpu[0] += time.thread_time() - t0
+    encoder.encode = timed_encode
+
+def worker_cpu_time(sender):
+    # CPU time (s) of the encoder process of a --worker process track, None for thread workers.
+    # From /proc (Linux): the process is still running, RUSAGE_CHILDREN only counts waited for ones
+    process = getattr(getattr(sender._RTCRtpSender__encoder, "frame_encoder", None), "process", None)
+    if process is None:
+        return None
+    with open(f"/proc/{process.pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split() # from the state on, the name may contain spaces
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK") # utime + stime
+
+async def run(args, cert_dir):
+    layout = MosaicLayout.stacked(args.width, args.height) if args.mosaic else None
+    webserver = WebServer(adaptive=args.adaptive, encoder=EncoderConfig(codec=args.codec, preset=args.preset, worker=args.worker, threads=args.threads), mosaic=layout, cert_dir=cert_dir)
+
+    pc = aiortc.RTCPeerConnection()
+    received = { name: [] for name in TRACKS } # (receive time, age ms)
+    unreadable = { name: 0 for name in TRACKS }
+    skews = [] # ms, oldest to newest tile of a mosaic frame
+    measuring = asyncio.Event()
+
+    def read_age(name, luma, now_ms):
+        age = (now_ms - read_stamp(luma)) % (1 << STAMP_BITS)
+        if age > 10000:
+            unreadable[name] += 1
+            return None
+        received[name].append((time.monotonic(), age))
+        return age
+
+    async def read(name, track):
+        while True:
+            try:
+                frame = await track.recv()
+            except aiortc.mediastreams.MediaStreamError:
+                return # closed
+            now_ms = time.time_ns() // 1000000
+            if not measuring.is_set():
+                continue
+            luma = frame.to_ndarray(format="yuv420p")[:frame.height]
+            if layout is None:
+                read_age(name, luma, now_ms)
+                continue
+            ages = []
+            for tile_name, (x, y, width, height) in layout.tiles.items():
+                age = read_age(tile_name, luma[y:y + height, x:x + width], now_ms)
+                if age is not None:
+                    ages.append(age)
+            if len(ages) > 1:
+                skews.append(max(ages) - min(ages))
+
+    for name in TRACKS:
+        pc.addTransceiver("video", direction="recvonly")
+    pc.createDataChannel("control")
+    await pc.setLocalDescription(await pc.createOffer())
+
+    async with aiohttp.ClientSession() as session:
+        for retry in range(50):
+            try:
+                async with session.post("https://localhost:9443/offer", json={
+                    "sdp": pc.localDescription.sdp, "type": pc.localDescription.type,
+                }, ssl=False) as response: # self signed
+                    answer = await response.json()
+                break
+            except aiohttp.ClientConnectorError:
+                await asyncio.sleep(0.2) # server not up yet
+    await pc.setRemoteDescription(aiortc.RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+
+    for transceiver in pc.getTransceivers():
+        if transceiver.kind == "video" and (layout is None or transceiver.mid == "0"):
+            asyncio.create_task(read(TRACKS[int(transceiver.mid)], transceiver.receiver.track))
+
+    stop = threading.Event()
+    frames = synthetic_frames(args.height, args.width)
+    for name in TRACKS:
+        threading.Thread(target=feed, args=(webserver, name, frames, args.fps, stop), daemon=True).start()
+
+    while pc.connectionState != "connected":
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(args.warmup)
+
+    server_pc = webserver.pc["head"]
+    server_tracks = { **webserver.track, "mosaic": webserver.mosaic_track }
+    encode_cpu = { name: [0.0] for name in server_tracks }
+    senders = {}
+    for sender in server_pc.getSenders():
+        for name, track in server_tracks.items():
+            if track is not None and sender.track is track and sender._RTCRtpSender__encoder is not None:
+                wrap_encoder(sender, encode_cpu[name])
+                senders[name] = sender
+
+    lags = []
+    lag_task = asyncio.run_coroutine_threadsafe(measure_loop_lag(lags), webserver.loop)
+    stats_before = webserver.track_stats()
+    cpu_before = time.process_time()
+    worker_cpu_before = { name: worker_cpu_time(sender) for name, sender in senders.items() }
+    t0 = time.monotonic()
+    measuring.set()
+
+    await asyncio.sleep(args.duration)
+
+    measuring.clear()
+    elapsed = time.monotonic() - t0
+    cpu = time.process_time() - cpu_before
+    worker_cpu = 0
+    for name, sender in senders.items():
+        if worker_cpu_before[name] is not None:
+            # sending the frame and waiting for it is timed here, encoding in the worker
+            track_worker_cpu = worker_cpu_time(sender) - worker_cpu_before[name]
+            encode_cpu[name][0] += track_worker_cpu
+            worker_cpu += track_worker_cpu
+    stats_after = webserver.track_stats()
+    encoder_stats = webserver.encoder_stats()
+    lag_task.cancel()
+    stop.set()
+
+    result = {
+        "config": vars(args),
+        "revision": subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None,
+        "process_cpu": cpu / elapsed, # cores
+        "worker_cpu": worker_cpu / elapsed, # cores, encoder processes with --worker process
+        "event_loop_lag_ms": percentiles(lags),
+        "tracks": {},
+    }
+    def delta(name, key):
+        if name not in stats_after:
+            return None
+        return stats_after[name][key] - stats_before[name][key]
+
+    for name in TRACKS:
+        fed = delta(name, "frames_fed")
+        result["tracks"][name] = {
+            "frames_fed": fed,
+            "frames_sent": delta(name, "frames_sent"),
+            "frames_received": len(received[name]),
+            "frames_unreadable": unreadable[name],
+            "fps": len(received[name]) / elapsed,
+            "drop_rate": 1 - len(received[name]) / fed if fed else None,
+            "frame_age_ms": percentiles([age for _, age in received[name]]),
+            "encode_cpu": encode_cpu[name][0] / elapsed, # cores
+            "encoder": encoder_stats.get(name),
+        }
+    if layout is not None:
+        result["mosaic"] = {
+            "frames_fed": delta("mosaic", "frames_fed"), # tiles, of all cameras
+            "frames_sent": delta("mosaic", "frames_sent"),
+            "tile_skew_ms": percentiles(skews),
+            "encode_cpu": encode_cpu["mosaic"][0] / elapsed, # cores
+            "encoder": encoder_stats.get("mosaic"),
+        }
+
+    await pc.close()
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless streaming benchmark of WebServer")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--duration", type=float, default=10, help="s")
+    parser.add_argument("--warmup", type=float, default=2, help="s")
+    # off by default: client and server share the CPU here, which shows up as RTT and makes runs less comparable
+    parser.add_argument("--adaptive", action="store_true", help="enable bitrate / resolution adaptation")
+    parser.add_argument("--codec", choices=["video/H264", "video/VP8"])
+    parser.add_argument("--preset", default="ultrafast", help="x264 preset")
+    parser.add_argument("--worker", choices=["thread", "process"], default="thread")
+    parser.add_argument("--threads", type=int, default=0, help="encoder threads per track, 0 for by frame size")
+    parser.add_argument("--mosaic", action="store_true", help="tile the cameras into one track")
+    parser.add_argument("--output", help="save results as JSON")
+    args = parser.parse_args()
+
+    # the self signed certificate of the server is thrown away with the run
+    with tempfile.TemporaryDirectory() as cert_dir:
+        result = asyncio.run(run(args, cert_dir))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
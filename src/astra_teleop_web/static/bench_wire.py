@@ -0,0 +1,41 @@
+import json
+import time
+import numpy as np
+
+from astra_teleop_web import wire
+
+camera_matrix = [[915.2, 0.0, 640.3], [0.0, 914.8, 360.1], [0.0, 0.0, 1.0]]
+distortion_coefficients = [[0.11, -0.23, 0.001, -0.002, 0.09]]
+corners = (np.random.rand(8, 1, 4, 2) * 1280).astype(np.float32) # 8 markers, as many as both hands show
+ids = np.arange(8, dtype=np.int32).reshape(8, 1)
+pedal_values = [0.1, 0.2, 0.3, 0.4]
+
+json_hand = json.dumps([camera_matrix, distortion_coefficients, corners.tolist(), ids.tolist()])
+binary_hand = wire.encode_hand(camera_matrix, distortion_coefficients, corners, ids)
+calibrations = wire.CalibrationCache()
+calibrated_hand = wire.encode_hand_calibrated(calibrations.register(camera_matrix, distortion_coefficients), corners, ids)
+json_pedal = json.dumps(pedal_values)
+binary_pedal = wire.encode_pedal(pedal_values)
+
+def bench(name, f, iterations=10000):
+    t0 = time.perf_counter()
+    for i in range(iterations):
+        f()
+    t1 = time.perf_counter()
+    print(f"{name}: {(t1 - t0) / iterations * 1000000:.2f} us")
+
+print(f"hand size: json {len(json_hand)} bytes, binary {len(binary_hand)} bytes, calibrated {len(calibrated_hand)} bytes")
+print(f"pedal size: json {len(json_pedal)} bytes, binary {len(binary_pedal)} bytes")
+
+# decoding including conversion to arrays, which solve does for json anyway
+def decode_json_hand():
+    m, d, c, i = json.loads(json_hand)
+    return np.array(m), np.array(d), np.array(c, dtype=np.float32), np.array(i)
+
+bench("hand json decode", decode_json_hand)
+bench("hand binary decode", lambda: wire.decode_hand(binary_hand))
+# as the webserver parses them, to float64 intrinsics for the solver
+bench("hand binary parse", lambda: wire.parse_hand(binary_hand, calibrations))
+bench("hand calibrated parse", lambda: wire.parse_hand(calibrated_hand, calibrations))
+bench("pedal json decode", lambda: np.array(json.loads(json_pedal)))
+bench("pedal binary decode", lambda: wire.decode_pedal(binary_pedal))
@@ -0,0 +1,189 @@
+// ArUco detection off the main thread, used by capture() in index.js.
+//
+// Frames come in as transferred ImageBitmaps, so the page grabs the next frame while this
+// one is detected. Markers are searched at full resolution in regions around the markers of
+// the previous frame, one per marker (or group of nearby markers), so markers far apart do not
+// make one region as big as the frame. When the regions would cover more than ROI_MAX_AREA of
+// the frame, the downscaled search below is cheaper and used instead. Without previous markers, when some of them are lost, and every
+// FULL_SEARCH_INTERVAL frames (for markers that came into view elsewhere), the whole frame
+// is also searched at FULL_SEARCH_SCALE, which is fast but has imprecise corners: it only
+// tells where the markers missing from the region are, they are detected again at full
+// resolution around there before being sent (see bench_resize.html for the cost of
+// downscaling with cv2.resize, here the canvas scales while drawing).
+importScripts("opencv_simd.js");
+
+const ROI_MARGIN = 0.5; // of the size of the region around a previous marker, on each side
+const ROI_MIN_MARGIN = 32; // px
+const ROI_MAX_AREA = 0.5; // of the frame, about the cost of the full search and the refinement after it
+const FULL_SEARCH_SCALE = 0.5;
+const FULL_SEARCH_INTERVAL = 30; // frames
+
+let cv2 = null;
+let detector = null;
+let canvas = null;
+let ctx = null;
+let previous = null; // { corners, ids } of the last frame with markers, in frame coordinates
+let framesSinceFullSearch = 0;
+
+const ready = (async function () {
+  cv2 = await cv;
+  const aruco_dict = cv2.getPredefinedDictionary(cv2.DICT_4X4_50);
+  const aruco_detection_parameters = new cv2.aruco_DetectorParameters();
+  aruco_detection_parameters.cornerRefinementMethod = cv2.CORNER_REFINE_SUBPIX; // Faster
+  const refine_parameters = new cv2.aruco_RefineParameters(10, 3, true);
+  detector = new cv2.aruco_ArucoDetector(aruco_dict, aruco_detection_parameters, refine_parameters);
+})();
+
+// Detects markers in the region (x, y, width, height) of the frame drawn at scale,
+// returns { corners: Float32Array (n * 4 * 2), ids: Int32Array (n) } in frame coordinates
+function detectRegion(frame, x, y, width, height, scale) {
+  const w = Math.round(width * scale);
+  const h = Math.round(height * scale);
+  if (canvas === null || canvas.width < w || canvas.height < h) {
+    canvas = new OffscreenCanvas(frame.width, frame.height);
+    ctx = canvas.getContext("2d", { willReadFrequently: true });
+  }
+  ctx.drawImage(frame, x, y, width, height, 0, 0, w, h);
+  const imageData = ctx.getImageData(0, 0, w, h);
+
+  const mat = cv2.matFromImageData(imageData);
+  const gray = new cv2.Mat();
+  cv2.cvtColor(mat, gray, cv2.COLOR_RGBA2GRAY);
+  const corners = new cv2.MatVector();
+  const ids = new cv2.Mat();
+  const rejected = new cv2.MatVector();
+  detector.detectMarkers(gray, corners, ids, rejected);
+
+  const n = ids.rows;
+  const result = { corners: new Float32Array(n * 4 * 2), ids: new Int32Array(ids.data32S.subarray(0, n)) };
+  for (let i = 0; i < n; ++i) {
+    const points = corners.get(i).data32F;
+    for (let j = 0; j < 4; ++j) {
+      result.corners[(i * 4 + j) * 2] = x + points[j * 2] / scale;
+      result.corners[(i * 4 + j) * 2 + 1] = y + points[j * 2 + 1] / scale;
+    }
+  }
+
+  mat.delete();
+  gray.delete();
+  corners.delete();
+  ids.delete();
+  rejected.delete();
+  return result;
+}
+
+function regionAround(corners, frameWidth, frameHeight) {
+  let minX = Infinity, minY = Infinity, maxX = -Infinity, maxY = -Infinity;
+  for (let i = 0; i < corners.length; i += 2) {
+    minX = Math.min(minX, corners[i]);
+    maxX = Math.max(maxX, corners[i]);
+    minY = Math.min(minY, corners[i + 1]);
+    maxY = Math.max(maxY, corners[i + 1]);
+  }
+  const marginX = Math.max((maxX - minX) * ROI_MARGIN, ROI_MIN_MARGIN);
+  const marginY = Math.max((maxY - minY) * ROI_MARGIN, ROI_MIN_MARGIN);
+  const x = Math.max(0, Math.floor(minX - marginX));
+  const y = Math.max(0, Math.floor(minY - marginY));
+  return [x, y, Math.min(frameWidth, Math.ceil(maxX + marginX)) - x, Math.min(frameHeight, Math.ceil(maxY + marginY)) - y];
+}
+
+function overlaps(a, b) {
+  return a[0] < b[0] + b[2] && b[0] < a[0] + a[2] && a[1] < b[1] + b[3] && b[1] < a[1] + a[3];
+}
+
+// Regions around each of the markers, overlapping ones joined (a marker across both is seen
+// whole), or null when they cover too much of the frame
+function regionsAround(markers, frameWidth, frameHeight) {
+  const regions = [];
+  for (let i = 0; i < markers.ids.length; ++i) {
+    regions.push(regionAround(markers.corners.subarray(i * 8, i * 8 + 8), frameWidth, frameHeight));
+  }
+  for (let joined = true; joined;) {
+    joined = false;
+    for (let i = 0; i < regions.length && !joined; ++i) {
+      for (let j = i + 1; j < regions.length; ++j) {
+        if (overlaps(regions[i], regions[j])) {
+          const [a, b] = [regions[i], regions[j]];
+          const x = Math.min(a[0], b[0]);
+          const y = Math.min(a[1], b[1]);
+          regions[i] = [x, y, Math.max(a[0] + a[2], b[0] + b[2]) - x, Math.max(a[1] + a[3], b[1] + b[3]) - y];
+          regions.splice(j, 1);
+          joined = true; // the grown region may overlap ones checked before
+          break;
+        }
+      }
+    }
+  }
+  const area = regions.reduce((sum, region) => sum + region[2] * region[3], 0);
+  return area > ROI_MAX_AREA * frameWidth * frameHeight ? null : regions;
+}
+
+// Markers of a (the first) not in b, b is null for none
+function mergeMarkers(a, b) {
+  if (b === null) {
+    return a;
+  }
+  const known = new Set(b.ids);
+  const keep = [];
+  for (let i = 0; i < a.ids.length; ++i) {
+    if (!known.has(a.ids[i])) {
+      keep.push(i);
+    }
+  }
+  const result = { corners: new Float32Array(b.corners.length + keep.length * 8), ids: new Int32Array(b.ids.length + keep.length) };
+  result.corners.set(b.corners);
+  result.ids.set(b.ids);
+  keep.forEach((i, k) => {
+    result.corners.set(a.corners.subarray(i * 8, i * 8 + 8), b.corners.length + k * 8);
+    result.ids[b.ids.length + k] = a.ids[i];
+  });
+  return result;
+}
+
+function detect(frame) {
+  let result = null;
+  let mode = "roi";
+  const regions = previous !== null ? regionsAround(previous, frame.width, frame.height) : null;
+  if (regions !== null) {
+    result = { corners: new Float32Array(0), ids: new Int32Array(0) };
+    for (const region of regions) {
+      result = mergeMarkers(detectRegion(frame, ...region, 1), result);
+    }
+  }
+  const lost = result !== null && result.ids.length < previous.ids.length; // they may have moved out of the region
+  if (result === null || lost || framesSinceFullSearch >= FULL_SEARCH_INTERVAL) {
+    mode = "full";
+    framesSinceFullSearch = 0;
+    const found = detectRegion(frame, 0, 0, frame.width, frame.height, FULL_SEARCH_SCALE);
+    const known = new Set(result !== null ? result.ids : []);
+    for (let i = 0; i < found.ids.length; ++i) {
+      if (known.has(found.ids[i])) {
+        continue;
+      }
+      // one region per new marker, markers far apart would make one region as big as the frame
+      const region = regionAround(found.corners.subarray(i * 8, i * 8 + 8), frame.width, frame.height);
+      result = mergeMarkers(detectRegion(frame, ...region, 1), result);
+      for (const id of result.ids) {
+        known.add(id);
+      }
+    }
+    if (result === null) {
+      result = { corners: new Float32Array(0), ids: new Int32Array(0) };
+    }
+  } else {
+    framesSinceFullSearch++;
+  }
+  // copied, the arrays of the result are transferred to the page
+  previous = result.ids.length > 0 ? { corners: result.corners.slice(), ids: result.ids.slice() } : null;
+  return { ...result, mode };
+}
+
+self.onmessage = async function (evt) {
+  const { id, frame } = evt.data;
+  await ready;
+  const detectStart = performance.timeOrigin + performance.now();
+  const result = detect(frame);
+  const detectEnd = performance.timeOrigin + performance.now();
+  frame.close();
+  self.postMessage({ id, ...result, detectStart, detectEnd }, [result.corners.buffer, result.ids.buffer]);
+};
@@ -6,6 +6,12 @@ const handCommTarget = new EventTarget();
 const pedalCommTarget = new EventTarget();
 const controlCommTarget = new EventTarget();
 
+// Set by the answer. Sent with the offer when reconnecting after a connection blip, so the
+// server resumes the session (same tracks and state) instead of starting over.
+let sessionId = null;
+const RECONNECT_ATTEMPTS = 5;
+const RECONNECT_INTERVAL = 1000; // ms
+
 async function start() {
   if (document.getElementById('start').classList.contains("hidden")) {
     toastr.error("Disconnect first!");
@@ -14,14 +20,47 @@ async function start() {
   document.getElementById('start').classList.add("hidden");
   toastr.info("Connecting...");
 
+  sessionId = null;
+  if (!await connect()) {
+    document.getElementById('start').classList.remove("hidden");
+  }
+}
+
+async function reconnect(lostTime) {
+  for (let attempt = 0; attempt < RECONNECT_ATTEMPTS; attempt++) {
+    if (await connect(lostTime)) {
+      return;
+    }
+    await sleep(RECONNECT_INTERVAL);
+  }
+  toastr.error("Could not reconnect.");
+  sessionId = null;
+  document.getElementById('player').classList.add("hidden");
+  document.getElementById('start').classList.remove("hidden");
+}
+
+// lostTime: performance.now() when the previous connection was lost, when reconnecting
+// Returns false when the offer could not be made
+async function connect(lostTime = null) {
   const pc = new RTCPeerConnection({
     sdpSemantics: 'unified-plan'
   });
+  // undo what is bound to this connection when it is lost
+  const detachers = [];
+  let lost = false;
+  let recoverSeconds = null;
+
+  // set from the answer when the server tiles all cameras into one track (mid: 0)
+  let mosaicLayout = null;
 
   // connect audio / video
   pc.addEventListener('track', function (evt) {
     if (evt.track.kind === 'video') {
-      if (evt.transceiver.mid === '0') {
+      if (mosaicLayout !== null) {
+        if (evt.transceiver.mid === '0') {
+          showMosaic(evt.track, mosaicLayout);
+        }
+      } else if (evt.transceiver.mid === '0') {
         document.getElementById('video-head').srcObject = new MediaStream([evt.track]);
         document.getElementById('video-head').play();
       } else if (evt.transceiver.mid === '1') {
@@ -40,60 +79,104 @@ async function start() {
   pc.addTransceiver('video', { direction: 'recvonly' });
   pc.addTransceiver('video', { direction: 'recvonly' });
 
-  const handChannel = pc.createDataChannel("hand")
-
-  const handToServerCb = async function (evt) {
-    handChannel.send(evt.detail)
+  // Observers (open index.html?observer) only watch the streams,
+  // hand / pedal / control channels belong to the operator
+  const observer = new URLSearchParams(window.location.search).has('observer');
+
+  // Upload the capture camera and detect markers on server (open index.html?detect=server),
+  // instead of running capture() in the browser
+  const serverDetect = !observer && new URLSearchParams(window.location.search).get('detect') === 'server';
+  if (serverDetect) {
+    if (localStorage.getItem("camera_matrix") === null) {
+      toastr.error("You need calibrate camera first");
+      pc.close();
+      return false;
+    }
+    let mediaStream;
+    try {
+      mediaStream = await navigator.mediaDevices.getUserMedia({
+        video: {
+          frameRate: { min: 30, ideal: 30, max: 30 },
+          width: { min: 1280, ideal: 1280, max: 1280 },
+          height: { min: 720, ideal: 720, max: 720 },
+        },
+      });
+    } catch (err) {
+      toastr.error(`Error opening video capture (may be your cam have too low resolution): ${err.name} ${err.message}`);
+      pc.close();
+      return false;
+    }
+    const captureTrack = mediaStream.getVideoTracks()[0];
+    detachers.push(() => captureTrack.stop());
+    captureTrack.contentHint = 'detail'; // keep resolution for detection accuracy, drop frames instead
+    pc.addTransceiver(captureTrack, { direction: 'sendonly' }); // mid: 3
+    toastr.info("Capture video will be uploaded to the server for marker detection.");
   }
 
-  handChannel.addEventListener('open', function (evt) {
-    handCommTarget.addEventListener('toServer', handToServerCb);
+  if (!observer) {
+    // a lost hand / pedal message is superseded by the next one, do not hold newer ones back for retransmissions
+    const handChannel = pc.createDataChannel("hand", { ordered: false, maxRetransmits: 0 })
+
+    const handToServerCb = async function (evt) {
+      handChannel.send(evt.detail)
+    }
+
+    handChannel.addEventListener('open', function (evt) {
+      handCommTarget.addEventListener('toServer', handToServerCb);
+      detachers.push(() => handCommTarget.removeEventListener('toServer', handToServerCb));
 
-    handChannel.addEventListener('message', function (evt) {
-      handCommTarget.dispatchEvent(new CustomEvent("fromServer", { detail: evt.data }))
+      handChannel.addEventListener('message', function (evt) {
+        handCommTarget.dispatchEvent(new CustomEvent("fromServer", { detail: evt.data }))
+      })
     })
-  })
 
-  handChannel.addEventListener('close', function (evt) {
-    handCommTarget.removeEventListener('toServer', handToServerCb);
-  })
+    handChannel.addEventListener('close', function (evt) {
+      handCommTarget.removeEventListener('toServer', handToServerCb);
+    })
 
-  const pedalChannel = pc.createDataChannel("pedal")
+    const pedalChannel = pc.createDataChannel("pedal", { ordered: false, maxRetransmits: 0 })
 
-  const pedalToServerCb = async function (evt) {
-    pedalChannel.send(evt.detail)
-  }
+    const pedalToServerCb = async function (evt) {
+      pedalChannel.send(evt.detail)
+    }
 
-  pedalChannel.addEventListener('open', function (evt) {
-    pedalCommTarget.addEventListener('toServer', pedalToServerCb);
+    pedalChannel.addEventListener('open', function (evt) {
+      pedalCommTarget.addEventListener('toServer', pedalToServerCb);
+      detachers.push(() => pedalCommTarget.removeEventListener('toServer', pedalToServerCb));
 
-    pedalChannel.addEventListener('message', function (evt) {
-      pedalCommTarget.dispatchEvent(new CustomEvent("fromServer", { detail: evt.data }))
+      pedalChannel.addEventListener('message', function (evt) {
+        pedalCommTarget.dispatchEvent(new CustomEvent("fromServer", { detail: evt.data }))
+      })
     })
-  })
 
-  pedalChannel.addEventListener('close', function (evt) {
-    pedalCommTarget.removeEventListener('toServer', pedalToServerCb);
-  })
+    pedalChannel.addEventListener('close', function (evt) {
+      pedalCommTarget.removeEventListener('toServer', pedalToServerCb);
+    })
 
-  const controlChannel = pc.createDataChannel("control")
+    const controlChannel = pc.createDataChannel("control")
 
-  const controlToServerCb = async function (evt) {
-    console.log(evt.detail)
-    controlChannel.send(evt.detail)
-  }
+    const controlToServerCb = async function (evt) {
+      console.log(evt.detail)
+      controlChannel.send(evt.detail)
+    }
 
-  controlChannel.addEventListener('open', function (evt) {
-    controlCommTarget.addEventListener('toServer', controlToServerCb);
+    controlChannel.addEventListener('open', function (evt) {
+      controlCommTarget.addEventListener('toServer', controlToServerCb);
+      detachers.push(() => controlCommTarget.removeEventListener('toServer', controlToServerCb));
+      if (recoverSeconds !== null) {
+        controlChannel.send(JSON.stringify({ type: "stats", recover: recoverSeconds }));
+      }
+      registerCalibration(); // may be a restarted server
 
-    controlChannel.addEventListener('message', function (evt) {
-      controlCommTarget.dispatchEvent(new CustomEvent("fromServer", { detail: evt.data }))
+      controlChannel.addEventListener('message', function (evt) {
+        controlCommTarget.dispatchEvent(new CustomEvent("fromServer", { detail: evt.data }))
+      })
     })
-  })
 
-  controlChannel.addEventListener('close', function (evt) {
-    controlCommTarget.removeEventListener('toServer', controlToServerCb);
-  })
+    controlChannel.addEventListener('close', function (evt) {
+      controlCommTarget.removeEventListener('toServer', controlToServerCb);
+    })
+  }
 
   // Display statistics
   const showPing = async () => {
@@ -102,23 +185,39 @@ async function start() {
     results.forEach(res => {
       if (res.type === "candidate-pair" && res.nominated) {
         document.getElementById('pc-ping').innerHTML = res.currentRoundTripTime * 1000;
+        controlCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: JSON.stringify({ type: "stats", rtt: res.currentRoundTripTime }) }));
       }
     });
   }
-  setInterval(showPing, 1000);
+  const statsTimer = setInterval(showPing, 1000);
+  detachers.push(() => clearInterval(statsTimer));
 
   pc.addEventListener('connectionstatechange', () => {
     document.getElementById('pc-status').innerHTML = pc.connectionState;
     if (pc.connectionState === 'connected') {
-      toastr.success("Connected.");
+      if (lostTime === null) {
+        toastr.success("Connected.");
+      } else {
+        recoverSeconds = (performance.now() - lostTime) / 1000;
+        toastr.success(`Reconnected in ${Math.round(recoverSeconds * 1000)}ms.`);
+      }
       document.getElementById('player').classList.remove("hidden");
-    } else if (pc.connectionState === 'disconnected') {
-      toastr.error("Lost connection.");
-      clearInterval(showPing)
+    } else if ((pc.connectionState === 'disconnected' || pc.connectionState === 'failed') && !lost) {
+      lost = true;
+      for (const detach of detachers) {
+        detach();
+      }
       document.getElementById('pc-ping').innerHTML = "INF";
       pc.close()
-      document.getElementById('player').classList.add("hidden");
-      document.getElementById('start').classList.remove("hidden");
+      if (sessionId !== null) {
+        // the server keeps the session for a while, the video is back as soon as a new connection is up
+        toastr.warning("Lost connection, reconnecting...");
+        reconnect(performance.now());
+      } else {
+        toastr.error("Lost connection.");
+        document.getElementById('player').classList.add("hidden");
+        document.getElementById('start').classList.remove("hidden");
+      }
     }
   });
 
@@ -147,6 +246,13 @@ async function start() {
       body: JSON.stringify({
         sdp: offer.sdp,
         type: offer.type,
+        role: observer ? 'observer' : 'operator',
+        session: sessionId,
+        ...(serverDetect ? {
+          detect: 'server',
+          camera_matrix: JSON.parse(localStorage.getItem("camera_matrix")),
+          distortion_coefficients: JSON.parse(localStorage.getItem("distortion_coefficients")),
+        } : {}),
       }),
       headers: {
         'Content-Type': 'application/json'
@@ -158,12 +264,181 @@ async function start() {
     }
   } catch (err) {
     toastr.error(`Network error: ${err.message}`);
+    for (const detach of detachers) {
+      detach();
+    }
     pc.close()
-    document.getElementById('start').classList.remove("hidden");
+    return false;
   }
   const answer = await response.json();
+  mosaicLayout = answer.mosaic || null;
+  if (lostTime !== null && !answer.resumed) {
+    toastr.warning("The server did not keep the session, started a new one.");
+  }
+  sessionId = answer.session ?? null;
+
+  await pc.setRemoteDescription({ sdp: answer.sdp, type: answer.type });
+  return true;
+}
+
+// Crops the views out of the mosaic track on every video frame
+// layout: { width, height, tiles: { name: [x, y, width, height] } }, see MosaicLayout in webserver.py
+function showMosaic(track, layout) {
+  const video = document.getElementById('video-mosaic');
+  video.srcObject = new MediaStream([track]);
+  video.play();
+
+  const views = { head: 'head', wrist_left: 'wrist-left', wrist_right: 'wrist-right' };
+  const contexts = {};
+  for (const [name, id] of Object.entries(views)) {
+    if (!(name in layout.tiles)) {
+      continue;
+    }
+    const canvas = document.getElementById(`mosaic-${id}`);
+    canvas.width = layout.tiles[name][2];
+    canvas.height = layout.tiles[name][3];
+    canvas.classList.remove("hidden");
+    document.getElementById(`video-${id}`).classList.add("hidden");
+    contexts[name] = canvas.getContext('2d');
+  }
+
+  const draw = () => {
+    // the track may be downscaled by the server when the link is congested
+    const sx = video.videoWidth / layout.width;
+    const sy = video.videoHeight / layout.height;
+    if (sx > 0 && sy > 0) {
+      for (const [name, ctx] of Object.entries(contexts)) {
+        const [x, y, width, height] = layout.tiles[name];
+        ctx.drawImage(video, x * sx, y * sy, width * sx, height * sy, 0, 0, width, height);
+      }
+    }
+    if ('requestVideoFrameCallback' in video) {
+      video.requestVideoFrameCallback(draw);
+    } else {
+      requestAnimationFrame(draw);
+    }
+  };
+  draw();
+}
+
+// Binary wire format of hand / pedal channels, see wire.py
+// Set localStorage "wire_format" to "json" to fall back to JSON messages
+const WIRE_HAND_VERSION = 3;
+const WIRE_HAND_CALIBRATION_VERSION = 4;
+const WIRE_PEDAL_VERSION = 2;
+const WIRE_KIND_HAND = 1;
+const WIRE_KIND_PEDAL = 2;
+
+function useBinaryWire() {
+  return localStorage.getItem("wire_format") !== "json";
+}
+
+// hand / pedal channels are unordered, the server drops messages older than the last one it got
+let handSeq = 0;
+let pedalSeq = 0;
+
+// Typed arrays use the platform byte order, which is little endian on every browser we run
+// corners: Float32Array (n * 4 * 2), ids: Int32Array (n), as detect_worker.js returns them
+// timestamps: [capture, detect start, detect end] in epoch ms
+function encodeHand(cameraMatrix, distortionCoefficients, corners, ids, timestamps, seq) {
+  const nMarkers = ids.length;
+  const nDistortion = distortionCoefficients.length;
+  const buffer = new ArrayBuffer(8 + 8 * 3 + 4 * (9 + nDistortion + nMarkers + nMarkers * 4 * 2));
+
+  const header = new DataView(buffer, 0, 8);
+  header.setUint8(0, WIRE_HAND_VERSION);
+  header.setUint8(1, WIRE_KIND_HAND);
+  header.setUint16(2, nMarkers, true);
+  header.setUint16(4, nDistortion, true);
+  header.setUint16(6, seq & 0xFFFF, true);
+
+  let offset = 8;
+  new Float64Array(buffer, offset, 3).set(timestamps);
+  offset += 3 * 8;
+  new Float32Array(buffer, offset, 9).set(cameraMatrix);
+  offset += 9 * 4;
+  new Float32Array(buffer, offset, nDistortion).set(distortionCoefficients);
+  offset += nDistortion * 4;
+  new Int32Array(buffer, offset, nMarkers).set(ids);
+  offset += nMarkers * 4;
+  new Float32Array(buffer, offset, nMarkers * 4 * 2).set(corners);
+  return buffer;
+}
+
+// v4, intrinsics registered with registerCalibration
+function encodeHandCalibrated(calibrationId, corners, ids, timestamps, seq) {
+  const nMarkers = ids.length;
+  const buffer = new ArrayBuffer(8 + 8 * 3 + 4 * (nMarkers + nMarkers * 4 * 2));
+
+  const header = new DataView(buffer, 0, 8);
+  header.setUint8(0, WIRE_HAND_CALIBRATION_VERSION);
+  header.setUint8(1, WIRE_KIND_HAND);
+  header.setUint16(2, nMarkers, true);
+  header.setUint16(4, calibrationId, true);
+  header.setUint16(6, seq & 0xFFFF, true);
+
+  let offset = 8;
+  new Float64Array(buffer, offset, 3).set(timestamps);
+  offset += 3 * 8;
+  new Int32Array(buffer, offset, nMarkers).set(ids);
+  offset += nMarkers * 4;
+  new Float32Array(buffer, offset, nMarkers * 4 * 2).set(corners);
+  return buffer;
+}
+
+// Calibration of the running capture, registered on the server once (and again on every new
+// control channel), hand messages reference its id instead of carrying the intrinsics.
+// Until the id is back, hand messages carry the intrinsics as before.
+let handCalibration = null; // { camera_matrix, distortion_coefficients, id }
+
+function registerCalibration() {
+  if (handCalibration === null) {
+    return;
+  }
+  handCalibration.id = null;
+  controlCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: JSON.stringify({
+    type: "calibration",
+    camera_matrix: handCalibration.camera_matrix,
+    distortion_coefficients: handCalibration.distortion_coefficients,
+  }) }));
+}
+
+const TELEOP_MODE_COLORS = { 'None': 'black', 'Base': 'red' }; // arm modes are blue
+
+// Structured state streamed by the server (see telemetry.py), only the keys that changed
+function showState(state) {
+  if (state.teleop_mode !== undefined) {
+    document.getElementById('teleop-mode').innerHTML = state.teleop_mode;
+    document.getElementById('teleop-mode').style.color = TELEOP_MODE_COLORS[state.teleop_mode] ?? 'blue';
+  }
+  if (state.gripper_lock_left !== undefined) {
+    document.getElementById('gripper-lock-left').innerHTML = state.gripper_lock_left;
+  }
+  if (state.gripper_lock_right !== undefined) {
+    document.getElementById('gripper-lock-right').innerHTML = state.gripper_lock_right;
+  }
+  if (state.lift_distance !== undefined) {
+    document.getElementById('lift-distance').innerHTML = state.lift_distance.toFixed(3);
+  }
+  if (state.tracking !== undefined) {
+    const [left, right] = state.tracking;
+    document.getElementById('tracking').innerHTML = `left ${left ? 'yes' : 'no'}, right ${right ? 'yes' : 'no'}`;
+  }
+  if (state.filter !== undefined) {
+    const lag = (state.filter.lag_mm ?? []).map((l) => l ?? '-').join(' / ');
+    document.getElementById('pose-filter').innerHTML = state.filter.name === null ? 'off' : `${state.filter.name} ${lag}mm`;
+  }
+}
 
-  await pc.setRemoteDescription(answer);
+function encodePedal(values, seq) {
+  const buffer = new ArrayBuffer(8 + 4 * values.length);
+  const header = new DataView(buffer, 0, 8);
+  header.setUint8(0, WIRE_PEDAL_VERSION);
+  header.setUint8(1, WIRE_KIND_PEDAL);
+  header.setUint16(2, values.length, true);
+  header.setUint16(4, seq & 0xFFFF, true);
+  new Float32Array(buffer, 8, values.length).set(values);
+  return buffer;
 }
 
 class MyCameraCapture {
@@ -228,6 +503,58 @@ class MyCameraCapture {
   }
 }
 
+// Marker detection in detect_worker.js, one frame at a time
+class DetectWorker {
+  constructor() {
+    this.worker = new Worker("detect_worker.js");
+    this.pending = new Map(); // id -> resolve
+    this.nextId = 0;
+    this.worker.addEventListener('message', (evt) => {
+      this.pending.get(evt.data.id)(evt.data);
+      this.pending.delete(evt.data.id);
+    });
+  }
+
+  // frame: ImageBitmap, handed over to the worker
+  // -> { corners: Float32Array (n * 4 * 2), ids: Int32Array (n), mode, detectStart, detectEnd (epoch ms) }
+  detect(frame) {
+    const id = this.nextId++;
+    return new Promise((resolve) => {
+      this.pending.set(id, resolve);
+      this.worker.postMessage({ id, frame }, [frame]);
+    });
+  }
+
+  terminate() {
+    this.worker.terminate();
+  }
+}
+
+// Outlines and ids of the detected markers over the frame, like cv2.drawDetectedMarkers
+function drawMarkers(ctx, corners, ids) {
+  ctx.lineWidth = 2;
+  ctx.strokeStyle = 'lime';
+  ctx.fillStyle = 'red';
+  ctx.font = '20px sans-serif';
+  for (let i = 0; i < ids.length; ++i) {
+    const points = corners.subarray(i * 4 * 2, (i + 1) * 4 * 2);
+    ctx.beginPath();
+    ctx.moveTo(points[0], points[1]);
+    for (let j = 1; j < 4; ++j) {
+      ctx.lineTo(points[j * 2], points[j * 2 + 1]);
+    }
+    ctx.closePath();
+    ctx.stroke();
+    ctx.fillRect(points[0] - 3, points[1] - 3, 6, 6);
+    ctx.fillText(`id=${ids[i]}`, points[0], points[1] - 6);
+  }
+}
+
+// Set localStorage "capture_overlay" to "off" to skip drawing the capture and markers
+function useCaptureOverlay() {
+  return localStorage.getItem("capture_overlay") !== "off";
+}
+
 async function capture() {
   if (localStorage.getItem("camera_matrix") === null) {
     toastr.error("You need calibrate camera first");
@@ -235,12 +562,13 @@ async function capture() {
   }
   const camera_matrix_list = JSON.parse(localStorage.getItem("camera_matrix"));
   const distortion_coefficients_list = JSON.parse(localStorage.getItem("distortion_coefficients"));
+  const camera_matrix_array = new Float32Array(camera_matrix_list.flat());
+  const distortion_coefficients_array = new Float32Array(distortion_coefficients_list.flat());
+  handCalibration = { camera_matrix: camera_matrix_list, distortion_coefficients: distortion_coefficients_list, id: null };
+  registerCalibration();
 
-  if (window.cv2 === undefined) {
-    window.cv2 = await cv;
-  }
-  
   const cap = await MyCameraCapture.create();
+  const detectWorker = new DetectWorker();
 
   document.getElementById('capture').classList.add("hidden");
   document.getElementById('calibrate').classList.add("hidden");
@@ -250,106 +578,84 @@ async function capture() {
   $outCanvas.height = cap.height;
   const outCtx = $outCanvas.getContext("2d");
 
-  const aruco_dict = cv2.getPredefinedDictionary(cv2.DICT_4X4_50);
-  const aruco_detection_parameters = new cv2.aruco_DetectorParameters();
-  aruco_detection_parameters.cornerRefinementMethod = cv2.CORNER_REFINE_SUBPIX; // Faster
-  // aruco_detection_parameters.cornerRefinementMethod = cv2.CORNER_REFINE_APRILTAG; // Provide subpixel accuracy
-  // aruco_detection_parameters.aprilTagQuadDecimate = 2; // Speed up for wasm
-  const refine_parameters = new cv2.aruco_RefineParameters(10, 3, true)
-  const detector = new cv2.aruco_ArucoDetector(aruco_dict, aruco_detection_parameters, refine_parameters);
-
   const fromServerCb = async function (evt) {
     console.dir(evt.detail);
   }
   handCommTarget.addEventListener('fromServer', fromServerCb);
 
   let avgTime = 0;
+  let lastTime = performance.now();
+  // the next frame is grabbed while the worker detects this one
+  let nextFrame = cap.grabFrame();
   while (true) {
-    const frame = await cap.grabFrame();
-
+    const frame = await nextFrame;
     const t0 = performance.now();
-    const imageData = cap.getImageData(frame);
-    const t1 = performance.now();
-
-    const mat = cv2.matFromImageData(imageData);
-
-    const corners = new cv2.MatVector();
-    const ids = new cv2.Mat();
-    const rejected = new cv2.MatVector();
-
-    const t2 = performance.now();
-    detector.detectMarkers(mat, corners, ids, rejected); // 63ms@1920x1080 40ms@1280x720
-    const t3 = performance.now();
+    nextFrame = cap.grabFrame();
 
-    const corners_list_list = [];
-    for (let l = 0; l < corners.size(); ++l) {
-      const temp_corners = corners.get(l);
-      const corners_list = [];
-      const rows = temp_corners.rows;
-      const cols = temp_corners.cols;
-      const channels = Math.trunc(temp_corners.type() / 8) + 1;
-      for (let i = 0; i < rows; ++i) {
-        const row = [];
-        for (let j = 0; j < cols; ++j) {
-          const point = [];
-          for (let k = 0; k < channels; ++k) {
-            point.push(temp_corners.data32F[(i * cols + j) * channels + k]);
-          }
-          row.push(point);
-        }
-        corners_list.push(row);
-      }
-      corners_list_list.push(corners_list);
+    const overlay = useCaptureOverlay();
+    if (overlay) {
+      outCtx.drawImage(frame, 0, 0); // before the frame is handed to the worker
     }
-    
-    const ids_list = [];
-    for (let i = 0; i < ids.rows; ++i) {
-      const row = [];
-      for (let j = 0; j < ids.cols; ++j) {
-        row.push(ids.data32S[i * ids.cols + j]);
+    const { corners, ids, mode, detectStart, detectEnd } = await detectWorker.detect(frame);
+
+    // for latency metrics on the server
+    const timestamps = [performance.timeOrigin + t0, detectStart, detectEnd];
+    handSeq = (handSeq + 1) & 0xFFFF;
+
+    if (useBinaryWire() && handCalibration.id !== null) {
+      handCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: encodeHandCalibrated(
+        handCalibration.id,
+        corners,
+        ids,
+        timestamps,
+        handSeq
+      ) }))
+    } else if (useBinaryWire()) {
+      handCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: encodeHand(
+        camera_matrix_array,
+        distortion_coefficients_array,
+        corners,
+        ids,
+        timestamps,
+        handSeq
+      ) }))
+    } else {
+      // [n][1][4][2] and [n][1], as cv2.aruco returns them
+      const corners_list_list = [];
+      const ids_list = [];
+      for (let i = 0; i < ids.length; ++i) {
+        const corners_list = [];
+        for (let j = 0; j < 4; ++j) {
+          corners_list.push([corners[(i * 4 + j) * 2], corners[(i * 4 + j) * 2 + 1]]);
+        }
+        corners_list_list.push([corners_list]);
+        ids_list.push([ids[i]]);
       }
-      ids_list.push(row);
-    }
-
-    // console.log(JSON.stringify([
-    //   corners_list_list,
-    //   ids_list
-    // ]));
-
-    handCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: JSON.stringify([
-      camera_matrix_list,
-      distortion_coefficients_list,
-      corners_list_list,
-      ids_list
-    ]) }))
 
-    cv2.cvtColor(mat, mat, cv2.COLOR_RGBA2BGR);
-    cv2.drawDetectedMarkers(mat, corners, ids);
-
-    cv2.cvtColor(mat, mat, cv2.COLOR_BGR2RGBA);
-    const debugImageData = new ImageData(new Uint8ClampedArray(mat.data), mat.cols, mat.rows);
-    outCtx.putImageData(debugImageData, 0, 0);
-
-    corners.delete();
-    ids.delete();
-    rejected.delete();
+      handCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: JSON.stringify([
+        camera_matrix_list,
+        distortion_coefficients_list,
+        corners_list_list,
+        ids_list,
+        timestamps,
+        handSeq
+      ]) }))
+    }
 
-    mat.delete();
+    if (overlay) {
+      drawMarkers(outCtx, corners, ids);
+    }
 
-    const t4 = performance.now();
-    avgTime = avgTime * 0.9 + (t4 - t0) * 0.1;  
-    // console.log(`imageData time: ${(t1 - t0).toFixed(2)}`);
-    // console.log(`detectMarkers time: ${(t3 - t2).toFixed(2)}`);
-    // console.log(`time: ${(t4 - t0).toFixed(2)}, avg: ${avgTime.toFixed(2)}`); // 50ms@1280x720
-    document.getElementById('aruco-timing').innerHTML = (t4 - t0).toFixed(2);
+    // time per hand message, detection of the next frame overlaps with grabbing it
+    const t1 = performance.now();
+    avgTime = avgTime * 0.9 + (t1 - lastTime) * 0.1;
+    lastTime = t1;
+    document.getElementById('aruco-timing').innerHTML = `${avgTime.toFixed(2)} (detect ${(detectEnd - detectStart).toFixed(2)} ${mode})`;
   }
   
   handCommTarget.removeEventListener('fromServer', fromServerCb);
 
-  aruco_dict.delete();
-  aruco_detection_parameters.delete();
-  refine_parameters.delete();
-  detector.delete();
+  detectWorker.terminate();
 
   document.getElementById('capture').classList.remove("hidden");
   document.getElementById('calibrate').classList.remove("hidden");
@@ -662,6 +968,10 @@ async function connectPedal() {
 
   pedalCommTarget.addEventListener('fromServer', fromServerCb);
 
+  // Hz, set localStorage "pedal_rate" to change
+  const pedalRate = Number(localStorage.getItem("pedal_rate") ?? 50);
+  let lastPedalSendTime = 0;
+
   while (true) {
     const { value: buffer, done } = await serialRead();
     if (done) break;
@@ -677,7 +987,15 @@ async function connectPedal() {
       pedalRealValues.push((pedalValues[i] - pedalMin[i]) / (pedalMax[i] - pedalMin[i]));
     }
     
-    pedalCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: JSON.stringify(pedalRealValues) }))
+    // the serial port delivers far more frames than the control loop needs
+    const now = performance.now();
+    if (now - lastPedalSendTime < 1000 / pedalRate) {
+      continue;
+    }
+    lastPedalSendTime = now;
+
+    pedalSeq = (pedalSeq + 1) & 0xFFFF;
+    pedalCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: useBinaryWire() ? encodePedal(pedalRealValues, pedalSeq) : JSON.stringify({ seq: pedalSeq, values: pedalRealValues }) }))
   }
 
   pedalCommTarget.removeEventListener('fromServer', fromServerCb);
@@ -748,6 +1066,12 @@ window.addEventListener('load', function () {
   // Notice: autoplay is restricted when user is not clicked the page
   // start()
 
+  if (new URLSearchParams(window.location.search).get('detect') === 'server') {
+    // see start(), the capture camera is streamed to the server instead
+    document.getElementById('capture-notice').textContent =
+      "Video from your device will be uploaded to the server, where the markers are detected (detect=server mode).";
+  }
+
   document.addEventListener(
     "keydown",
     (event) => {
@@ -782,6 +1106,8 @@ window.addEventListener('load', function () {
           controlCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: JSON.stringify("percise_mode_more_percise") }));
         } else if (keyName.toLowerCase() == 'r') {
           controlCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: JSON.stringify("reset") }));
+        } else if (keyName.toLowerCase() == 'c') {
+          controlCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: JSON.stringify("cancel") }));
         } else if (keyName.toLowerCase() == 'f') {
           controlCommTarget.dispatchEvent(new CustomEvent("toServer", { detail: JSON.stringify("done") }));
         } else if (keyName.toLowerCase() == 't') {
@@ -798,40 +1124,33 @@ window.addEventListener('load', function () {
 
   controlCommTarget.addEventListener('fromServer', async function (evt) {
     message = JSON.parse(evt.detail);
-    toastr.info("Server Message: " + message);
 
-    if (message === "Teleop Mode: None") {
-      document.getElementById('teleop-mode').innerHTML = 'None';
-      document.getElementById('teleop-mode').style.color = 'black';
-    } else if (message === "Teleop Mode: Base") {
-      document.getElementById('teleop-mode').innerHTML = 'Base';
-      document.getElementById('teleop-mode').style.color = 'red';
-    } else if (message === "Teleop Mode: Arm") {
-      document.getElementById('teleop-mode').innerHTML = 'Arm';
-      document.getElementById('teleop-mode').style.color = 'blue';
-    } else if (message === "Teleop Mode: Arm (Percise)") {
-      document.getElementById('teleop-mode').innerHTML = 'Arm (Percise)';
-      document.getElementById('teleop-mode').style.color = 'blue';
-    } else if (message === "Teleop Mode: Arm (More Percise)") {
-      document.getElementById('teleop-mode').innerHTML = 'Arm (More Percise)';
-      document.getElementById('teleop-mode').style.color = 'blue';
-    } else if (message === "Left Gripper Lock: Locked (Ready to Unlock)") {
-      document.getElementById('gripper-lock-left').innerHTML = 'Locked (Ready to Unlock)';
-    } else if (message === "Right Gripper Lock: Locked (Ready to Unlock)") {
-      document.getElementById('gripper-lock-right').innerHTML = 'Locked (Ready to Unlock)';
-    } else if (message === "Left Gripper Lock: Unlocked") {
-      document.getElementById('gripper-lock-left').innerHTML = 'Unlocked';
-    } else if (message === "Right Gripper Lock: Unlocked") {
-      document.getElementById('gripper-lock-right').innerHTML = 'Unlocked';
-    } else if (message.startsWith("Left Gripper Lock: Locked")) {
-      document.getElementById('gripper-lock-left').innerHTML = 'Locked';
-    } else if (message.startsWith("Right Gripper Lock: Locked")) {
-      document.getElementById('gripper-lock-right').innerHTML = 'Locked';
-    } else if (message === "Left Gripper Lock: Locked (Ready to Unlock)") {
-      document.getElementById('gripper-lock-left').innerHTML = 'Locked (Ready to Unlock)';
-    } else if (message === "Right Gripper Lock: Locked (Ready to Unlock)") {
-      document.getElementById('gripper-lock-right').innerHTML = 'Locked (Ready to Unlock)';
+    if (typeof message === 'object' && message.type === 'metrics') {
+      // name: [count, mean, p50, p95] in ms
+      document.getElementById('latency-summary').innerHTML = Object.entries(message.summary).map(
+        ([name, [count, mean, p50, p95]]) => `${name}: p50 ${p50}ms p95 ${p95}ms`
+      ).join('<br>');
+      return;
     }
+    if (typeof message === 'object' && message.type === 'calibration') {
+      if (handCalibration !== null) {
+        if (message.id !== null) {
+          handCalibration.id = message.id;
+        } else if (handCalibration.id !== null) {
+          registerCalibration(); // the server does not know our id
+        }
+      }
+      return;
+    }
+    if (typeof message === 'object' && message.type === 'telemetry') {
+      // batched by the server, a repeated text comes once with how often it was logged
+      for (const [text, count] of message.logs ?? []) {
+        toastr.info("Server Message: " + text + (count > 1 ? ` (x${count})` : ''));
+      }
+      showState(message.state ?? {});
+      return;
+    }
+    toastr.info("Server Message: " + message);
   });
 
   toastr.options = {
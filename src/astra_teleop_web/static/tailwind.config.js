@@ -0,0 +1,9 @@
+/** @type {import('tailwindcss').Config} */
+module.exports = {
+  // classes toggled by index.js (e.g. hidden) are found there
+  content: ["./index.html", "./index.js"],
+  theme: {
+    extend: {},
+  },
+  plugins: [],
+}
@@ -0,0 +1,92 @@
+import asyncio
+import math
+import threading
+import time
+import logging
+
+from astra_teleop_web.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_INTERVAL = 0.1 # s
+REPEAT_INTERVAL = 1 # s, the same text is shown at most this often
+
+# Status texts and UI state for the operator page, sent on the control channel in one
+# message per tick instead of one message (and one toast) per call:
+#   {"type": "telemetry", "logs": [[text, count], ...], "state": {key: value, ...}}
+# log() and state() can be called from any thread, send(message) is called on the event loop.
+# A text logged again within repeat_interval waits for the next message after it and is sent
+# once with the number of times it was logged. State keys are sent when their value changed,
+# the newest value only.
+class TelemetryPublisher:
+    def __init__(self, send, interval=TELEMETRY_INTERVAL, repeat_interval=REPEAT_INTERVAL):
+        self.send = send
+        self.interval = interval
+        self.repeat_interval = repeat_interval
+        self.lock = threading.Lock()
+        self.logs = {} # text -> times logged since it was last sent, in order
+        self.sent_time = {} # text -> monotonic time it was last sent
+        self.values = {}
+        self.changed = set()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def log(self, text):
+        with self.lock:
+            count = self.logs.get(text, 0)
+            self.logs[text] = count + 1
+        if count:
+            metrics.inc("telemetry_coalesced_total")
+
+    def state(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                if key not in self.values or self.values[key] != value:
+                    self.values[key] = value
+                    self.changed.add(key)
+
+    def resend_state(self):
+        # for a new control channel, the page starts out knowing nothing
+        with self.lock:
+            self.changed.update(self.values)
+
+    def flush(self):
+        # -> the message of this tick, or None if there is nothing new
+        now = time.monotonic()
+        with self.lock:
+            logs = []
+            for text, count in list(self.logs.items()):
+                if now - self.sent_time.get(text, -math.inf) >= self.repeat_interval:
+                    logs.append([text, count])
+                    self.sent_time[text] = now
+                    del self.logs[text]
+            state = { key: self.values[key] for key in self.changed }
+            self.changed.clear()
+            self.sent_time = { text: t for text, t in self.sent_time.items() if now - t < self.repeat_interval }
+
+        if not logs and not state:
+            return None
+        message = { "type": "telemetry" }
+        if logs:
+            message["logs"] = logs
+        if state:
+            message["state"] = state
+        return message
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            message = self.flush()
+            if message is None:
+                continue
+            try:
+                self.send(message)
+            except Exception as e:
+                logger.warning(f"Sending telemetry failed: {e}")
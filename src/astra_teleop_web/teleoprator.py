@@ -2,11 +2,15 @@ import asyncio
 import logging
 
 import numpy as np
-from pytransform3d import transformations as pt
-from pytransform3d import rotations as pr
 import math
+import threading
+import time
 
 from astra_teleop.process import get_solve
+from astra_teleop_web.convergence import StateNotifier, pose_distance
+from astra_teleop_web.metrics import metrics
+from astra_teleop_web.pose_filter import LowPassPoseFilter
+from astra_teleop_web.scheduler import FixedRateScheduler
 from astra_teleop_web.webserver import WebServer
 
 logger = logging.getLogger(__name__)
@@ -16,9 +20,18 @@ INITIAL_LIFT_DISTANCE = 0.8
 
 FAR_SEEING_HEAD_TILT = 0.26
 
+RESET_POS_TOLERANCE = 0.02 # m
+RESET_ROT_TOLERANCE = 0.03 # rad
+RESET_TIMEOUT = 10 # s
+RESET_REPUBLISH_INTERVAL = 0.1 # s, goals are republished while resetting
+
+PEDAL_TIMEOUT = 0.5 # s, pedal values older than this are not applied by the control loop
+LIFT_LOG_INTERVAL = 0.1 # s
+
 class Teleopoperator:
-    def __init__(self):        
-        self.webserver = WebServer()
+    def __init__(self, pose_filter=None, webserver=None, control_rate=100):        
+        # e.g. WebServer(record=...) to record the session, or ReplayWebServer() to replay one
+        self.webserver = webserver if webserver is not None else WebServer()
         self.webserver.on_hand = self.hand_cb
         self.webserver.on_pedal = self.pedal_cb
         self.webserver.on_control = self.control_cb
@@ -41,32 +54,91 @@ class Teleopoperator:
         self.lift_distance = INITIAL_LIFT_DISTANCE
         self.Tscam = { "left": None, "right": None, }
         self.Tcamgoal_last = { "left": None, "right": None }
+        self.pose_capture_time = None # client capture time (epoch s) of a Tcamgoal_last not published yet
+        # applied in percise mode, e.g. OneEuroPoseFilter() or ConstantVelocityPoseFilter() to compensate latency
+        self.pose_filter = pose_filter if pose_filter is not None else LowPassPoseFilter()
+        # clock of hand timestamps and command times, poses are predicted to the command time
+        # (replay sets the recorded one)
+        self.clock = time.monotonic
+        # Tscam, Tcamgoal_last, lift_distance and pose_filter are shared by hand_cb (dispatch thread),
+        # the resets (event loop) and control_tick (scheduler thread)
+        self.lock = threading.RLock()
         
         self.gripper_lock = { "left": False, "right": False }
         self.last_gripper_pos = { "left": GRIPPER_MAX, "right": GRIPPER_MAX }
         
         self.far_seeing = False
+
+        # resets wake up on new tags and new eef poses (pushed with update_eef_pose)
+        self.state_changed = StateNotifier()
+        self.eef_pose = { "left": None, "right": None }
+        self.reset_pos_tolerance = RESET_POS_TOLERANCE
+        self.reset_rot_tolerance = RESET_ROT_TOLERANCE
+        self.reset_timeout = RESET_TIMEOUT
+
+        self.pedal_values = None
+        self.pedal_time = 0
+        self.last_lift_log_time = 0
+        self.control_error = None
+        self.driving = False # the control loop sent a base velocity on the last tick
+
+        # Hz, commands are published by a fixed rate loop from the latest hand / pedal state,
+        # None publishes on every hand / pedal message instead (as replay does, for determinism)
+        self.control_rate = control_rate
+        self.scheduler = None
+        self.publish_state()
+        if self.control_rate is not None:
+            self.scheduler = FixedRateScheduler(self.control_rate, self.control_tick)
+            self.scheduler.start()
         
+    def update_eef_pose(self, side, Tsgoal):
+        # Optional, call from the robot state callback (any thread) so resets notice
+        # convergence right away, otherwise on_get_current_eef_pose is polled
+        self.eef_pose[side] = Tsgoal
+        self.state_changed.notify()
+
+    def get_current_eef_pose(self, side):
+        if self.eef_pose[side] is not None:
+            return self.eef_pose[side]
+        return self.on_get_current_eef_pose(side)
+
+    async def wait_converged(self, name, predicate, on_interval=None):
+        try:
+            elapsed = await self.state_changed.wait_for(
+                predicate, timeout=self.reset_timeout, interval=RESET_REPUBLISH_INTERVAL, on_interval=on_interval,
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"{name} timed out after {self.reset_timeout}s")
+            self.webserver.control_datachannel_log(f"{name} timed out after {self.reset_timeout}s")
+            raise
+        logger.info(f"{name} done in {elapsed:.2f}s")
+        self.webserver.control_datachannel_log(f"{name} done in {elapsed:.2f}s")
+
     async def reset_Tscam(self):
-        self.Tscam = { "left": None, "right": None, }
-        self.Tcamgoal_last = { "left": None, "right": None }
+        with self.lock:
+            self.Tscam = { "left": None, "right": None, }
+            self.Tcamgoal_last = { "left": None, "right": None }
+            self.pose_capture_time = None
+            self.pose_filter.reset()
         
-        while True: # wait for new tag result
-            ok = True
+        def log_waiting():
             for side in ["left", "right"]:
                 if self.Tcamgoal_last[side] is None:
                     logger.info(f"Waiting for new Tcamgoal_last {side}")
-                    ok = False
-            if ok:
-                break
-            
-            await asyncio.sleep(0.1)
+
+        # wait for new tag result
+        await self.wait_converged(
+            "Tag detection",
+            lambda: all(self.Tcamgoal_last[side] is not None for side in ["left", "right"]),
+            on_interval=log_waiting,
+        )
             
-        for side in ["left", "right"]:
-            Tsgoal = self.on_get_current_eef_pose(side)
-            Tcamgoal = self.Tcamgoal_last[side]
-            self.Tscam[side] = Tsgoal @ np.linalg.inv(Tcamgoal)
-            logger.info(f"Tscam ({side}): \n{str(self.Tscam[side])}")
+        with self.lock:
+            for side in ["left", "right"]:
+                Tsgoal = self.get_current_eef_pose(side)
+                Tcamgoal = self.Tcamgoal_last[side]
+                self.Tscam[side] = Tsgoal @ np.linalg.inv(Tcamgoal)
+                logger.info(f"Tscam ({side}): \n{str(self.Tscam[side])}")
                 
     async def update_percise_mode(self, percise_mode):
         self.percise_mode = percise_mode
@@ -76,51 +148,44 @@ class Teleopoperator:
     def update_teleop_mode(self, teleop_mode):
         self.teleop_mode = teleop_mode
         assert self.teleop_mode in ["base", "arm", None]
+        mode = self.teleop_mode_name()
+        self.webserver.publish_state(teleop_mode=mode)
+        logger.info(f"Teleop Mode: {mode}")
+
+    def teleop_mode_name(self):
         if self.teleop_mode == "base":
-            self.webserver.control_datachannel_log("Teleop Mode: Base")
-            logger.info("Teleop Mode: Base")
+            return "Base"
         elif self.teleop_mode == "arm":
             if self.percise_mode == "more_percise":
-                self.webserver.control_datachannel_log("Teleop Mode: Arm (More Percise)")
-                logger.info("Teleop Mode: Arm (More Percise)")
+                return "Arm (More Percise)"
             elif self.percise_mode:
-                self.webserver.control_datachannel_log("Teleop Mode: Arm (Percise)")
-                logger.info("Teleop Mode: Arm (Percise)")
-            else:
-                self.webserver.control_datachannel_log("Teleop Mode: Arm")
-                logger.info("Teleop Mode: Arm")
-        else:
-            self.webserver.control_datachannel_log("Teleop Mode: None")
-            logger.info("Teleop Mode: None")
+                return "Arm (Percise)"
+            return "Arm"
+        return "None"
 
     async def reset_arm(self, lift_distance=INITIAL_LIFT_DISTANCE, joint_bent=math.pi/4, far_seeing=False):  
         self.far_seeing = far_seeing
-        self.lift_distance = lift_distance
+        with self.lock:
+            self.lift_distance = lift_distance
         goal_pose = {
             "left": self.on_get_initial_eef_pose("left", [self.lift_distance, joint_bent, -joint_bent, 0, 0, 0]),
             "right": self.on_get_initial_eef_pose("right", [self.lift_distance, -joint_bent, joint_bent, 0, 0, 0]),
         }
 
-        while True:
-            ok = True
+        def converged():
             for side in ["left", "right"]:
-                curr_pose = self.on_get_current_eef_pose(side)
-                
-                goal_pose_pq = pt.pq_from_transform(goal_pose[side])
-                curr_pose_pq = pt.pq_from_transform(curr_pose)
-                
-                pos_dist = math.dist(goal_pose_pq[:3], curr_pose_pq[:3])
-                rot_dist = pr.quaternion_dist(
-                    goal_pose_pq[3:],
-                    curr_pose_pq[3:]
-                )
-            
-                if not (pos_dist < 0.02 and rot_dist < 0.03):
+                pos_dist, rot_dist = pose_distance(goal_pose[side], self.get_current_eef_pose(side))
+                if not (pos_dist < self.reset_pos_tolerance and rot_dist < self.reset_rot_tolerance):
+                    return False
+            return True
+
+        def publish():
+            for side in ["left", "right"]:
+                curr_pose = self.get_current_eef_pose(side)
+                pos_dist, rot_dist = pose_distance(goal_pose[side], curr_pose)
+                if not (pos_dist < self.reset_pos_tolerance and rot_dist < self.reset_rot_tolerance):
                     logger.info(f"Resetting {side}: pos_dist {pos_dist}m, rot_dist {rot_dist}rad, curr_pose: \n{curr_pose}")
-                    ok = False            
-            if ok:
-                break
-            
+
             for side in ["left", "right"]:
                 self.on_pub_goal(side, goal_pose[side])
                 self.on_pub_gripper(side, self.last_gripper_pos[side])
@@ -129,8 +194,22 @@ class Teleopoperator:
                 self.on_pub_head(0, FAR_SEEING_HEAD_TILT)
             else:
                 self.on_pub_head(0, self.get_head_tilt(self.lift_distance))
-            
-            await asyncio.sleep(0.1)
+
+        await self.wait_converged("Reset arm", converged, on_interval=publish)
+
+    def publish_state(self):
+        # everything the operator page shows, see telemetry.py
+        self.webserver.publish_state(
+            teleop_mode=self.teleop_mode_name(),
+            lift_distance=round(self.lift_distance, 3),
+            gripper_lock_left=self.gripper_lock_state("left"),
+            gripper_lock_right=self.gripper_lock_state("right"),
+        )
+
+    def gripper_lock_state(self, side):
+        if self.gripper_lock[side] == 'ready_to_unlock':
+            return "Locked (Ready to Unlock)"
+        return "Locked" if self.gripper_lock[side] else "Unlocked"
 
     def get_head_tilt(self, lift_distance):
         point0_lift = 0
@@ -140,62 +219,136 @@ class Teleopoperator:
         
         return point0_tilt + (point1_tilt - point0_tilt) * (lift_distance - point0_lift) / (point1_lift - point0_lift)
 
-    def hand_cb(self, camera_matrix, distortion_coefficients, corners, ids):
+    def hand_cb(self, camera_matrix, distortion_coefficients, corners, ids, timestamp=None, capture_time=None):
+        # timestamp: monotonic capture time, the pose filter's clock; capture_time: client clock (epoch s)
+        if timestamp is None:
+            timestamp = self.clock()
+
         Tcamgoal = {}
 
+        t0 = time.perf_counter()
         Tcamgoal["left"], Tcamgoal["right"] = self.solve(
             camera_matrix, distortion_coefficients,
             aruco_corners=corners, aruco_ids=ids,
             debug=False,
             debug_image=None,
         ) # 1ms@1080p
+        metrics.observe("solve_seconds", time.perf_counter() - t0)
         
+        # both arms in one vectorized pass
+        with self.lock:
+            sides = ["left", "right"]
+            valid = np.array([Tcamgoal[side] is not None for side in sides])
+            if valid.any():
+                T = np.stack([Tcamgoal[side] if Tcamgoal[side] is not None else np.eye(4) for side in sides])
+                lag = None
+                if self.percise_mode:
+                    T_raw = T
+                    T = self.pose_filter(T, valid, timestamp)
+                    # how far the filtered position trails the measured one
+                    lag = np.linalg.norm(T[:, :3, 3] - T_raw[:, :3, 3], axis=1)
+                else:
+                    self.pose_filter.reset()
+                self.webserver.publish_state(
+                    tracking=[bool(v) for v in valid],
+                    filter={
+                        "name": type(self.pose_filter).__name__ if self.percise_mode else None,
+                        "lag_mm": [round(float(l) * 1000) if v else None for l, v in zip(lag, valid)] if lag is not None else None,
+                    },
+                )
+                for i, side in enumerate(sides):
+                    if valid[i]:
+                        self.Tcamgoal_last[side] = T[i]
+                if capture_time is not None:
+                    self.pose_capture_time = capture_time
+                self.state_changed.notify()
+
+        if self.control_rate is None and self.teleop_mode is not None:
+            with self.lock:
+                error = self.check_arm_ready()
+                if error is None:
+                    self.publish_arm()
+            if error is not None:
+                self.webserver.control_datachannel_log(error)
+                raise Exception(error)
+
+    def check_arm_ready(self):
         for side in ["left", "right"]:
-            if Tcamgoal[side] is not None:
-                if self.Tcamgoal_last[side] is None:
-                    self.Tcamgoal_last[side] = Tcamgoal[side]
+            if self.Tcamgoal_last[side] is None:
+                return f"Connect capture and making sure {side} are in the camera view!"
 
-                if self.percise_mode:
-                    # low_pass_coff = 0.1
-                    # Tcamgoal[side] = pt.transform_from_pq(pt.pq_slerp(
-                    #     pt.pq_from_transform(self.Tcamgoal_last[side]),
-                    #     pt.pq_from_transform(Tcamgoal[side]),
-                    #     low_pass_coff
-                    # ))
-
-                    # trust for sensor read (in this case, opencv on web client)
-                    p_low_pass_coff = 0.1
-                    q_low_pass_coff = 0.1
-                    pq_camgoal_last = pt.pq_from_transform(self.Tcamgoal_last[side])
-                    pq_camgoal = pt.pq_from_transform(Tcamgoal[side])
-                    p = pq_camgoal_last[:3] * (1 - p_low_pass_coff) + pq_camgoal[:3] * p_low_pass_coff
-                    q = pr.quaternion_slerp(pq_camgoal_last[3:], pq_camgoal[3:], q_low_pass_coff, shortest_path=True)
-                    Tcamgoal[side] = pt.transform_from_pq(np.concatenate([p, q]))
-
-                self.Tcamgoal_last[side] = Tcamgoal[side]
-
-        if self.teleop_mode is not None:
-            for side in ["left", "right"]:
-                if self.Tcamgoal_last[side] is None:
-                    self.webserver.control_datachannel_log(f"Connect capture and making sure {side} are in the camera view!")
-                    raise Exception(f"Connect capture and making sure {side} are in the camera view!")
+        for side in ["left", "right"]:
+            if self.Tscam[side] is None:
+                return f"Reset {side} arm first!"
+
+    def goal_poses(self, t):
+        # Tcamgoal_last, in percise mode predicted by the pose filter to the command time t
+        Tcamgoal = dict(self.Tcamgoal_last)
+        T = self.pose_filter.predict(t) if self.percise_mode else None
+        if T is not None:
+            for i, side in enumerate(["left", "right"]):
+                if self.pose_filter.initialized[i]:
+                    Tcamgoal[side] = T[i]
+        return Tcamgoal
+
+    def publish_arm(self, t=None):
+        if t is None:
+            t = self.clock()
+        Tcamgoal = self.goal_poses(t)
+        t0 = time.perf_counter()
+        for side in ["left", "right"]:
+        # for side in ["left"]:
+            Tsgoal = self.Tscam[side] @ Tcamgoal[side]
+            self.on_pub_goal(side, Tsgoal, Tscam=self.Tscam[side], Tsgoal_inactive=Tsgoal)
+        metrics.observe("publish_seconds", time.perf_counter() - t0, callback="on_pub_goal")
+        if self.pose_capture_time is not None:
+            # once per pose, the control loop publishes the same pose until the next one
+            metrics.observe("hand_to_command_seconds", time.time() - self.pose_capture_time)
+            self.pose_capture_time = None
+    
+        if self.far_seeing:
+            self.on_pub_head(0, FAR_SEEING_HEAD_TILT)
+        else:
+            self.on_pub_head(0, self.get_head_tilt(self.lift_distance))
 
-            for side in ["left", "right"]:
-                if self.Tscam[side] is None:
-                    self.webserver.control_datachannel_log(f"Reset {side} arm first!")
-                    raise Exception(f"Reset {side} arm first!")
-            
-            for side in ["left", "right"]:
-            # for side in ["left"]:
-                Tsgoal = self.Tscam[side] @ self.Tcamgoal_last[side]
-                self.on_pub_goal(side, Tsgoal, Tscam=self.Tscam[side], Tsgoal_inactive=Tsgoal)
-        
-            if self.far_seeing:
-                self.on_pub_head(0, FAR_SEEING_HEAD_TILT)
-            else:
-                self.on_pub_head(0, self.get_head_tilt(self.lift_distance))
-        
     def pedal_cb(self, pedal_real_values):
+        if self.control_rate is None:
+            TIME_DELTA = 0.1 # nominal pedal message interval
+            with self.lock:
+                self.apply_pedal(pedal_real_values, TIME_DELTA)
+        else:
+            # applied by control_tick
+            self.pedal_values = pedal_real_values
+            self.pedal_time = time.monotonic()
+
+    def control_tick(self, dt):
+        # the check, the lift and the publish see the same poses
+        with self.lock:
+            self.control_step(dt)
+
+    def control_step(self, dt):
+        error = self.check_arm_ready() if self.teleop_mode is not None else None
+        if error != self.control_error:
+            # reported once, not on every tick
+            self.control_error = error
+            if error is not None:
+                logger.warning(error)
+                self.webserver.control_datachannel_log(error)
+
+        pedal_fresh = self.pedal_values is not None and time.monotonic() - self.pedal_time < PEDAL_TIMEOUT
+        applied = pedal_fresh and not (self.teleop_mode == "arm" and error is not None)
+        if applied:
+            self.apply_pedal(self.pedal_values, dt)
+        driving = applied and self.teleop_mode == "base"
+        if self.driving and not driving:
+            # pedal stream stale, or mode changed: stop the base once, it keeps the last velocity otherwise
+            self.on_cmd_vel(0.0, 0.0)
+        self.driving = driving
+
+        if self.teleop_mode is not None and error is None:
+            self.publish_arm(self.clock()) # predicted to this tick
+
+    def apply_pedal(self, pedal_real_values, dt):
         pedal_names = ["angular-pos", "angular-neg", "linear-neg", "linear-pos"]
         pedal_names_arm_mode = ["left-gripper", "lift-neg", "lift-pos", "right-gripper"]
         non_sensetive_area = 0.1
@@ -206,20 +359,25 @@ class Teleopoperator:
             LIFT_VEL_MAX = 0.5
             lift_vel = (values["lift-pos"] - values["lift-neg"]) * LIFT_VEL_MAX
 
-            TIME_DELTA = 0.1 # TODO Better solution
-            change = lift_vel * TIME_DELTA
+            change = lift_vel * dt
 
             LIFT_DISTANCE_MIN = 0
             LIFT_DISTANCE_MAX = 1.2
+            now = time.monotonic()
+            log = now - self.last_lift_log_time > LIFT_LOG_INTERVAL # the control loop runs much faster than a log is readable
             if self.lift_distance + change < LIFT_DISTANCE_MIN or self.lift_distance + change > LIFT_DISTANCE_MAX:
-                logger.warn("Lift Over Limit")
-                self.webserver.control_datachannel_log("Lift Over Limit")
+                if log:
+                    self.last_lift_log_time = now
+                    logger.warning("Lift Over Limit")
+                    self.webserver.control_datachannel_log("Lift Over Limit")
             elif change:
                 self.Tscam["left"][2,3] += change
                 self.Tscam["right"][2,3] += change
                 self.lift_distance += change
-                logger.info(f"Lift Distance: {self.lift_distance:.3f}")
-                self.webserver.control_datachannel_log(f"Lift Distance: {self.lift_distance:.3f}")
+                if log:
+                    self.last_lift_log_time = now
+                    logger.info(f"Lift Distance: {self.lift_distance:.3f}")
+                self.webserver.publish_state(lift_distance=round(self.lift_distance, 3))
             
             gripper_pos = {}
             for side in ["left", "right"]:
@@ -231,13 +389,13 @@ class Teleopoperator:
                     self.gripper_lock[side] = 'ready_to_unlock'
 
                     logger.info(f"{side.capitalize()} Gripper Lock: Locked (Ready to Unlock)")
-                    self.webserver.control_datachannel_log(f"{side.capitalize()} Gripper Lock: Locked (Ready to Unlock)")
+                    self.webserver.publish_state(**{ f"gripper_lock_{side}": self.gripper_lock_state(side) })
 
             for side in ["left", "right"]:
                 if self.gripper_lock[side] == 'ready_to_unlock' and gripper_pos[side] <= self.last_gripper_pos[side]:
                     self.gripper_lock[side] = False
                     logger.info(f"{side.capitalize()} Gripper Lock: Unlocked")
-                    self.webserver.control_datachannel_log(f"{side.capitalize()} Gripper Lock: Unlocked")
+                    self.webserver.publish_state(**{ f"gripper_lock_{side}": self.gripper_lock_state(side) })
 
             # Update last gripper pos if not locked
             for side in ["left", "right"]:
@@ -311,10 +469,12 @@ class Teleopoperator:
             self.gripper_lock["left"] = True
             logger.info("Left Gripper Lock: Locked, release your pedal to unlock")
             self.webserver.control_datachannel_log("Left Gripper Lock: Locked, release your pedal to unlock")
+            self.webserver.publish_state(gripper_lock_left=self.gripper_lock_state("left"))
         elif control_type == "gripper_lock_right":
             self.gripper_lock["right"] = True
             logger.info("Right Gripper Lock: Locked, release your pedal to unlock")
             self.webserver.control_datachannel_log("Right Gripper Lock: Locked, release your pedal to unlock")
+            self.webserver.publish_state(gripper_lock_right=self.gripper_lock_state("right"))
             
     def error_cb(self, msg):
-        self.webserver.loop.call_soon_threadsafe(self.webserver.control_datachannel_log, msg)
+        self.webserver.control_datachannel_log(msg)
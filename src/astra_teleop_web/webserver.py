@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import json
 from pathlib import Path
 import subprocess
@@ -13,52 +14,522 @@ import av.video
 import fractions
 import ssl
 import threading
-import queue
 import time
 import os
+import uuid
 from typing import Union
-import cv2
 import logging
 import numpy as np
 
+from astra_teleop_web import wire
+from astra_teleop_web.adaptation import AdaptationController
+from astra_teleop_web.assets import StaticAssets
+from astra_teleop_web.capture import CameraConfig, CaptureManager
+from astra_teleop_web.detect import ServerSideDetector, parse_intrinsics
+from astra_teleop_web.dispatch import DEFAULT_POLICY, Dispatcher
+from astra_teleop_web.encoding import EncoderConfig, TrackEncoder, aiortc_internals, create_codec, set_sender_encoder
+from astra_teleop_web.metrics import Histogram, metrics
+from astra_teleop_web.recording import KIND_CONTROL, KIND_HAND, KIND_PEDAL, SessionRecorder
+from astra_teleop_web.shm import PIXEL_FORMATS, SharedFrameRing, feed_shared_memory
+from astra_teleop_web.telemetry import TelemetryPublisher
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Bounded FIFO, when full the oldest value is overwritten (maxlen=1 holds only the newest).
+# `put` can be called from any thread, the waiting `get` is woken up through the event
+# loop directly instead of parking an executor thread.
+class FeedQueue:
+    def __init__(self, maxlen=1):
+        self.q = collections.deque(maxlen=maxlen) # append / popleft are atomic, so no lock needed
+        self.loop = None
+        self.event = None
+        self.waiting = False
+
+    def put(self, value):
+        self.q.append(value) # overwrites the old one, if any
+        if self.waiting:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def pending(self):
+        return len(self.q)
+
+    def clear(self):
+        self.q.clear()
+
+    async def get(self):
+        if self.event is None:
+            self.loop = asyncio.get_running_loop()
+            self.event = asyncio.Event()
+        # waiting is set before the deque is checked, so a put in between always sets the event
+        self.waiting = True
+        try:
+            while True:
+                self.event.clear()
+                try:
+                    return self.q.popleft()
+                except IndexError:
+                    pass
+                await self.event.wait()
+        finally:
+            self.waiting = False
+
+SHM_POLL_INTERVAL = 0.002
+SHM_ATTACH_INTERVAL = 1
+SHM_STALL_TIMEOUT = 2 # s without frames before checking whether the producer recreated the segment
+MAX_FRAME_AGE = 0.25 # s
+STALE_LOG_INTERVAL = 5 # s
+# what a malformed frame raises on the way into a track (wrong pixel format, shape or dtype)
+FEED_ERRORS = (ValueError, TypeError, IndexError, AttributeError, av.FFmpegError)
+
 class FeedableVideoStreamTrack(aiortc.mediastreams.MediaStreamTrack):
     kind = 'video'
 
-    def __init__(self):
+    def __init__(self, shm_name=None, name=None, fps=None, max_frame_age=MAX_FRAME_AGE):
         super().__init__()
+        self.name = name # for metrics
         self.VIDEO_CLOCK_RATE = 90000
-        self.q = queue.LifoQueue(maxsize=1)
-        self.last_time = time.time()
+        self.slot = FeedQueue()
+
+        # frames older than this when recv gets them (e.g. fed while the encoder was stuck) are
+        # dropped instead of being shown, None to send them anyway
+        self.max_frame_age = max_frame_age
+        self.frames_stale = 0
+        self.last_stale_log_time = 0
+        self.frame_age = Histogram()
+
+        # target frame rate, frames are paced by their capture time
+        self.fps = fps
+        self.next_capture_time = None
+        self.last_pts = 0
+
+        # read from a shared memory ring written by another process instead of feed()
+        self.shm_name = shm_name
+        self.ring = None
+        self.ring_seq = 0
+        self.ring_progress_time = 0
+
+        self.frames_fed = 0
+        self.frames_sent = 0
+
+        # set by AdaptationController
+        self.scale = 1.0
+        self.max_fps = None
+
+    @property
+    def frames_dropped(self):
+        # frames overwritten before recv got them
+        return self.frames_fed - self.frames_sent - self.slot.pending()
+
+    def stats(self):
+        return {
+            "frames_fed": self.frames_fed,
+            "frames_dropped": self.frames_dropped,
+            "frames_stale": self.frames_stale,
+            "frames_sent": self.frames_sent,
+            "frame_age_ms": {
+                "p50": None if self.frame_age.count == 0 else self.frame_age.quantile(0.5) * 1000,
+                "p95": None if self.frame_age.count == 0 else self.frame_age.quantile(0.95) * 1000,
+            },
+        }
+
+    async def recv_shared_memory(self):
+        while True:
+            if self.ring is None:
+                try:
+                    self.ring = SharedFrameRing.attach(self.shm_name)
+                except FileNotFoundError:
+                    logger.debug(f"waiting for shared memory {self.shm_name}")
+                    await asyncio.sleep(SHM_ATTACH_INTERVAL)
+                    continue
+                self.ring_seq = self.ring.latest_seq()
+                self.ring_progress_time = time.monotonic()
+
+            seq = self.ring.latest_seq()
+            if seq == self.ring_seq:
+                now = time.monotonic()
+                if now - self.ring_progress_time > SHM_STALL_TIMEOUT:
+                    self.ring_progress_time = now
+                    try:
+                        replaced = self.ring.replaced()
+                    except FileNotFoundError:
+                        replaced = False # stopped, or not created again yet
+                    if replaced:
+                        logger.info(f"shared memory {self.shm_name} was recreated, reattaching")
+                        self.ring.close()
+                        self.ring = None
+                        continue
+                await asyncio.sleep(SHM_POLL_INTERVAL)
+                continue
+            self.frames_fed += seq - self.ring_seq
+            self.ring_seq = seq
+            self.ring_progress_time = time.monotonic()
+
+            image_with_timestamp = self.ring.view(seq)
+            if image_with_timestamp is None:
+                continue
+            image, timestamp_ns = image_with_timestamp
+            frame = av.video.VideoFrame.from_ndarray(image, format=self.ring.pixel_format) # the only copy, out of shared memory
+            if not self.ring.valid(seq):
+                logger.debug('frame overwritten while reading')
+                continue
+            return frame, int(timestamp_ns / 1000000000), int(timestamp_ns % 1000000000)
 
     async def recv(self) -> Union[av.frame.Frame, av.packet.Packet]:
         if self.readyState != "live":
             raise aiortc.mediastreams.MediaStreamError
         
-        image_with_timestamp = await asyncio.get_running_loop().run_in_executor(None, self.q.get)
-        self.q.task_done()
-        image, timestamp_sec, timestamp_nsec = image_with_timestamp
-        frame = av.video.VideoFrame.from_ndarray(image) # shape: (height, width, channel) dtype: np.uint8 [0,255]
+        while True:
+            if self.shm_name is not None:
+                frame, timestamp_sec, timestamp_nsec = await self.recv_shared_memory()
+            else:
+                image_with_timestamp = await self.slot.get()
+                image, timestamp_sec, timestamp_nsec, pixel_format = image_with_timestamp
+                frame = None
 
-        frame.pts = int((timestamp_sec + timestamp_nsec / 1000000000) * self.VIDEO_CLOCK_RATE)
+            # Capture timestamps are wall clock (they come from drivers and other processes), only the
+            # age is taken from it. Capture time on the monotonic clock, for pacing and pts, can not
+            # jump with the wall clock.
+            age = time.time() - (timestamp_sec + timestamp_nsec / 1000000000)
+            capture_time = time.monotonic() - age
+
+            if self.max_frame_age is not None and age > self.max_frame_age:
+                self.frames_stale += 1
+                if self.name is not None:
+                    metrics.inc("stale_frames_total", track=self.name)
+                if capture_time - self.last_stale_log_time > STALE_LOG_INTERVAL:
+                    self.last_stale_log_time = capture_time
+                    logger.warning(f"Video {self.name}: dropping stale frames ({age * 1000:.0f}ms old)")
+                continue
+
+            # skip frames to lower the frame rate, paced on a grid of capture times (with a quarter
+            # period of tolerance), so the jitter of a camera running at the target rate drops nothing
+            rates = [rate for rate in [self.fps, self.max_fps] if rate is not None]
+            if rates:
+                period = 1 / min(rates)
+                if self.next_capture_time is not None and capture_time < self.next_capture_time - period / 4:
+                    continue
+                self.next_capture_time = max((self.next_capture_time or 0) + period, capture_time + period * 3 / 4)
+            break
+
+        if frame is None:
+            # rgb24 / bgr24 shape: (height, width, channel), yuv420p / nv12 shape: (height * 3 / 2, width)
+            # dtype: np.uint8 [0,255]
+            frame = av.video.VideoFrame.from_ndarray(image, format=pixel_format)
+
+        if self.scale != 1.0:
+            # scaled and converted to the encoder format in one pass
+            frame = frame.reformat(
+                width=int(frame.width * self.scale) // 2 * 2,
+                height=int(frame.height * self.scale) // 2 * 2,
+                format="yuv420p",
+            )
+
+        self.last_pts = max(int(capture_time * self.VIDEO_CLOCK_RATE), self.last_pts + 1)
+        frame.pts = self.last_pts
         frame.time_base = fractions.Fraction(1, self.VIDEO_CLOCK_RATE)
 
+        self.frame_age.observe(age)
+        if self.name is not None:
+            metrics.observe("frame_age_seconds", age, track=self.name)
+
+        self.frames_sent += 1
         return frame
     
     def feed(self, image_with_timestamp):
-        try:
-            self.q.put_nowait(image_with_timestamp)
-        except queue.Full:
-            try:
-                self.q.get_nowait()
-                self.q.task_done()
-                logger.debug('lost one image')
-            except queue.Empty:
-                logger.debug('times fly!')
-                pass
-            self.q.put_nowait(image_with_timestamp) # Should not throw any error
+        # (image, timestamp_sec, timestamp_nsec[, pixel_format]), pixel_format defaults to rgb24
+        if len(image_with_timestamp) == 3:
+            image_with_timestamp = (*image_with_timestamp, "rgb24")
+        elif image_with_timestamp[3] not in PIXEL_FORMATS:
+            raise ValueError(f"Unsupported pixel format {image_with_timestamp[3]}")
+        self.frames_fed += 1
+        self.slot.put(image_with_timestamp)
+
+    def stop(self):
+        super().stop()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+# Video track fed with already encoded packets (H.264 Annex B from UVC cameras),
+# which are packetized by aiortc without decode / re-encode.
+class FeedablePacketStreamTrack(aiortc.mediastreams.MediaStreamTrack):
+    kind = 'video'
+
+    def __init__(self, maxsize=30):
+        super().__init__()
+        self.VIDEO_CLOCK_RATE = 90000
+        # Unlike raw frames, encoded packets depend on each other, so we can not just keep the latest one
+        self.maxsize = maxsize
+        self.q = FeedQueue(maxlen=maxsize)
+        self.wait_keyframe = True
+
+    async def recv(self) -> Union[av.frame.Frame, av.packet.Packet]:
+        if self.readyState != "live":
+            raise aiortc.mediastreams.MediaStreamError
+
+        packet_with_timestamp = await self.q.get()
+        packet, timestamp_sec, timestamp_nsec = packet_with_timestamp
+
+        packet.pts = int((timestamp_sec + timestamp_nsec / 1000000000) * self.VIDEO_CLOCK_RATE)
+        packet.time_base = fractions.Fraction(1, self.VIDEO_CLOCK_RATE)
+
+        return packet
+
+    def restart(self):
+        # for a new receiver, which can only start decoding at a keyframe
+        self.q.clear()
+        self.wait_keyframe = True
+
+    def feed(self, packet_with_timestamp):
+        packet = packet_with_timestamp[0]
+        if self.wait_keyframe:
+            if not packet.is_keyframe:
+                logger.debug('waiting for keyframe')
+                return
+            self.wait_keyframe = False
+        if self.q.pending() >= self.maxsize:
+            # Decoder can not recover from a hole in the stream until next keyframe
+            logger.debug('lost packets, flush until next keyframe')
+            self.q.clear()
+            if not packet.is_keyframe:
+                self.wait_keyframe = True
+                return
+        self.q.put(packet_with_timestamp)
+
+# Where every camera goes in the mosaic: name -> (x, y, width, height), scaled to fit.
+# Chroma of yuv420p is subsampled by 2, so tiles are placed on even pixels.
+class MosaicLayout:
+    def __init__(self, width, height, tiles):
+        if width % 2 or height % 4:
+            raise ValueError(f"Mosaic size {width}x{height} must have an even width and a height divisible by 4")
+        for name, (x, y, tile_width, tile_height) in tiles.items():
+            if x % 2 or y % 2 or tile_width % 2 or tile_height % 2:
+                raise ValueError(f"Tile {name} must be placed and sized on even pixels")
+            if x < 0 or y < 0 or x + tile_width > width or y + tile_height > height:
+                raise ValueError(f"Tile {name} is out of the mosaic")
+        self.width = width
+        self.height = height
+        self.tiles = tiles
+
+    @classmethod
+    def stacked(cls, width=640, height=360, head_scale=1.0, wrist_scale=0.5):
+        # head on top, the wrists side by side below it (width / height of the cameras)
+        def size(scale):
+            return int(width * scale) // 2 * 2, int(height * scale) // 2 * 2
+        head_width, head_height = size(head_scale)
+        wrist_width, wrist_height = size(wrist_scale)
+        return cls(
+            max(head_width, 2 * wrist_width),
+            (head_height + wrist_height + 3) // 4 * 4,
+            {
+                "head": (0, 0, head_width, head_height),
+                "wrist_left": (0, head_height, wrist_width, wrist_height),
+                "wrist_right": (wrist_width, head_height, wrist_width, wrist_height),
+            },
+        )
+
+    def to_json(self):
+        return { "width": self.width, "height": self.height, "tiles": { name: list(tile) for name, tile in self.tiles.items() } }
+
+# Tiles all cameras into one video track, so there is one encoder / RTP stream / jitter buffer
+# and the views can not drift apart. Fed frames are scaled into their tile of a preallocated
+# yuv420p buffer on the feeding thread, recv() sends the buffer when a tile was updated
+# (at most `fps` times a second).
+class MosaicTrack(aiortc.mediastreams.MediaStreamTrack):
+    kind = 'video'
+
+    def __init__(self, layout, fps=30):
+        super().__init__()
+        self.layout = layout
+        self.fps = fps
+        self.VIDEO_CLOCK_RATE = 90000
+        self.lock = threading.Lock()
+        self.updated = FeedQueue()
+
+        width, height = layout.width, layout.height
+        self.buffer = np.empty((height * 3 // 2, width), dtype=np.uint8)
+        self.buffer[:height] = 16 # black
+        self.buffer[height:] = 128
+        y_plane = self.buffer[:height]
+        u_plane = self.buffer[height:height + height // 4].reshape(height // 2, width // 2)
+        v_plane = self.buffer[height + height // 4:].reshape(height // 2, width // 2)
+        self.planes = {} # name -> views of the tile in the Y, U, V planes
+        for name, (x, y, tile_width, tile_height) in layout.tiles.items():
+            self.planes[name] = (
+                y_plane[y:y + tile_height, x:x + tile_width],
+                u_plane[y // 2:(y + tile_height) // 2, x // 2:(x + tile_width) // 2],
+                v_plane[y // 2:(y + tile_height) // 2, x // 2:(x + tile_width) // 2],
+            )
+        self.timestamps = { name: None for name in layout.tiles } # capture time of the tile, s
+        self.pending = { name: False for name in layout.tiles }
+
+        self.frames_fed = 0
+        self.frames_dropped = 0 # tiles overwritten before they were sent
+        self.frames_sent = 0
+
+        # set by AdaptationController
+        self.scale = 1.0
+        self.max_fps = None
+        self.last_sent_time = 0
+        self.last_pts = 0
+
+    def stats(self):
+        return {
+            "frames_fed": self.frames_fed,
+            "frames_dropped": self.frames_dropped,
+            "frames_sent": self.frames_sent,
+        }
+
+    def feed(self, name, image_with_timestamp):
+        if name not in self.planes:
+            return
+        image, timestamp_sec, timestamp_nsec = image_with_timestamp[:3]
+        pixel_format = image_with_timestamp[3] if len(image_with_timestamp) > 3 else "rgb24"
+        if pixel_format not in PIXEL_FORMATS:
+            raise ValueError(f"Unsupported pixel format {pixel_format}")
+
+        y_tile, u_tile, v_tile = self.planes[name]
+        tile_height, tile_width = y_tile.shape
+        # scaled and converted in one pass
+        frame = av.video.VideoFrame.from_ndarray(image, format=pixel_format).reformat(width=tile_width, height=tile_height, format="yuv420p")
+        yuv = frame.to_ndarray()
+
+        with self.lock:
+            y_tile[:] = yuv[:tile_height]
+            u_tile[:] = yuv[tile_height:tile_height + tile_height // 4].reshape(tile_height // 2, tile_width // 2)
+            v_tile[:] = yuv[tile_height + tile_height // 4:].reshape(tile_height // 2, tile_width // 2)
+            self.timestamps[name] = timestamp_sec + timestamp_nsec / 1000000000
+            self.frames_fed += 1
+            self.frames_dropped += self.pending[name]
+            self.pending[name] = True
+        self.updated.put(True)
+
+    async def recv(self) -> Union[av.frame.Frame, av.packet.Packet]:
+        if self.readyState != "live":
+            raise aiortc.mediastreams.MediaStreamError
+
+        await self.updated.get()
+        # tiles updated in the meantime go out in the same frame (with some tolerance for capture jitter)
+        fps = self.fps if self.max_fps is None else min(self.fps, self.max_fps)
+        wait = self.last_sent_time + 0.9 / fps - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self.updated.clear()
+        self.last_sent_time = time.monotonic()
+
+        with self.lock:
+            frame = av.video.VideoFrame.from_ndarray(self.buffer, format="yuv420p")
+            timestamps = { name: t for name, t in self.timestamps.items() if t is not None }
+            self.pending = { name: False for name in self.pending }
+
+        if self.scale != 1.0:
+            frame = frame.reformat(
+                width=int(frame.width * self.scale) // 2 * 2,
+                height=int(frame.height * self.scale) // 2 * 2,
+            )
+
+        now = time.time()
+        for name, t in timestamps.items():
+            metrics.observe("frame_age_seconds", now - t, track=name)
+
+        # capture time of the newest tile on the monotonic clock, like FeedableVideoStreamTrack,
+        # a tile captured earlier than the others must not move pts back
+        capture_time = time.monotonic() - (now - max(timestamps.values()))
+        self.last_pts = max(int(capture_time * self.VIDEO_CLOCK_RATE), self.last_pts + 1)
+        frame.pts = self.last_pts
+        frame.time_base = fractions.Fraction(1, self.VIDEO_CLOCK_RATE)
+
+        self.frames_sent += 1
+        return frame
+
+def force_codec(transceiver, mime_type):
+    codecs = aiortc.RTCRtpSender.getCapabilities(transceiver.kind).codecs
+    transceiver.setCodecPreferences([codec for codec in codecs if codec.mimeType == mime_type])
+
+# Encodes frames of one camera once and fans the packets out to every observer peer.
+# Each observer has its own FeedablePacketStreamTrack queue, so a slow viewer only
+# drops its own packets (until the next keyframe) without stalling anyone else.
+# For passthrough cameras the fed packets are forwarded without any encoding.
+class EncodedFanout:
+    KEYFRAME_MIN_INTERVAL = 1 # s, limit keyframe requests from joining / lagging observers
+
+    def __init__(self, passthrough=False, shm_name=None, bit_rate=1000000, encoder_config=None, max_frame_age=MAX_FRAME_AGE):
+        self.passthrough = passthrough
+        self.encoder_config = encoder_config if encoder_config is not None else EncoderConfig()
+        self.source = None if passthrough else FeedableVideoStreamTrack(shm_name=shm_name, fps=self.encoder_config.fps, max_frame_age=max_frame_age)
+        self.bit_rate = bit_rate
+        self.codec = None
+        self.subscribers = set()
+        self.task = None
+        self.last_keyframe_time = 0
+
+    def subscribe(self):
+        track = FeedablePacketStreamTrack()
+        self.subscribers.add(track)
+        if not self.passthrough and self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return track
+
+    def unsubscribe(self, track):
+        self.subscribers.discard(track)
+        if not self.subscribers and self.task is not None:
+            self.task.cancel()
+            self.task = None
+            self.codec = None
+
+    def feed(self, image_with_timestamp):
+        if not self.subscribers:
+            return
+        if self.passthrough:
+            self.publish(image_with_timestamp)
+        else:
+            self.source.feed(image_with_timestamp)
+
+    def publish(self, packet_with_timestamp):
+        for track in list(self.subscribers):
+            track.feed(packet_with_timestamp)
+
+    def encode(self, frame, force_keyframe):
+        if self.codec is None or frame.width != self.codec.width or frame.height != self.codec.height:
+            self.codec = create_codec(
+                self.encoder_config, "video/H264", frame.width, frame.height, self.bit_rate, frame.time_base,
+                options={ "x264-params": "repeat-headers=1" }, # observers may join at any keyframe
+            )
+            force_keyframe = True
+
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        frame.pict_type = av.video.frame.PictureType.I if force_keyframe else av.video.frame.PictureType.NONE
+        return self.codec.encode(frame)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            frame = await self.source.recv()
+
+            now = time.monotonic()
+            force_keyframe = False
+            if any(track.wait_keyframe for track in self.subscribers) and now - self.last_keyframe_time > self.KEYFRAME_MIN_INTERVAL:
+                force_keyframe = True
+                self.last_keyframe_time = now
+
+            packets = await loop.run_in_executor(None, self.encode, frame, force_keyframe)
+
+            t = frame.pts * 1000000000 // self.source.VIDEO_CLOCK_RATE
+            for packet in packets:
+                self.publish((packet, int(t / 1000000000), int(t % 1000000000)))
+
+# Delivery of the datachannels (set by the browser when opening them, checked here).
+# A lost hand / pedal message is superseded by the next one anyway, so it is not worth
+# holding newer messages back for a retransmission.
+CHANNEL_QOS = {
+    "hand": { "ordered": False, "maxRetransmits": 0 },
+    "pedal": { "ordered": False, "maxRetransmits": 0 },
+    "control": { "ordered": True, "maxRetransmits": None },
+}
+
+RESUME_TIMEOUT = 10 # s
 
 def asyncio_run_thread_in_new_loop(coroutine):
     loop = asyncio.new_event_loop()
@@ -66,7 +537,44 @@ def asyncio_run_thread_in_new_loop(coroutine):
     loop.run_forever()
 
 class WebServer:
-    def __init__(self):
+    def __init__(self, passthrough=(), shared_memory=None, max_observers=4, adaptive=True, record=None, dispatch_policy=None, encoder=None, mosaic=None, max_frame_age=MAX_FRAME_AGE, resume_timeout=RESUME_TIMEOUT, cert_dir="."):
+        # names of tracks fed with encoded H.264 packets instead of images
+        self.passthrough = set(passthrough)
+        # of cert.pem / key.pem, a self signed pair is generated there if missing
+        self.cert_dir = Path(cert_dir)
+        # track name -> shared memory ring name, for tracks fed by other processes
+        self.shared_memory = shared_memory or {}
+        # read-only viewers, sharing one encode per camera
+        self.max_observers = max_observers
+        self.observer_count = 0
+        # codec preference and encoder settings of the tracks, see encoding.py
+        self.encoder_config = encoder if encoder is not None else EncoderConfig()
+        self.encoders = {}
+        # s, older frames are dropped instead of sent (None to keep them), see FeedableVideoStreamTrack
+        self.max_frame_age = max_frame_age
+        # MosaicLayout, to send all cameras tiled in one track to the operator
+        if mosaic is not None and (self.passthrough or self.shared_memory):
+            raise ValueError("Mosaic mode tiles fed images, passthrough / shared memory tracks can not be used with it")
+        self.mosaic = mosaic
+        self.mosaic_track = None
+        self.last_feed_error_log_time = {} # name -> monotonic s
+        self.fanout = {
+            name: EncodedFanout(passthrough=name in self.passthrough, shm_name=self.shared_memory.get(name), encoder_config=self.encoder_config, max_frame_age=max_frame_age)
+            for name in ["head", "wrist_left", "wrist_right"]
+        }
+        # adapt bitrate / resolution / frame rate of operator tracks to the link
+        self.adaptive = adaptive
+        self.adaptation = None
+        # browser capture camera uploaded for ArUco detection on server, instead of in the browser
+        self.detector = None
+        # s, latency summary sent on the control channel
+        self.metrics_interval = 10
+        # path of a session log, see recording.py, or a SessionRecorder for another frame interval,
+        # e.g. SessionRecorder(path, frame_interval=0) to record every frame
+        if record is not None and not isinstance(record, SessionRecorder):
+            record = SessionRecorder(record)
+        self.recorder = record
+
         self.track = {
             "head": None,
             "wrist_left": None,
@@ -76,30 +584,69 @@ class WebServer:
         self.datachannel = {
             "control": None,
         }
+        # status texts and UI state for the operator page, batched, see telemetry.py
+        self.telemetry = TelemetryPublisher(self.control_datachannel_send)
         
         self.on_hand = None
         self.on_pedal = None
         self.on_control = None
 
+        # operator session, kept for resume_timeout after the connection is lost, see offer
+        self.session = None
+        self.session_lost_time = None
+        self.session_expiry = None
+        self.resume_timeout = resume_timeout
+
+        # drops hand / pedal messages overtaken on the unordered channels
+        self.seq_filter = { "hand": wire.SequenceFilter(), "pedal": wire.SequenceFilter() }
+        # camera intrinsics registered by the operator page, kept across sessions (ids stay valid on reconnects)
+        self.calibrations = wire.CalibrationCache()
+
+        # callbacks run off the event loop, see dispatch.py
+        dispatch_policy = { **DEFAULT_POLICY, **(dispatch_policy or {}) }
+        self.dispatch = {
+            "hand": Dispatcher("hand", self.call_hand, policy=dispatch_policy["hand"]),
+            "pedal": Dispatcher("pedal", self.call_pedal, policy=dispatch_policy["pedal"]),
+            "control": Dispatcher("control", self.call_control, policy=dispatch_policy["control"]),
+        }
+
         self.t = threading.Thread(target=asyncio_run_thread_in_new_loop, args=(self.run_server(), ), daemon=True)
         self.t.start()
 
     async def run_server(self):
         self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.current_thread()
+        for dispatcher in self.dispatch.values():
+            dispatcher.start()
         self.app = aiohttp.web.Application()
 
         self.pc: dict[str, aiortc.RTCPeerConnection] = {}
 
         async def on_shutdown(app):
             # close peer connections
-            await asyncio.gather(*[pc.close() for pc in self.pc])
+            await asyncio.gather(*[pc.close() for pc in self.pc.values()])
             self.pc.clear()
+            if self.recorder is not None:
+                self.recorder.close()
         self.app.on_shutdown.append(on_shutdown)
 
         self.app.router.add_post("/offer", self.offer)
 
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        self.app.router.add_static('/', os.path.join(script_dir, 'static'), show_index=True, )
+        async def metrics_handler(request):
+            return aiohttp.web.Response(text=metrics.render(), content_type="text/plain")
+        self.app.router.add_get("/metrics", metrics_handler)
+
+        async def report_metrics():
+            while True:
+                await asyncio.sleep(self.metrics_interval)
+                self.control_datachannel_log({ "type": "metrics", "summary": metrics.summary() })
+        self.metrics_task = asyncio.create_task(report_metrics())
+        self.telemetry.start()
+
+        # precompressed, cached by ETag / content hash, see assets.py
+        self.static_assets = StaticAssets()
+        await self.loop.run_in_executor(None, self.static_assets.preload)
+        self.static_assets.add_routes(self.app)
         
         async def on_prepare(request, response):
             response.headers['Cross-Origin-Opener-Policy'] = 'same-origin'
@@ -109,14 +656,14 @@ class WebServer:
         # aiohttp.web.run_self.app(self.app, host="0.0.0.0", port=8088, loop=asyncio.get_event_loop())
         # See: https://github.com/aiortc/aiortc/issues/1116
 
-        if not Path("cert.pem").exists():
+        if not (self.cert_dir / "cert.pem").exists():
             logger.info("generating certs")
             subprocess.check_call(
                 "openssl req -x509 -newkey rsa:4096 -keyout key.pem -out cert.pem -sha256 -days 3650 -nodes -subj '/CN=astra-teleop-web'",
-                shell=True
+                shell=True, cwd=self.cert_dir
             )
         ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        ssl_context.load_cert_chain('cert.pem', 'key.pem')
+        ssl_context.load_cert_chain(self.cert_dir / "cert.pem", self.cert_dir / "key.pem")
 
         runner = aiohttp.web.AppRunner(self.app)
         await runner.setup()
@@ -130,63 +677,288 @@ class WebServer:
         params = await request.json()
 
         offer = aiortc.RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+
+        if params.get("role") == "observer":
+            return await self.offer_observer(offer)
+
+        intrinsics = None
+        if params.get("detect") == "server":
+            # checked before the session is touched, a bad offer does not end the running one
+            try:
+                intrinsics = parse_intrinsics(params.get("camera_matrix"), params.get("distortion_coefficients"))
+            except ValueError as e:
+                raise aiohttp.web.HTTPBadRequest(reason=str(e))
         
+        # A browser reconnecting after a connection blip sends the session it had, which keeps
+        # the tracks, encoders and sequence filters (aiortc can not restart ICE on a peer, so
+        # the session moves to a new one instead).
+        resume = self.session is not None and params.get("session") == self.session
         if 'head' in self.pc:
-            raise aiohttp.web.HTTPBadRequest(reason="Multiple connection! Wait for last connection is done")
+            if not resume:
+                raise aiohttp.web.HTTPBadRequest(reason="Multiple connection! Wait for last connection is done")
+            # the browser gave up on the old connection before we noticed
+            old_pc = self.pc['head']
+            self.session_lost(old_pc)
+            await old_pc.close()
+        if resume:
+            self.session_expiry.cancel()
+            self.session_expiry = None
+            logger.info(f"Resuming session {self.session}")
+        else:
+            if self.session is not None:
+                self.end_session() # the lost one is not coming back
+            self.session = uuid.uuid4().hex
+            for seq_filter in self.seq_filter.values():
+                seq_filter.reset()
 
         self.pc['head'] = pc = aiortc.RTCPeerConnection()
 
+        if intrinsics is not None:
+            # The browser uploads its capture camera and markers are detected here
+            self.detector = ServerSideDetector(
+                *intrinsics,
+                on_hand=lambda *args: self.dispatch["hand"].put(*args, None, None),
+            )
+
+            @pc.on("track")
+            def on_track(track):
+                logger.info("Capture track received, detecting markers on server")
+                if track.kind == "video":
+                    self.detector.start(track)
+
         @pc.on("connectionstatechange")
         async def on_connectionstatechange():
             logger.info("Connection state is %s" % pc.connectionState)
-            if pc.connectionState == "failed":
-                await pc.close()
-
-                del self.pc['head']
-                self.datachannel["control"] = None
-                self.track["head"] = None
-                self.track["wrist_left"] = None
-                self.track["wrist_right"] = None
-            elif pc.connectionState == "closed":
-                del self.pc['head']
-                self.datachannel["control"] = None
-                self.track["head"] = None
-                self.track["wrist_left"] = None
-                self.track["wrist_right"] = None
+            if pc.connectionState == "connected":
+                if self.session_lost_time is not None:
+                    message = f"Session resumed, {(time.monotonic() - self.session_lost_time) * 1000:.0f}ms after the connection was lost"
+                    logger.info(message)
+                    self.control_datachannel_log(message)
+                    self.session_lost_time = None
+                if self.adaptive:
+                    self.adaptation = AdaptationController(
+                        pc,
+                        { "head": self.mosaic_track } if self.mosaic is not None else
+                        { name: track for name, track in self.track.items() if name not in self.passthrough },
+                        log=self.control_datachannel_log,
+                    )
+                    self.adaptation.start()
+            elif pc.connectionState in ["failed", "closed"]:
+                if self.pc.get('head') is pc: # not replaced by a resumed connection yet
+                    self.session_lost(pc)
+                if pc.connectionState == "failed":
+                    await pc.close()
                 
         @pc.on("datachannel")
         def on_datachannel(channel: aiortc.RTCDataChannel):
             logger.info("channel(%s) - %s" % (channel.label, repr("created by remote party")))
+            qos = CHANNEL_QOS.get(channel.label)
+            if qos is not None and (channel.ordered != qos["ordered"] or channel.maxRetransmits != qos["maxRetransmits"]):
+                logger.warning(f"channel({channel.label}) - ordered {channel.ordered}, maxRetransmits {channel.maxRetransmits}, expected {qos}")
+
             if channel.label == "hand":
                 @channel.on("message")
                 async def on_message(msg):
-                    camera_matrix, distortion_coefficients, corners, ids = json.loads(msg)
-                    if self.on_hand:
-                        self.on_hand(camera_matrix, distortion_coefficients, corners, ids)
+                    recv_time = time.time()
+                    if self.recorder is not None:
+                        self.recorder.record_message(KIND_HAND, msg)
+                    try:
+                        camera_matrix, distortion_coefficients, corners, ids, timestamps, seq = wire.parse_hand(msg, self.calibrations)
+                    except KeyError as e:
+                        # e.g. registered with a previous run of the server, the page registers again
+                        logger.warning(f"Unknown calibration {e}, hand message dropped")
+                        self.control_datachannel_log({ "type": "calibration", "id": None })
+                        return
+                    except ValueError as e:
+                        logger.warning(f"Malformed hand message dropped: {e}")
+                        return
+                    if not self.seq_filter["hand"].accept(seq):
+                        metrics.inc("stale_dropped_total", channel="hand")
+                        return
+
+                    capture_time = None
+                    timestamp = None
+                    if timestamps is not None and timestamps[0] > 0:
+                        capture_time, detect_start_time, detect_end_time = [t / 1000 for t in timestamps]
+                        metrics.observe("client_capture_to_detect_seconds", detect_start_time - capture_time)
+                        metrics.observe("client_detect_seconds", detect_end_time - detect_start_time)
+                        metrics.observe("hand_network_seconds", recv_time - detect_end_time)
+                        # the pose filter runs on the capture clock, not on arrival with the network jitter,
+                        # a client clock ahead of ours counts as captured now
+                        timestamp = time.monotonic() - max(time.time() - capture_time, 0)
+
+                    self.dispatch["hand"].put(camera_matrix, distortion_coefficients, corners, ids, capture_time, timestamp)
             elif channel.label == "pedal":
                 @channel.on("message")
                 async def on_message(msg):
-                    pedal_real_values = json.loads(msg)
-                    if self.on_pedal:
-                        self.on_pedal(pedal_real_values)
+                    if self.recorder is not None:
+                        self.recorder.record_message(KIND_PEDAL, msg)
+                    try:
+                        pedal_real_values, seq = wire.parse_pedal(msg)
+                    except ValueError as e:
+                        logger.warning(f"Malformed pedal message dropped: {e}")
+                        return
+                    if not self.seq_filter["pedal"].accept(seq):
+                        metrics.inc("stale_dropped_total", channel="pedal")
+                        return
+                    self.dispatch["pedal"].put(pedal_real_values)
             elif channel.label == "control":
                 self.datachannel["control"] = channel
+                self.telemetry.resend_state()
 
                 @channel.on("message")
                 async def on_message(msg):
+                    if self.recorder is not None:
+                        self.recorder.record_message(KIND_CONTROL, msg)
                     control_type = json.loads(msg)
-                    if self.on_control:
-                        asyncio.create_task(self.on_control(control_type))
+                    if isinstance(control_type, dict) and control_type.get("type") == "stats":
+                        # reported by the browser, not a command
+                        if control_type.get("rtt") is not None:
+                            metrics.observe("client_rtt_seconds", control_type["rtt"])
+                        if control_type.get("recover") is not None:
+                            metrics.observe("session_recover_seconds", control_type["recover"])
+                        return
+                    if isinstance(control_type, dict) and control_type.get("type") == "calibration":
+                        calibration_id = self.calibrations.register(control_type["camera_matrix"], control_type["distortion_coefficients"])
+                        self.control_datachannel_log({ "type": "calibration", "id": calibration_id })
+                        return
+                    if control_type == "cancel":
+                        # not queued behind the command it is meant to stop
+                        if self.dispatch["control"].cancel():
+                            self.control_datachannel_log("Cancelled")
+                        return
+                    self.dispatch["control"].put(control_type)
             else:
                 raise Exception("Unknown label")
 
-        self.track["head"] = FeedableVideoStreamTrack()
-        pc.addTransceiver(self.track["head"], "sendonly") # mid: 0
-        self.track["wrist_left"] = FeedableVideoStreamTrack()
-        pc.addTransceiver(self.track["wrist_left"], "sendonly") # mid: 1
-        self.track["wrist_right"] = FeedableVideoStreamTrack()
-        pc.addTransceiver(self.track["wrist_right"], "sendonly") # mid: 2
+        # tracks of a resumed session are kept, they were fed all along
+        transceivers = {}
+        for name in ["head", "wrist_left", "wrist_right"] if self.mosaic is None else []: # mid: 0, 1, 2
+            if self.track[name] is not None and self.track[name].readyState != "live":
+                self.track[name] = None # stopped with the peer it was on
+            if name in self.passthrough:
+                if self.track[name] is None:
+                    self.track[name] = FeedablePacketStreamTrack()
+                else:
+                    self.track[name].restart()
+                transceiver = pc.addTransceiver(self.track[name], "sendonly")
+                # Packets are forwarded as is, so the browser must accept the camera codec
+                force_codec(transceiver, "video/H264")
+            else:
+                if self.track[name] is None:
+                    self.track[name] = FeedableVideoStreamTrack(
+                        shm_name=self.shared_memory.get(name), name=name,
+                        fps=self.encoder_config.fps, max_frame_age=self.max_frame_age,
+                    )
+                transceivers[name] = transceiver = pc.addTransceiver(self.track[name], "sendonly")
+                if self.encoder_config.codec is not None:
+                    force_codec(transceiver, self.encoder_config.codec)
+        if self.mosaic is not None:
+            # mid: 0, the browser crops the views by the layout sent with the answer
+            if self.mosaic_track is None or self.mosaic_track.readyState != "live":
+                self.mosaic_track = MosaicTrack(self.mosaic)
+            transceivers["mosaic"] = transceiver = pc.addTransceiver(self.mosaic_track, "sendonly")
+            if self.encoder_config.codec is not None:
+                force_codec(transceiver, self.encoder_config.codec)
+
+        extra = { "session": self.session, "resumed": resume }
+        if self.mosaic is not None:
+            extra["mosaic"] = self.mosaic.to_json()
+        response = await self.answer(pc, offer, extra=extra)
+
+        # The codec is negotiated now, and aiortc only creates its own encoder on the first frame.
+        # Encoders of a resumed session are kept when the codec is the same.
+        for name, transceiver in transceivers.items():
+            if not aiortc_internals(transceiver=transceiver):
+                break
+            if not transceiver._codecs:
+                continue
+            mime_type = transceiver._codecs[0].mimeType
+            encoder = self.encoders.get(name)
+            if encoder is None or encoder.mime_type.lower() != mime_type.lower():
+                if encoder is not None:
+                    encoder.close()
+                encoder = self.encoders[name] = TrackEncoder(self.encoder_config, mime_type, name=name)
+            else:
+                encoder.restart()
+            set_sender_encoder(transceiver.sender, encoder)
 
+        return response
+
+    def session_lost(self, pc):
+        # the operator connection is gone, the session is kept for resume_timeout
+        del self.pc['head']
+        # aiortc stops the track of a sender when the sender stops, detached they can be sent again
+        for sender in pc.getSenders():
+            sender.replaceTrack(None)
+        self.datachannel["control"] = None
+        if self.adaptation is not None:
+            self.adaptation.stop()
+            self.adaptation = None
+        if self.detector is not None:
+            self.detector.stop()
+            self.detector = None
+        if self.session is None:
+            return
+        self.session_lost_time = time.monotonic()
+        if self.session_expiry is not None:
+            self.session_expiry.cancel()
+        self.session_expiry = self.loop.call_later(self.resume_timeout, self.end_session)
+        logger.info(f"Operator connection lost, keeping session {self.session} for {self.resume_timeout}s")
+
+    def end_session(self):
+        logger.info(f"Session {self.session} ended")
+        if self.session_expiry is not None:
+            self.session_expiry.cancel()
+            self.session_expiry = None
+        self.session = None
+        self.session_lost_time = None
+        self.track["head"] = None
+        self.track["wrist_left"] = None
+        self.track["wrist_right"] = None
+        self.mosaic_track = None
+        self.close_encoders()
+
+    async def offer_observer(self, offer):
+        if len(self.pc) - ('head' in self.pc) >= self.max_observers:
+            raise aiohttp.web.HTTPBadRequest(reason="Too many observers!")
+
+        self.observer_count += 1
+        key = f"observer_{self.observer_count}"
+        self.pc[key] = pc = aiortc.RTCPeerConnection()
+        tracks = {}
+
+        def cleanup():
+            if key in self.pc:
+                del self.pc[key]
+            for name, track in tracks.items():
+                self.fanout[name].unsubscribe(track)
+                track.stop()
+            tracks.clear()
+
+        @pc.on("connectionstatechange")
+        async def on_connectionstatechange():
+            logger.info("Observer %s connection state is %s" % (key, pc.connectionState))
+            if pc.connectionState == "failed":
+                await pc.close()
+                cleanup()
+            elif pc.connectionState == "closed":
+                cleanup()
+
+        @pc.on("datachannel")
+        def on_datachannel(channel: aiortc.RTCDataChannel):
+            # hand / pedal / control belong to the operator session only
+            logger.warning("channel(%s) - %s" % (channel.label, repr("rejected for observer")))
+            channel.close()
+
+        for name in ["head", "wrist_left", "wrist_right"]: # mid: 0, 1, 2
+            tracks[name] = self.fanout[name].subscribe()
+            transceiver = pc.addTransceiver(tracks[name], "sendonly")
+            force_codec(transceiver, "video/H264")
+
+        return await self.answer(pc, offer)
+
+    async def answer(self, pc, offer, extra=None):
         await pc.setRemoteDescription(offer)
 
         answer = await pc.createAnswer()
@@ -195,77 +967,114 @@ class WebServer:
         return aiohttp.web.Response(
             content_type="application/json",
             text=json.dumps(
-                {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+                {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type, **(extra or {})}
             ),
         )
     
+    def call_hand(self, camera_matrix, distortion_coefficients, corners, ids, capture_time, timestamp):
+        if self.on_hand:
+            # hand_to_command_seconds is observed when the pose is published
+            self.on_hand(camera_matrix, distortion_coefficients, corners, ids, timestamp=timestamp, capture_time=capture_time)
+
+    def call_pedal(self, pedal_real_values):
+        if self.on_pedal:
+            self.on_pedal(pedal_real_values)
+
+    async def call_control(self, control_type):
+        if self.on_control:
+            await self.on_control(control_type)
+
     def control_datachannel_log(self, message):
-        if self.datachannel["control"] is not None:
-            self.datachannel["control"].send(json.dumps(message))
-    
-    def track_feed(self, name, image_with_timestamp):
-        if self.track[name] is not None:
-            try:
-                self.track[name].feed(image_with_timestamp)
-            except:
-                pass
+        # any thread, texts are batched and rate limited by the telemetry publisher
+        if isinstance(message, str):
+            self.telemetry.log(message)
+        else:
+            self.control_datachannel_send(message)
 
-def feed_webserver(webserver, device):
-    cam = cv2.VideoCapture(f"/dev/video_{device}", cv2.CAP_V4L2)
-    cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    def publish_state(self, **values):
+        # any thread, e.g. publish_state(teleop_mode="Arm"), shown by the operator page
+        self.telemetry.state(**values)
 
-    fourcc_value = cv2.VideoWriter_fourcc(*'MJPG')
+    def control_datachannel_send(self, message):
+        if self.datachannel["control"] is None:
+            return
+        if threading.current_thread() is not self.loop_thread:
+            # from a dispatch thread, the datachannel is not thread safe
+            self.loop.call_soon_threadsafe(self.control_datachannel_send, message)
+            return
+        if self.datachannel["control"].readyState != "open":
+            return
+        self.datachannel["control"].send(json.dumps(message))
+    
+    def track_stats(self):
+        stats = {
+            name: track.stats()
+            for name, track in self.track.items()
+            if track is not None and hasattr(track, "stats")
+        }
+        if self.mosaic_track is not None:
+            stats["mosaic"] = self.mosaic_track.stats()
+        return stats
 
-    image_height = 360
-    image_width = 640
+    def encoder_stats(self):
+        return { name: encoder.stats() for name, encoder in self.encoders.items() }
 
-    image_size = (image_height, image_width)
+    def close_encoders(self):
+        for encoder in self.encoders.values():
+            encoder.close()
+        self.encoders.clear()
 
-    frames_per_second = 30
+    def dispatch_stats(self):
+        return { channel: dispatcher.stats() for channel, dispatcher in self.dispatch.items() }
 
-    cam.set(cv2.CAP_PROP_FOURCC, fourcc_value)
-    cam.set(cv2.CAP_PROP_FRAME_HEIGHT, image_height)
-    cam.set(cv2.CAP_PROP_FRAME_WIDTH, image_width)
-    cam.set(cv2.CAP_PROP_FPS, frames_per_second)
-    
-    while True:
-        ret, color_image = cam.read()
-        image = cv2.cvtColor(color_image, cv2.COLOR_BGR2RGB)
-        assert image.shape[0] == 360 and image.shape[1] == 640
-        try:
-            t = time.time_ns()
-            getattr(webserver, f"track_{device}").feed((image, int(t / 1000000000), int(t % 1000000000)))
-        except:
-            pass
-
-
-def feed_webserver_av(webserver, device):
-    container = av.open(f"/dev/video_{device}", format="v4l2", options={
-        "input_format": "mjpeg",
-        "framerate": "30",
-        "video_size": "640x360",
-    })
-
-    for index, frame in enumerate(container.decode(video=0)):
-        if index % 2 != 0:
-            # FFmpeg have a 256 length size of buffer for v4l2 mmap
-            # Too large for latency
-            # https://github.com/FFmpeg/FFmpeg/blob/66c05dc03163998fb9a90ebd53e2c39a4f95b7ea/libavdevice/v4l2.c#L55
-            continue
-        image = frame.to_rgb().to_ndarray()
-        assert image.shape[0] == 360 and image.shape[1] == 640
+    def track_feed(self, name, image_with_timestamp, pixel_format=None):
+        if pixel_format is not None:
+            image_with_timestamp = (*image_with_timestamp[:3], pixel_format)
+        if self.recorder is not None:
+            try:
+                self.recorder.record_frame(name, image_with_timestamp)
+            except Exception as e:
+                logger.warning(f"Recording frame failed: {e}")
+        # a bad frame of one track does not keep it from the others
+        if self.track[name] is not None:
+            try:
+                self.track[name].feed(image_with_timestamp)
+            except FEED_ERRORS as e:
+                self.feed_failed(name, "track", e)
+        if self.mosaic_track is not None:
+            try:
+                self.mosaic_track.feed(name, image_with_timestamp)
+            except FEED_ERRORS as e:
+                self.feed_failed(name, "mosaic", e)
         try:
-            t = time.time_ns()
-            getattr(webserver, f"track_{device}").feed((image, int(t / 1000000000), int(t % 1000000000)))
-        except:
-            pass
+            self.fanout[name].feed(image_with_timestamp)
+        except FEED_ERRORS as e:
+            self.feed_failed(name, "fanout", e)
+
+    def feed_failed(self, name, target, e):
+        metrics.inc("feed_errors_total", track=name)
+        now = time.monotonic()
+        # called for every frame of the camera, logged now and then
+        if now - self.last_feed_error_log_time.get(name, -STALE_LOG_INTERVAL) > STALE_LOG_INTERVAL:
+            self.last_feed_error_log_time[name] = now
+            logger.warning(f"Feeding {name} to the {target} failed: {e!r}")
 
 if __name__ == '__main__':
-    webserver = WebServer()
-    
-    threading.Thread(target=feed_webserver, args=(webserver, "head"), daemon=True).start()
-    threading.Thread(target=feed_webserver, args=(webserver, "wrist_left"), daemon=True).start()
-    threading.Thread(target=feed_webserver, args=(webserver, "wrist_right"), daemon=True).start()
+    if os.environ.get("ASTRA_TELEOP_WEB_SHM"):
+        # capture in separate processes, frames are passed through shared memory
+        import multiprocessing
+        shm_names = { device: f"astra_teleop_web_{device}" for device in ["head", "wrist_left", "wrist_right"] }
+        for device, name in shm_names.items():
+            multiprocessing.Process(target=feed_shared_memory, args=(name, device), daemon=True).start()
+        webserver = WebServer(shared_memory=shm_names, record=os.environ.get("ASTRA_TELEOP_WEB_RECORD"))
+    else:
+        webserver = WebServer(
+            record=os.environ.get("ASTRA_TELEOP_WEB_RECORD"),
+            mosaic=MosaicLayout.stacked() if os.environ.get("ASTRA_TELEOP_WEB_MOSAIC") else None,
+        )
+
+        capture = CaptureManager(webserver, [CameraConfig(name) for name in ["head", "wrist_left", "wrist_right"]])
+        capture.start()
     
     webserver.on_hand = print
     webserver.on_pedal = print
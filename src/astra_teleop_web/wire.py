@@ -0,0 +1,212 @@
+import json
+import struct
+import numpy as np
+
+# Binary messages of hand / pedal datachannels, all little endian.
+#
+# hand (v3):
+#   header: version (u8), kind (u8) = KIND_HAND, n_markers (u16), n_distortion (u16), seq (u16, padding in v1 / v2)
+#   timestamps (v2+): capture, detect_start, detect_end (f64 * 3, client epoch ms)
+#   camera_matrix: f32 * 9
+#   distortion_coefficients: f32 * n_distortion
+#   ids: i32 * n_markers
+#   corners: f32 * n_markers * 4 * 2
+#
+# hand (v4), intrinsics registered once with a calibration control message (see CalibrationCache):
+#   header: version (u8), kind (u8) = KIND_HAND, n_markers (u16), calibration id (u16), seq (u16)
+#   timestamps, ids, corners as in v3
+#
+# pedal (v2):
+#   header: version (u8), kind (u8) = KIND_PEDAL, n_values (u16), seq (u16, v2 only), padding (2 bytes, v2 only)
+#   values: f32 * n_values
+#
+# Every field is 4 bytes aligned, so np.frombuffer can view them directly.
+# JSON text messages are still accepted as fallback, with seq as the 6th element of
+# hand messages and pedal messages as {"seq": seq, "values": values}.
+#
+# hand / pedal channels are unordered and unreliable, seq (wrapping at 2^16) lets the
+# server drop messages overtaken by newer ones.
+HAND_VERSION = 3
+HAND_CALIBRATION_VERSION = 4
+PEDAL_VERSION = 2
+KIND_HAND = 1
+KIND_PEDAL = 2
+
+HAND_HEADER = struct.Struct("<BBHHH")
+HAND_TIMESTAMPS = struct.Struct("<ddd")
+PEDAL_HEADER_V1 = struct.Struct("<BBH")
+PEDAL_HEADER = struct.Struct("<BBHH2x")
+
+def is_binary(msg):
+    return isinstance(msg, (bytes, bytearray, memoryview))
+
+def check_header(version, kind, expected_kind, versions):
+    if version not in versions:
+        raise ValueError(f"Unsupported wire version {version}")
+    if kind != expected_kind:
+        raise ValueError(f"Unexpected message kind {kind}")
+
+def check_length(msg, length, exact=True):
+    # the sizes in the header must match the message, np.frombuffer would fail on a short one
+    # and read the wrong fields of a long one
+    if len(msg) < length or exact and len(msg) != length:
+        raise ValueError(f"Message length {len(msg)}, expected {length}")
+
+def encode_hand(camera_matrix, distortion_coefficients, corners, ids, timestamps=(0, 0, 0), seq=0):
+    camera_matrix = np.asarray(camera_matrix, dtype="<f4").reshape(9)
+    distortion_coefficients = np.asarray(distortion_coefficients, dtype="<f4").reshape(-1)
+    ids = np.asarray(ids, dtype="<i4").reshape(-1)
+    corners = np.asarray(corners, dtype="<f4").reshape(len(ids), 4, 2)
+    return b"".join([
+        HAND_HEADER.pack(HAND_VERSION, KIND_HAND, len(ids), len(distortion_coefficients), seq & 0xFFFF),
+        HAND_TIMESTAMPS.pack(*timestamps),
+        camera_matrix.tobytes(),
+        distortion_coefficients.tobytes(),
+        ids.tobytes(),
+        corners.tobytes(),
+    ])
+
+def encode_hand_calibrated(calibration_id, corners, ids, timestamps=(0, 0, 0), seq=0):
+    ids = np.asarray(ids, dtype="<i4").reshape(-1)
+    corners = np.asarray(corners, dtype="<f4").reshape(len(ids), 4, 2)
+    return b"".join([
+        HAND_HEADER.pack(HAND_CALIBRATION_VERSION, KIND_HAND, len(ids), calibration_id, seq & 0xFFFF),
+        HAND_TIMESTAMPS.pack(*timestamps),
+        ids.tobytes(),
+        corners.tobytes(),
+    ])
+
+def decode_hand(msg):
+    # Returns camera_matrix (3, 3), distortion_coefficients (1, n), corners (n_markers, 1, 4, 2)
+    # and ids (n_markers, 1), in the same layout as cv2.aruco.
+    # v4 messages carry no intrinsics, camera_matrix and distortion_coefficients are None
+    # (see hand_calibration)
+    check_length(msg, HAND_HEADER.size, exact=False)
+    version, kind, n_markers, n_distortion, _ = HAND_HEADER.unpack_from(msg, 0)
+    check_header(version, kind, KIND_HAND, [1, 2, 3, 4])
+    check_length(msg, HAND_HEADER.size
+        + (HAND_TIMESTAMPS.size if version >= 2 else 0)
+        + ((9 + n_distortion) * 4 if version < 4 else 0)
+        + n_markers * (1 + 4 * 2) * 4)
+    offset = HAND_HEADER.size
+    if version >= 2:
+        offset += HAND_TIMESTAMPS.size
+
+    camera_matrix = distortion_coefficients = None
+    if version < 4:
+        camera_matrix = np.frombuffer(msg, dtype="<f4", count=9, offset=offset).reshape(3, 3)
+        offset += 9 * 4
+        distortion_coefficients = np.frombuffer(msg, dtype="<f4", count=n_distortion, offset=offset).reshape(1, n_distortion)
+        offset += n_distortion * 4
+    ids = np.frombuffer(msg, dtype="<i4", count=n_markers, offset=offset).reshape(n_markers, 1)
+    offset += n_markers * 4
+    corners = np.frombuffer(msg, dtype="<f4", count=n_markers * 8, offset=offset).reshape(n_markers, 1, 4, 2)
+
+    return camera_matrix, distortion_coefficients, corners, ids
+
+def hand_timestamps(msg):
+    # (capture, detect_start, detect_end) in client epoch ms, or None if not sent
+    version = msg[0]
+    if version < 2:
+        return None
+    return HAND_TIMESTAMPS.unpack_from(msg, HAND_HEADER.size)
+
+def hand_seq(msg):
+    if msg[0] < 3:
+        return None
+    return HAND_HEADER.unpack_from(msg, 0)[4]
+
+def hand_calibration(msg):
+    if msg[0] < 4:
+        return None
+    return HAND_HEADER.unpack_from(msg, 0)[3]
+
+def parse_hand(msg, calibrations=None):
+    # binary or JSON message -> (camera_matrix, distortion_coefficients, corners, ids, timestamps or None, seq or None)
+    # With a CalibrationCache, v4 messages get the registered intrinsics and the intrinsics
+    # sent along in older messages are interned, so they are converted once
+    if is_binary(msg):
+        camera_matrix, distortion_coefficients, corners, ids = decode_hand(msg)
+        timestamps, seq = hand_timestamps(msg), hand_seq(msg)
+    else:
+        message = json.loads(msg)
+        camera_matrix, distortion_coefficients, corners, ids = message[:4]
+        timestamps, seq = message[4] if len(message) > 4 else None, message[5] if len(message) > 5 else None
+
+    if camera_matrix is None:
+        if calibrations is None:
+            raise ValueError("Hand message references a calibration, but no calibrations are registered")
+        camera_matrix, distortion_coefficients = calibrations.get(hand_calibration(msg))
+    elif calibrations is not None:
+        camera_matrix, distortion_coefficients = calibrations.get(calibrations.register(camera_matrix, distortion_coefficients))
+    return camera_matrix, distortion_coefficients, corners, ids, timestamps, seq
+
+def encode_pedal(values, seq=0):
+    values = np.asarray(values, dtype="<f4").reshape(-1)
+    return PEDAL_HEADER.pack(PEDAL_VERSION, KIND_PEDAL, len(values), seq & 0xFFFF) + values.tobytes()
+
+def decode_pedal(msg):
+    # -> (values, seq or None)
+    check_length(msg, PEDAL_HEADER_V1.size, exact=False)
+    version, kind, n_values = PEDAL_HEADER_V1.unpack_from(msg, 0)
+    check_header(version, kind, KIND_PEDAL, [1, 2])
+    check_length(msg, (PEDAL_HEADER_V1 if version < 2 else PEDAL_HEADER).size + n_values * 4)
+    if version < 2:
+        return np.frombuffer(msg, dtype="<f4", count=n_values, offset=PEDAL_HEADER_V1.size), None
+    seq = PEDAL_HEADER.unpack_from(msg, 0)[3]
+    return np.frombuffer(msg, dtype="<f4", count=n_values, offset=PEDAL_HEADER.size), seq
+
+def parse_pedal(msg):
+    # -> (values, seq or None)
+    if is_binary(msg):
+        return decode_pedal(msg)
+    message = json.loads(msg)
+    if isinstance(message, dict):
+        return message["values"], message.get("seq")
+    return message, None
+
+# Drops messages that are not newer than the last accepted one (RFC 1982 serial number
+# arithmetic, so seq can wrap), messages without seq always pass
+class SequenceFilter:
+    def __init__(self):
+        self.last = None
+
+    def reset(self):
+        self.last = None
+
+    def accept(self, seq):
+        if seq is None:
+            return True
+        if self.last is not None and not 0 < (seq - self.last) & 0xFFFF < 0x8000:
+            return False
+        self.last = seq
+        return True
+
+# Camera intrinsics by id. The operator page registers its calibration once (a control message
+# {"type": "calibration", "camera_matrix": ..., "distortion_coefficients": ...}, answered with
+# {"type": "calibration", "id": id}) and then sends v4 hand messages referencing the id.
+# Intrinsics are kept as float64 arrays, so the solver gets the same ready-made arrays on every
+# message. Ids are handed out in registration order and the same intrinsics get the same id,
+# so replaying the recorded control messages gives the ids of the recorded session.
+class CalibrationCache:
+    def __init__(self):
+        self.calibrations = [] # (camera_matrix, distortion_coefficients) by id
+        self.ids = {} # intrinsics bytes -> id
+
+    def register(self, camera_matrix, distortion_coefficients):
+        camera_matrix = np.array(camera_matrix, dtype=np.float64).reshape(3, 3)
+        distortion_coefficients = np.array(distortion_coefficients, dtype=np.float64).reshape(1, -1)
+        key = camera_matrix.tobytes() + distortion_coefficients.tobytes()
+        calibration_id = self.ids.get(key)
+        if calibration_id is None:
+            if len(self.calibrations) > 0xFFFF:
+                raise ValueError("Too many calibrations")
+            calibration_id = len(self.calibrations)
+            self.calibrations.append((camera_matrix, distortion_coefficients))
+            self.ids[key] = calibration_id
+        return calibration_id
+
+    def get(self, calibration_id):
+        if calibration_id is None or not 0 <= calibration_id < len(self.calibrations):
+            raise KeyError(calibration_id)
+        return self.calibrations[calibration_id]
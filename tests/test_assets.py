@@ -0,0 +1,154 @@
+import asyncio
+import gzip
+import os
+
+import aiohttp.web
+from aiohttp.test_utils import TestClient, TestServer
+
+from astra_teleop_web import assets
+from astra_teleop_web.assets import IMMUTABLE, REVALIDATE, StaticAssets
+
+APP_JS = b"console.log('app');\n" * 100
+
+def make_static(directory):
+    (directory / "index.html").write_text('<script src="app.js"></script><link href="missing.css" rel="stylesheet">')
+    (directory / "app.js").write_bytes(APP_JS)
+    (directory / "small.txt").write_text("small")
+    (directory.parent / "secret.txt").write_text("secret")
+
+def run(directory, requests):
+    # requests: async function(client, static_assets) with the assets preloaded like the webserver does
+    async def main():
+        static_assets = StaticAssets(directory)
+        await asyncio.get_running_loop().run_in_executor(None, static_assets.preload)
+        app = aiohttp.web.Application()
+        static_assets.add_routes(app)
+        async with TestClient(TestServer(app)) as client:
+            return await requests(client, static_assets)
+    return asyncio.run(main())
+
+def test_preload(tmp_path):
+    static = tmp_path / "static"
+    static.mkdir()
+    make_static(static)
+    (static / "app.js.gz").write_bytes(gzip.compress(APP_JS))
+
+    async def requests(client, static_assets):
+        return set(static_assets.assets)
+    assert run(static, requests) == { "index.html", "app.js", "small.txt" } # variants are not assets of their own
+
+def test_page_references_versioned(tmp_path):
+    static = tmp_path / "static"
+    static.mkdir()
+    make_static(static)
+
+    async def requests(client, static_assets):
+        page = await client.get("/")
+        text = await page.text()
+        version = static_assets.assets["app.js"].version
+        versioned = await client.get(f"/app.js?v={version}")
+        unversioned = await client.get("/app.js")
+        return page, text, version, versioned, unversioned
+
+    page, text, version, versioned, unversioned = run(static, requests)
+    assert page.status == 200
+    assert page.headers["Cache-Control"] == REVALIDATE
+    assert page.headers["Content-Type"].startswith("text/html")
+    assert f'src="app.js?v={version}"' in text
+    assert 'href="missing.css"' in text # not there, left as is
+    assert versioned.headers["Cache-Control"] == IMMUTABLE
+    assert unversioned.headers["Cache-Control"] == REVALIDATE
+
+def test_etag_not_modified(tmp_path):
+    static = tmp_path / "static"
+    static.mkdir()
+    make_static(static)
+
+    async def requests(client, static_assets):
+        first = await client.get("/small.txt")
+        again = await client.get("/small.txt", headers={ "If-None-Match": first.headers["ETag"] })
+        return first, again, await again.read()
+
+    first, again, body = run(static, requests)
+    assert first.status == 200
+    assert again.status == 304
+    assert again.headers["ETag"] == first.headers["ETag"]
+    assert body == b""
+
+def test_precompressed_variant(tmp_path):
+    static = tmp_path / "static"
+    static.mkdir()
+    make_static(static)
+    variant = gzip.compress(APP_JS)
+    (static / "app.js.gz").write_bytes(variant)
+
+    async def requests(client, static_assets):
+        compressed = await client.get("/app.js", headers={ "Accept-Encoding": "gzip" }, auto_decompress=False)
+        identity = await client.get("/app.js", headers={ "Accept-Encoding": "gzip;q=0" })
+        return compressed, await compressed.read(), identity, await identity.read()
+
+    compressed, compressed_body, identity, identity_body = run(static, requests)
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.headers["Vary"] == "Accept-Encoding"
+    assert compressed_body == variant
+    assert "Content-Encoding" not in identity.headers
+    assert identity_body == APP_JS
+    assert compressed.headers["ETag"] != identity.headers["ETag"]
+
+def test_stale_variant_ignored(tmp_path):
+    static = tmp_path / "static"
+    static.mkdir()
+    make_static(static)
+    (static / "app.js.gz").write_bytes(gzip.compress(b"old"))
+    stat = os.stat(static / "app.js")
+    os.utime(static / "app.js.gz", ns=(stat.st_atime_ns, stat.st_mtime_ns - 1000000000))
+
+    async def requests(client, static_assets):
+        response = await client.get("/app.js", headers={ "Accept-Encoding": "gzip" })
+        return response, await response.read()
+
+    response, body = run(static, requests)
+    assert "Content-Encoding" not in response.headers
+    assert body == APP_JS
+
+def test_page_compressed_when_served(tmp_path):
+    static = tmp_path / "static"
+    static.mkdir()
+    make_static(static)
+
+    async def requests(client, static_assets):
+        response = await client.get("/index.html", headers={ "Accept-Encoding": "gzip" }, auto_decompress=False)
+        return response, await response.read()
+
+    response, body = run(static, requests)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert b"app.js?v=" in gzip.decompress(body)
+
+def test_changed_file_reloaded(tmp_path, monkeypatch):
+    static = tmp_path / "static"
+    static.mkdir()
+    make_static(static)
+    monkeypatch.setattr(assets, "CHECK_INTERVAL", 0)
+
+    async def requests(client, static_assets):
+        before = await (await client.get("/index.html")).text()
+        (static / "app.js").write_bytes(b"changed();" * 200)
+        after = await (await client.get("/index.html")).text()
+        return before, after
+
+    before, after = run(static, requests)
+    assert before != after # the page follows the new version of app.js
+
+def test_not_found(tmp_path):
+    static = tmp_path / "static"
+    static.mkdir()
+    make_static(static)
+    (static / "sub").mkdir()
+
+    async def requests(client, static_assets):
+        return [
+            (await client.get(path)).status
+            for path in ["/missing.js", "/../secret.txt", "/%2e%2e/secret.txt", "/sub"]
+        ]
+
+    assert run(static, requests) == [404, 404, 404, 404]
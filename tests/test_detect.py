@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from astra_teleop_web.detect import parse_intrinsics
+
+CAMERA_MATRIX = [[900, 0, 640], [0, 900, 360], [0, 0, 1]]
+
+def test_parse_intrinsics():
+    camera_matrix, distortion_coefficients = parse_intrinsics(CAMERA_MATRIX, [0.1, -0.2, 0, 0, 0.05])
+    assert camera_matrix.shape == (3, 3) and camera_matrix.dtype == np.float32
+    assert distortion_coefficients.shape == (1, 5)
+    assert parse_intrinsics(CAMERA_MATRIX, [[0] * 8])[1].shape == (1, 8)
+
+@pytest.mark.parametrize("camera_matrix, distortion_coefficients", [
+    (None, [0] * 5),
+    (CAMERA_MATRIX, None),
+    ([[900, 0, 640], [0, 900, 360]], [0] * 5),
+    (CAMERA_MATRIX, [0] * 6),
+    (CAMERA_MATRIX, [[0, 0], [0, 0, 0]]),
+    ([["a"] * 3] * 3, [0] * 5),
+    (CAMERA_MATRIX, [float("nan")] * 5),
+])
+def test_parse_intrinsics_invalid(camera_matrix, distortion_coefficients):
+    with pytest.raises(ValueError):
+        parse_intrinsics(camera_matrix, distortion_coefficients)
@@ -0,0 +1,147 @@
+import asyncio
+import threading
+
+import pytest
+
+from astra_teleop_web.dispatch import Dispatcher
+
+TIMEOUT = 5 # s
+
+class BlockingCallback:
+    # Records its calls, the first one blocks until released, so messages pile up behind it
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.done = threading.Event()
+        self.expected = None
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        if len(self.calls) == 1:
+            self.started.set()
+            assert self.release.wait(TIMEOUT)
+        if self.expected is not None and len(self.calls) >= self.expected:
+            self.done.set()
+
+def run_blocked(policy, messages, expected, **kwargs):
+    # -> calls, dispatcher: messages[0] is being handled while the others are put
+    callback = BlockingCallback()
+    callback.expected = expected
+    dispatcher = Dispatcher("test", callback, policy=policy, **kwargs)
+    dispatcher.start()
+    try:
+        dispatcher.put(*messages[0])
+        assert callback.started.wait(TIMEOUT)
+        for message in messages[1:]:
+            dispatcher.put(*message)
+        callback.release.set()
+        assert callback.done.wait(TIMEOUT)
+    finally:
+        dispatcher.stop()
+    return callback.calls, dispatcher
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Dispatcher("test", print, policy="newest")
+
+def test_latest():
+    calls, dispatcher = run_blocked("latest", [(0,), (1,), (2,), (3,)], expected=2)
+    assert calls == [(0,), (3,)]
+    assert dispatcher.stats()["dropped"] == 2
+    assert dispatcher.stats()["processed"] == 2
+
+def test_coalesce_newest_by_default():
+    calls, dispatcher = run_blocked("coalesce", [([0.0],), ([0.1],), ([0.2],)], expected=2)
+    assert calls == [([0.0],), ([0.2],)]
+    assert dispatcher.stats()["dropped"] == 1
+
+def test_coalesce_merge():
+    merge = lambda old, new: (old[0] + new[0],)
+    calls, _ = run_blocked("coalesce", [(1,), (2,), (3,), (4,)], expected=2, merge=merge)
+    assert calls == [(1,), (9,)]
+
+def test_fifo():
+    calls, dispatcher = run_blocked("fifo", [(i,) for i in range(5)], expected=5)
+    assert calls == [(i,) for i in range(5)]
+    assert dispatcher.stats()["dropped"] == 0
+
+def test_fifo_maxsize():
+    calls, dispatcher = run_blocked("fifo", [(i,) for i in range(6)], expected=3, maxsize=2)
+    assert calls == [(0,), (1,), (2,)] # 3 to 5 found the queue full
+    assert dispatcher.stats()["dropped"] == 3
+
+def test_failing_callback_keeps_running():
+    calls = []
+    done = threading.Event()
+    def callback(value):
+        calls.append(value)
+        if value == 0:
+            raise RuntimeError("fails")
+        done.set()
+
+    dispatcher = Dispatcher("test", callback, policy="fifo")
+    dispatcher.start()
+    try:
+        dispatcher.put(0)
+        dispatcher.put(1)
+        assert done.wait(TIMEOUT)
+    finally:
+        dispatcher.stop()
+    assert calls == [0, 1]
+
+def test_async_one_at_a_time():
+    async def main():
+        running = 0
+        overlapped = False
+        calls = []
+
+        async def callback(value):
+            nonlocal running, overlapped
+            running += 1
+            overlapped = overlapped or running > 1
+            await asyncio.sleep(0.01)
+            calls.append(value)
+            running -= 1
+
+        dispatcher = Dispatcher("test", callback, policy="fifo")
+        assert dispatcher.is_async
+        dispatcher.start()
+        for i in range(3):
+            dispatcher.put(i)
+        for _ in range(100):
+            if len(calls) == 3:
+                break
+            await asyncio.sleep(0.01)
+        dispatcher.stop()
+        return calls, overlapped
+
+    calls, overlapped = asyncio.run(main())
+    assert calls == [0, 1, 2]
+    assert not overlapped
+
+def test_async_cancel():
+    async def main():
+        started = asyncio.Event()
+        calls = []
+
+        async def callback(value):
+            calls.append(value)
+            started.set()
+            await asyncio.sleep(TIMEOUT)
+
+        dispatcher = Dispatcher("test", callback, policy="fifo")
+        dispatcher.start()
+        dispatcher.put(0)
+        dispatcher.put(1)
+        await asyncio.wait_for(started.wait(), TIMEOUT)
+        cancelled = dispatcher.cancel() # drops 1 and cancels 0
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+        dispatcher.stop()
+        return calls, cancelled, dispatcher.stats()
+
+    calls, cancelled, stats = asyncio.run(main())
+    assert cancelled
+    assert calls == [0]
+    assert stats["depth"] == 0
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from astra_teleop_web.pose_filter import ConstantVelocityPoseFilter, LowPassPoseFilter, OneEuroPoseFilter
+
+FILTERS = [LowPassPoseFilter, OneEuroPoseFilter, ConstantVelocityPoseFilter]
+SPEED = 0.5 # m/s
+PERIOD = 1 / 30 # s
+
+def run(pose_filter, n=100):
+    # left arm moving along x at SPEED, right arm never seen; -> time of the last message
+    valid = np.array([True, False])
+    for i in range(n):
+        T = np.tile(np.eye(4), (2, 1, 1))
+        T[0, 0, 3] = SPEED * i * PERIOD
+        pose_filter(T, valid, i * PERIOD)
+    return (n - 1) * PERIOD
+
+@pytest.mark.parametrize("Filter", FILTERS)
+def test_predicts_to_the_command_time(Filter):
+    pose_filter = Filter(horizon=0)
+    last = run(pose_filter)
+    now = pose_filter.predict(last)[0, 0, 3]
+    later = pose_filter.predict(last + 0.1)[0, 0, 3]
+    assert later > now
+    assert abs(later - SPEED * (last + 0.1)) < abs(now - SPEED * (last + 0.1))
+
+@pytest.mark.parametrize("Filter", FILTERS)
+def test_prediction_capped(Filter):
+    pose_filter = Filter(horizon=0, max_prediction=0.1)
+    last = run(pose_filter)
+    np.testing.assert_allclose(pose_filter.predict(last + 5), pose_filter.predict(last + 0.1))
+    np.testing.assert_allclose(pose_filter.predict(last - 1), pose_filter.predict(last)) # not back in time
+
+def test_horizon():
+    # horizon is added to the command time
+    with_horizon = ConstantVelocityPoseFilter(horizon=0.05)
+    without = ConstantVelocityPoseFilter(horizon=0)
+    last = run(with_horizon)
+    run(without)
+    np.testing.assert_allclose(with_horizon.predict(last), without.predict(last + 0.05))
+    assert with_horizon.initialized.tolist() == [True, False]
+
+def test_reset():
+    pose_filter = OneEuroPoseFilter()
+    run(pose_filter)
+    pose_filter.reset()
+    assert pose_filter.predict(0) is None
+
+def test_still_pose_not_moved():
+    pose_filter = ConstantVelocityPoseFilter()
+    T = np.tile(np.eye(4), (1, 1, 1))
+    T[0, :3, 3] = [0.1, 0.2, 0.3]
+    for i in range(50):
+        pose_filter(T, np.array([True]), i * PERIOD)
+    np.testing.assert_allclose(pose_filter.predict(49 * PERIOD + 0.1), T, atol=1e-9)
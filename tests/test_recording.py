@@ -0,0 +1,194 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+from astra_teleop_web import wire
+from astra_teleop_web.recording import (
+    KIND_CONTROL, KIND_FRAME, KIND_HAND, KIND_PEDAL, MAGIC, ReplayWebServer, SessionLog, SessionRecorder, StubRobot, replay,
+)
+
+CAMERA_MATRIX = np.array([[900, 0, 640], [0, 900, 360], [0, 0, 1]], dtype=np.float32)
+DISTORTION = np.zeros((1, 5), dtype=np.float32)
+CORNERS = np.arange(8, dtype=np.float32).reshape(1, 1, 4, 2)
+IDS = np.array([[0]], dtype=np.int32)
+
+def frame(value, timestamp_ns, shape=(4, 6, 3)):
+    return (np.full(shape, value, dtype=np.uint8), timestamp_ns // 1000000000, timestamp_ns % 1000000000)
+
+def test_record_and_read(tmp_path):
+    path = tmp_path / "session.atwrec"
+    recorder = SessionRecorder(path, frame_interval=0)
+    recorder.record_message(KIND_HAND, wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS, seq=1))
+    recorder.record_message(KIND_CONTROL, json.dumps("reset"))
+    recorder.record_frame("head", frame(7, 1500000000))
+    recorder.record_frame("wrist_left", (*frame(9, 1600000000, shape=(6, 4)), "yuv420p"))
+    recorder.close()
+    recorder.close() # once at exit too
+
+    records = list(SessionLog(path))
+    assert [(kind, name) for kind, name, _, _ in records] == [
+        (KIND_HAND, ""), (KIND_CONTROL, ""), (KIND_FRAME, "head"), (KIND_FRAME, "wrist_left"),
+    ]
+    assert isinstance(records[0][3], bytes)
+    assert wire.parse_hand(records[0][3])[5] == 1
+    assert records[1][3] == '"reset"'
+
+    _, _, timestamp_ns, (image, pixel_format) = records[2]
+    assert timestamp_ns == 1500000000
+    assert pixel_format == "rgb24"
+    assert image.shape == (4, 6, 3) and (image == 7).all()
+
+    _, _, _, (image, pixel_format) = records[3]
+    assert pixel_format == "yuv420p"
+    assert image.shape == (6, 4) and (image == 9).all()
+
+def test_frame_interval(tmp_path):
+    path = tmp_path / "session.atwrec"
+    recorder = SessionRecorder(path, frame_interval=0.2)
+    for i in range(10):
+        recorder.record_frame("head", frame(i, 1000000000 + i * 100000000)) # 10 fps
+        recorder.record_frame("wrist_left", frame(i, 1000000000 + i * 100000000))
+    recorder.close()
+
+    values = {}
+    for _, name, _, (image, _) in SessionLog(path):
+        values.setdefault(name, []).append(int(image[0, 0, 0]))
+    assert values == { "head": [0, 2, 4, 6, 8], "wrist_left": [0, 2, 4, 6, 8] } # per track
+
+def test_frames_copied(tmp_path):
+    # the writer thread writes later, a buffer reused by the caller must not change the record
+    path = tmp_path / "session.atwrec"
+    recorder = SessionRecorder(path, frame_interval=0)
+    image, timestamp_sec, timestamp_nsec = frame(1, 1000000000)
+    recorder.record_frame("head", (image, timestamp_sec, timestamp_nsec))
+    image[...] = 2
+    recorder.close()
+    (_, _, _, (recorded, _)), = SessionLog(path)
+    assert (recorded == 1).all()
+
+def test_append(tmp_path):
+    path = tmp_path / "session.atwrec"
+    for i in range(2):
+        recorder = SessionRecorder(path)
+        recorder.record_message(KIND_PEDAL, wire.encode_pedal([0.5], seq=i))
+        recorder.close()
+    assert path.read_bytes().count(MAGIC) == 1
+    assert [wire.parse_pedal(payload)[1] for _, _, _, payload in SessionLog(path)] == [0, 1]
+
+def test_truncated(tmp_path):
+    path = tmp_path / "session.atwrec"
+    recorder = SessionRecorder(path)
+    recorder.record_message(KIND_PEDAL, wire.encode_pedal([0.5], seq=0))
+    recorder.record_message(KIND_PEDAL, wire.encode_pedal([0.5], seq=1))
+    recorder.close()
+    data = path.read_bytes()
+    path.write_bytes(data[:-8]) # cut off by a crash, into the payload (not just the padding)
+    assert len(list(SessionLog(path))) == 1
+
+def test_not_a_session_log(tmp_path):
+    path = tmp_path / "other"
+    path.write_bytes(b"something else")
+    with pytest.raises(ValueError):
+        SessionLog(path)
+
+class RecordingTeleoperator:
+    # Stands in for Teleopoperator, collects what replay calls
+    def __init__(self):
+        self.webserver = ReplayWebServer()
+        self.hands = []
+        self.pedals = []
+        self.controls = []
+
+    def hand_cb(self, camera_matrix, distortion_coefficients, corners, ids, timestamp=None):
+        self.hands.append((camera_matrix, ids, timestamp))
+
+    def pedal_cb(self, pedal_real_values):
+        self.pedals.append(list(pedal_real_values))
+
+    async def control_cb(self, control_type):
+        await asyncio.sleep(0)
+        self.controls.append(control_type)
+
+def record_session(path):
+    recorder = SessionRecorder(path, frame_interval=0)
+    recorder.record_message(KIND_CONTROL, json.dumps({
+        "type": "calibration", "camera_matrix": CAMERA_MATRIX.tolist(), "distortion_coefficients": DISTORTION.tolist(),
+    }))
+    recorder.record_message(KIND_HAND, wire.encode_hand_calibrated(0, CORNERS, IDS, seq=2))
+    recorder.record_message(KIND_HAND, wire.encode_hand_calibrated(0, CORNERS, IDS, seq=1)) # overtaken
+    recorder.record_message(KIND_HAND, wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS, seq=3))
+    recorder.record_message(KIND_PEDAL, wire.encode_pedal([0.5, 0.5, 0.5, 0.5], seq=1))
+    recorder.record_message(KIND_CONTROL, json.dumps("reset"))
+    recorder.record_message(KIND_CONTROL, json.dumps({ "type": "stats" }))
+    recorder.record_message(KIND_CONTROL, json.dumps("arm"))
+    recorder.record_frame("head", frame(1, 1000000000))
+    recorder.close()
+
+def test_replay(tmp_path):
+    path = tmp_path / "session.atwrec"
+    record_session(path)
+    teleoperator = RecordingTeleoperator()
+    stats = asyncio.run(replay(path, teleoperator, speed=None))
+
+    assert stats["hand"] == 2 and stats["stale"] == 1
+    assert stats["pedal"] == 1
+    assert stats["control"] == 2 # calibration and stats messages are not replayed
+    assert stats["frame"] == 1
+    assert stats.get("errors", 0) == 0
+
+    assert len(teleoperator.hands) == 2
+    camera_matrix, ids, timestamp = teleoperator.hands[0]
+    np.testing.assert_allclose(camera_matrix, CAMERA_MATRIX) # from the registered calibration
+    assert timestamp is not None
+    assert teleoperator.hands[1][0] is camera_matrix # v3 intrinsics interned with the same id
+    assert teleoperator.pedals == [[0.5, 0.5, 0.5, 0.5]]
+    assert teleoperator.controls == ["reset", "arm"] # in order
+    assert teleoperator.webserver.frames_fed == { "head": 1 }
+
+def test_replay_capture_timestamps(tmp_path):
+    path = tmp_path / "session.atwrec"
+    recorder = SessionRecorder(path)
+    capture_time = 1000.25 # s, client clock
+    recorder.record_message(KIND_HAND, wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS, timestamps=(capture_time * 1000, 0, 0), seq=1))
+    recorder.record_message(KIND_HAND, wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS, timestamps=(1e15, 0, 0), seq=2)) # client clock ahead
+    recorder.record_message(KIND_HAND, wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS, seq=3))
+    recorder.close()
+    receive_times = [timestamp_ns / 1000000000 for _, _, timestamp_ns, _ in SessionLog(path)]
+
+    teleoperator = RecordingTeleoperator()
+    asyncio.run(replay(path, teleoperator, speed=None))
+    assert [timestamp for _, _, timestamp in teleoperator.hands] == [capture_time, receive_times[1], receive_times[2]]
+    assert teleoperator.clock() == receive_times[-1]
+
+def test_replay_cancel(tmp_path):
+    path = tmp_path / "session.atwrec"
+    recorder = SessionRecorder(path)
+    for control_type in ["reset", "arm", "cancel", "base"]:
+        recorder.record_message(KIND_CONTROL, json.dumps(control_type))
+    recorder.close()
+
+    class SlowTeleoperator(RecordingTeleoperator):
+        async def control_cb(self, control_type):
+            await asyncio.sleep(0 if control_type == "base" else 5)
+            self.controls.append(control_type)
+
+    teleoperator = SlowTeleoperator()
+    stats = asyncio.run(replay(path, teleoperator, speed=None))
+    assert teleoperator.controls == ["base"] # reset cancelled while running, arm dropped
+    assert teleoperator.webserver.log == ["Cancelled"]
+    assert stats["cancelled"] == 1
+    assert stats.get("errors", 0) == 0
+
+def test_replay_teleoperator(tmp_path):
+    pytest.importorskip("astra_teleop")
+    from astra_teleop_web.teleoprator import Teleopoperator
+
+    path = tmp_path / "session.atwrec"
+    record_session(path)
+    teleoperator = Teleopoperator(webserver=ReplayWebServer(), control_rate=None)
+    robot = StubRobot()
+    robot.attach(teleoperator)
+    stats = asyncio.run(replay(path, teleoperator, speed=None))
+    assert stats["hand"] == 2
@@ -0,0 +1,73 @@
+import asyncio
+
+from astra_teleop_web.metrics import metrics
+from astra_teleop_web.telemetry import TelemetryPublisher
+
+def coalesced_total():
+    return metrics.values.get(("telemetry_coalesced_total", ()), [None, 0])[1]
+
+def test_nothing_to_send():
+    telemetry = TelemetryPublisher(send=None)
+    assert telemetry.flush() is None
+
+def test_logs_coalesced():
+    telemetry = TelemetryPublisher(send=None)
+    before = coalesced_total()
+    for _ in range(3):
+        telemetry.log("Lift Over Limit")
+    telemetry.log("Reset done")
+    assert telemetry.flush() == { "type": "telemetry", "logs": [["Lift Over Limit", 3], ["Reset done", 1]] }
+    assert coalesced_total() - before == 2
+    assert telemetry.flush() is None
+
+def test_repeat_interval():
+    telemetry = TelemetryPublisher(send=None, repeat_interval=60)
+    telemetry.log("Lift Over Limit")
+    assert telemetry.flush()["logs"] == [["Lift Over Limit", 1]]
+    # logged again within repeat_interval, it waits
+    telemetry.log("Lift Over Limit")
+    telemetry.log("Lift Over Limit")
+    telemetry.log("Other")
+    assert telemetry.flush()["logs"] == [["Other", 1]]
+    telemetry.sent_time["Lift Over Limit"] -= 60
+    assert telemetry.flush()["logs"] == [["Lift Over Limit", 2]]
+
+def test_state_changes_only():
+    telemetry = TelemetryPublisher(send=None)
+    telemetry.state(teleop_mode="Arm", lift_distance=0.8)
+    telemetry.state(lift_distance=0.81)
+    assert telemetry.flush() == { "type": "telemetry", "state": { "teleop_mode": "Arm", "lift_distance": 0.81 } }
+    telemetry.state(teleop_mode="Arm") # unchanged
+    assert telemetry.flush() is None
+    telemetry.state(tracking=[True, False])
+    assert telemetry.flush()["state"] == { "tracking": [True, False] }
+
+def test_resend_state():
+    telemetry = TelemetryPublisher(send=None)
+    telemetry.state(teleop_mode="Base", lift_distance=0.5)
+    telemetry.flush()
+    telemetry.resend_state()
+    assert telemetry.flush()["state"] == { "teleop_mode": "Base", "lift_distance": 0.5 }
+
+def test_run_sends_on_the_loop():
+    async def main():
+        sent = []
+        def send(message):
+            sent.append(message)
+            if len(sent) == 1:
+                raise RuntimeError("channel closed") # logged, the publisher keeps running
+
+        telemetry = TelemetryPublisher(send, interval=0.01)
+        telemetry.start()
+        telemetry.log("first")
+        await asyncio.sleep(0.05)
+        telemetry.state(teleop_mode="Arm")
+        await asyncio.sleep(0.05)
+        telemetry.stop()
+        return sent
+
+    sent = asyncio.run(main())
+    assert sent == [
+        { "type": "telemetry", "logs": [["first", 1]] },
+        { "type": "telemetry", "state": { "teleop_mode": "Arm" } },
+    ]
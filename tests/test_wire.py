@@ -0,0 +1,203 @@
+import json
+import struct
+
+import numpy as np
+import pytest
+
+from astra_teleop_web import wire
+
+CAMERA_MATRIX = np.array([[900, 0, 640], [0, 900, 360], [0, 0, 1]], dtype=np.float32)
+DISTORTION = np.array([[0.1, -0.2, 0.001, 0.002, 0.05]], dtype=np.float32)
+CORNERS = np.arange(2 * 4 * 2, dtype=np.float32).reshape(2, 1, 4, 2)
+IDS = np.array([[3], [7]], dtype=np.int32)
+TIMESTAMPS = (1000.5, 1010.25, 1012.0)
+
+def encode_hand_v1(camera_matrix, distortion_coefficients, corners, ids):
+    # v1: no timestamps, no seq
+    distortion_coefficients = np.asarray(distortion_coefficients, dtype="<f4").reshape(-1)
+    ids = np.asarray(ids, dtype="<i4").reshape(-1)
+    return b"".join([
+        wire.HAND_HEADER.pack(1, wire.KIND_HAND, len(ids), len(distortion_coefficients), 0),
+        np.asarray(camera_matrix, dtype="<f4").tobytes(),
+        distortion_coefficients.tobytes(),
+        ids.tobytes(),
+        np.asarray(corners, dtype="<f4").tobytes(),
+    ])
+
+def encode_hand_v2(camera_matrix, distortion_coefficients, corners, ids, timestamps):
+    # v2: v3 without seq
+    msg = bytearray(wire.encode_hand(camera_matrix, distortion_coefficients, corners, ids, timestamps=timestamps, seq=0))
+    msg[0] = 2
+    return bytes(msg)
+
+def assert_markers(corners, ids):
+    assert corners.shape == (2, 1, 4, 2)
+    assert ids.shape == (2, 1)
+    np.testing.assert_array_equal(corners, CORNERS)
+    np.testing.assert_array_equal(ids, IDS)
+
+def test_hand_v1():
+    msg = encode_hand_v1(CAMERA_MATRIX, DISTORTION, CORNERS, IDS)
+    camera_matrix, distortion_coefficients, corners, ids, timestamps, seq = wire.parse_hand(msg)
+    np.testing.assert_array_equal(camera_matrix, CAMERA_MATRIX)
+    np.testing.assert_array_equal(distortion_coefficients, DISTORTION)
+    assert_markers(corners, ids)
+    assert timestamps is None
+    assert seq is None
+
+def test_hand_v2():
+    msg = encode_hand_v2(CAMERA_MATRIX, DISTORTION, CORNERS, IDS, TIMESTAMPS)
+    camera_matrix, distortion_coefficients, corners, ids, timestamps, seq = wire.parse_hand(msg)
+    np.testing.assert_array_equal(camera_matrix, CAMERA_MATRIX)
+    assert_markers(corners, ids)
+    assert timestamps == TIMESTAMPS
+    assert seq is None
+
+def test_hand_v3():
+    msg = wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS, timestamps=TIMESTAMPS, seq=70000)
+    assert msg[0] == wire.HAND_VERSION == 3
+    camera_matrix, distortion_coefficients, corners, ids, timestamps, seq = wire.parse_hand(msg)
+    np.testing.assert_array_equal(camera_matrix, CAMERA_MATRIX)
+    np.testing.assert_array_equal(distortion_coefficients, DISTORTION)
+    assert_markers(corners, ids)
+    assert timestamps == TIMESTAMPS
+    assert seq == 70000 & 0xFFFF
+
+def test_hand_v3_no_markers():
+    msg = wire.encode_hand(CAMERA_MATRIX, DISTORTION, np.zeros((0, 1, 4, 2)), np.zeros((0, 1)))
+    _, _, corners, ids, _, _ = wire.parse_hand(msg)
+    assert corners.shape == (0, 1, 4, 2)
+    assert ids.shape == (0, 1)
+
+def test_hand_v4():
+    calibrations = wire.CalibrationCache()
+    calibration_id = calibrations.register(CAMERA_MATRIX, DISTORTION)
+    msg = wire.encode_hand_calibrated(calibration_id, CORNERS, IDS, timestamps=TIMESTAMPS, seq=5)
+    assert msg[0] == wire.HAND_CALIBRATION_VERSION == 4
+    assert wire.hand_calibration(msg) == calibration_id
+
+    camera_matrix, distortion_coefficients, _, _ = wire.decode_hand(msg)
+    assert camera_matrix is None and distortion_coefficients is None
+
+    camera_matrix, distortion_coefficients, corners, ids, timestamps, seq = wire.parse_hand(msg, calibrations)
+    np.testing.assert_allclose(camera_matrix, CAMERA_MATRIX)
+    np.testing.assert_allclose(distortion_coefficients, DISTORTION)
+    assert_markers(corners, ids)
+    assert timestamps == TIMESTAMPS
+    assert seq == 5
+
+def test_hand_v4_unknown_calibration():
+    msg = wire.encode_hand_calibrated(3, CORNERS, IDS)
+    with pytest.raises(KeyError):
+        wire.parse_hand(msg, wire.CalibrationCache())
+    with pytest.raises(ValueError):
+        wire.parse_hand(msg)
+
+def test_hand_json():
+    msg = json.dumps([CAMERA_MATRIX.tolist(), DISTORTION.tolist(), CORNERS.tolist(), IDS.tolist(), list(TIMESTAMPS), 9])
+    camera_matrix, _, corners, ids, timestamps, seq = wire.parse_hand(msg)
+    np.testing.assert_array_equal(camera_matrix, CAMERA_MATRIX)
+    np.testing.assert_array_equal(corners, CORNERS)
+    assert timestamps == list(TIMESTAMPS)
+    assert seq == 9
+
+def test_hand_unsupported_version():
+    msg = bytearray(wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS))
+    msg[0] = 9
+    with pytest.raises(ValueError):
+        wire.decode_hand(bytes(msg))
+
+@pytest.mark.parametrize("msg", [
+    wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS)[:-8], # truncated corners
+    wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS) + b"\0" * 4,
+    wire.encode_hand_calibrated(0, CORNERS, IDS)[:-4],
+    encode_hand_v1(CAMERA_MATRIX, DISTORTION, CORNERS, IDS)[:-4],
+    wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS)[:4], # not even a header
+])
+def test_hand_wrong_length(msg):
+    with pytest.raises(ValueError):
+        wire.parse_hand(msg, wire.CalibrationCache())
+
+def test_pedal_v1():
+    values = np.array([0.1, 0.5, 0.9, 0.0], dtype=np.float32)
+    msg = wire.PEDAL_HEADER_V1.pack(1, wire.KIND_PEDAL, len(values)) + values.tobytes()
+    decoded, seq = wire.parse_pedal(msg)
+    np.testing.assert_array_equal(decoded, values)
+    assert seq is None
+
+def test_pedal_v2():
+    values = [0.1, 0.5, 0.9, 0.0]
+    msg = wire.encode_pedal(values, seq=65537)
+    assert msg[0] == wire.PEDAL_VERSION == 2
+    decoded, seq = wire.parse_pedal(msg)
+    np.testing.assert_allclose(decoded, values, rtol=1e-6)
+    assert seq == 1
+
+def test_pedal_json():
+    assert wire.parse_pedal(json.dumps({ "seq": 4, "values": [0.5] })) == ([0.5], 4)
+    assert wire.parse_pedal(json.dumps([0.5, 0.25])) == ([0.5, 0.25], None)
+
+@pytest.mark.parametrize("msg", [
+    wire.encode_pedal([0.1, 0.5, 0.9, 0.0])[:-4],
+    wire.encode_pedal([0.1, 0.5, 0.9, 0.0]) + b"\0" * 4,
+    wire.PEDAL_HEADER_V1.pack(1, wire.KIND_PEDAL, 4) + b"\0" * 12,
+    b"\2\2",
+])
+def test_pedal_wrong_length(msg):
+    with pytest.raises(ValueError):
+        wire.parse_pedal(msg)
+
+def test_pedal_wrong_kind():
+    msg = wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS)
+    with pytest.raises(ValueError):
+        wire.decode_pedal(msg)
+
+def test_sequence_filter():
+    seq_filter = wire.SequenceFilter()
+    assert seq_filter.accept(10)
+    assert not seq_filter.accept(10) # duplicate
+    assert not seq_filter.accept(9) # overtaken
+    assert seq_filter.accept(12)
+    assert seq_filter.accept(None) # no seq, always passes
+    seq_filter.reset()
+    assert seq_filter.accept(1)
+
+def test_sequence_filter_wrap():
+    seq_filter = wire.SequenceFilter()
+    assert seq_filter.accept(0xFFFE)
+    assert seq_filter.accept(0xFFFF)
+    assert seq_filter.accept(0) # wrapped
+    assert seq_filter.accept(1)
+    assert not seq_filter.accept(0xFFFF) # from before the wrap
+    assert seq_filter.accept(0x7FFF) # just under half the range ahead
+    assert not seq_filter.accept(0x7FFF + 0x8000) # half the range ahead counts as behind
+
+def test_calibration_cache():
+    calibrations = wire.CalibrationCache()
+    first = calibrations.register(CAMERA_MATRIX, DISTORTION)
+    assert calibrations.register(CAMERA_MATRIX.tolist(), DISTORTION.tolist()) == first # same intrinsics, same id
+    second = calibrations.register(CAMERA_MATRIX * 2, DISTORTION)
+    assert (first, second) == (0, 1)
+
+    camera_matrix, distortion_coefficients = calibrations.get(first)
+    assert camera_matrix.dtype == np.float64 and camera_matrix.shape == (3, 3)
+    assert distortion_coefficients.dtype == np.float64 and distortion_coefficients.shape == (1, 5)
+    np.testing.assert_allclose(calibrations.get(second)[0], CAMERA_MATRIX * 2)
+
+    for calibration_id in [None, -1, 2]:
+        with pytest.raises(KeyError):
+            calibrations.get(calibration_id)
+
+def test_calibration_cache_interns_v3_intrinsics():
+    calibrations = wire.CalibrationCache()
+    msg = wire.encode_hand(CAMERA_MATRIX, DISTORTION, CORNERS, IDS)
+    first = wire.parse_hand(msg, calibrations)
+    second = wire.parse_hand(msg, calibrations)
+    assert first[0] is second[0] # converted once, the same arrays on every message
+    assert len(calibrations.calibrations) == 1
+
+def test_fields_aligned():
+    # every field is 4 bytes aligned, so np.frombuffer can view them
+    for header in [wire.HAND_HEADER, wire.HAND_TIMESTAMPS, wire.PEDAL_HEADER]:
+        assert header.size % 4 == 0
+    assert struct.calcsize("<BBH") == wire.PEDAL_HEADER_V1.size